@@ -10,42 +10,167 @@ __version__ = "3.14"
 __author__  = "Stathis Kanterakis"
 __license__ = "LGPL"
 
-import csv, sys, os, logging, re, traceback
-import argparse
-from numpy import reshape, floating
+import csv, sys, os, logging, re, traceback, errno, gc, marshal, mmap
 from types import IntType
-from itertools import izip
-import cPickle
-from time import sleep
-from datetime import datetime
+from itertools import izip, imap, chain, compress, count, islice
+from operator import is_, gt, itemgetter
+from cStringIO import StringIO
+from time import sleep, time
 from random import random
-from signal import signal, SIGPIPE, SIG_DFL
+from signal import signal, SIGPIPE, SIG_DFL, SIGINT, SIGTERM, SIGALRM, setitimer, ITIMER_REAL
 from collections import OrderedDict
-from natsort import natsorted, ns
+from functools import wraps
+from hashlib import md5
+from struct import pack, unpack
+from bisect import bisect_left, bisect_right
 
 # don't throw exceptions on closed pipes..
 signal(SIGPIPE,SIG_DFL)
 
-# unbuffered stdout
-UNBUFF = os.fdopen(sys.stdout.fileno(), 'w', 0)
-sys.stdout = UNBUFF
-
-# Should we profile the code?
-PROFILE = False
-PROFILE_LIMIT = 0.1 # %
-PROFILE_DAT = 'profile.dat'
-PROFILE_TXT = 'profile.txt'
-
 # global
 _COLLAPSE_CHOICES = ['append','overwrite','add','smart_append','mean']
+_STORAGE_CHOICES = ['rows','columnar']
+_JOIN_CHOICES = ['outer','inner','left','right']
+_ASSOCIATIVE_MODES = ['overwrite','append'] # merging these in any grouping gives the same result
+_SOCKET_ENV = 'PYSHEET_SOCKET' # where clients find a running server (see serve)
+_LOCK_TIMEOUT = 180.0 # how long a command waits for its --lockFile (sec)
+_OUTPUT_BUFFER = 1 << 20 # bytes of output kept before writing to stdout (see setupOutput)
+_MAX_EXACT_INT = 2**52 # integers below this stay exact in NumPy float arrays, and in sums
+_NATURAL = None # the sort key of the rows that save() writes (see _naturalKey)
 
 ####################################
-########### CLI WRAPPER ############
+############ PROFILING #############
 ####################################
 
-def main():
-    """parse command line input and call appropriate functions"""
+_PROFILE = None # the PysheetProfile being recorded, if any
+
+class PysheetProfile(object):
+    """Records the time spent in each phase of the work on sheets (loading, merging,
+    querying, saving...) while it is started, with the rows and cells of the sheets they
+    worked on, and counters of anything else. Phases are timed inclusively: a merge
+    includes the contracts it does. Only one profile records at a time"""
+    def __init__(self):
+        self.phases = OrderedDict() # name -> {seconds, calls, rows, cells}
+        self.counters = OrderedDict()
+        self.seconds = 0.0
+        self._depth = {} # phases being timed, to time nested calls once
+        self._start = None
+
+    def start(self):
+        """starts recording. Returns self"""
+        global _PROFILE
+        _PROFILE = self
+        self._start = time()
+        return self
+
+    def stop(self):
+        """stops recording"""
+        global _PROFILE
+        if _PROFILE is self:
+            _PROFILE = None
+        if self._start != None:
+            self.seconds += time() - self._start
+            self._start = None
+
+    def add(self, phase, seconds, rows=0, cells=0):
+        """adds a call to a phase"""
+        stats = self.phases.setdefault(phase, OrderedDict(
+            [('seconds', 0.0), ('calls', 0), ('rows', 0), ('cells', 0)]))
+        stats['seconds'] += seconds
+        stats['calls'] += 1
+        stats['rows'] += rows
+        stats['cells'] += cells
+
+    def count(self, counter, n=1):
+        """adds n to a counter"""
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def timed(self, phase, function, first, args, kwargs):
+        """calls function(first, *args, **kwargs) as a call to phase (see _phase)"""
+        if self._depth.get(phase):
+            return function(first, *args, **kwargs)
+        self._depth[phase] = True
+        start = time()
+        try:
+            return function(first, *args, **kwargs)
+        finally:
+            self._depth[phase] = False
+            rows = cells = 0
+            sheet = first
+            if isinstance(sheet, Pysheet) and sheet._rows != None:
+                rows = sheet.height() - 1
+                cells = rows * len(sheet)
+            self.add(phase, time() - start, rows, cells)
+
+    def report(self):
+        """returns what was recorded, as a dictionary"""
+        seconds = self.seconds
+        if self._start != None:
+            seconds += time() - self._start
+        return OrderedDict([('version', __version__), ('seconds', seconds),
+            ('phases', self.phases), ('counters', self.counters)])
+
+    def dump(self, output):
+        """writes the report as JSON to a file, or to stderr if output is None"""
+        import json
+        text = json.dumps(self.report(), indent=2) + '\n'
+        if output == None:
+            sys.stderr.write(text)
+        else:
+            with open(output, 'w') as f:
+                f.write(text)
+
+def _phase(name):
+    """times the calls of a method (or a function of a sheet) as the named phase of the
+    profile being recorded. The rows and cells are those of the sheet at the end"""
+    def decorate(method):
+        @wraps(method)
+        def timed(self, *args, **kwargs):
+            if _PROFILE is None:
+                return method(self, *args, **kwargs)
+            return _PROFILE.timed(name, method, self, args, kwargs)
+        return timed
+    return decorate
+
+def _count(counter, n=1):
+    """adds n to a counter of the profile being recorded, if any"""
+    if _PROFILE is not None:
+        _PROFILE.count(counter, n)
 
+####################################
+########### CLI WRAPPER ############
+####################################
+
+def main(argv=None):
+    """parse command line input and call appropriate functions. The command line is
+    sent to the server at $PYSHEET_SOCKET if one is running (see serve)"""
+    if argv == None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['serve']:
+        serve(argv[1:])
+        return
+    if os.environ.get(_SOCKET_ENV) and 'stdin' not in argv:
+        code = forward(os.environ[_SOCKET_ENV], argv)
+        if code != None:
+            sys.exit(code)
+
+    parser = argParser()
+    # if no arguments given
+    if not argv:
+        parser.print_usage()
+        sys.exit(1)
+    args = parser.parse_args(argv)
+    stdout = setupOutput(args.unbuffered)
+    try:
+        run(args)
+    finally:
+        if sys.stdout is not stdout: # ours, not the caller's
+            sys.stdout.close() # writes out what is left
+        sys.stdout = stdout
+
+def argParser():
+    """returns the parser of the command line"""
+    import argparse
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
     description="A library to read and write delimited text files", epilog="""
 * = can take multiple arguments
@@ -71,8 +196,18 @@ Examples:
     touch res.csv; %(prog)s -d res.csv -w iteration_$i Result $val -o res.csv -L
         add an entry to the results file, locking before read/write access
 
+    %(prog)s -d res.csv -w iteration_$i Result $val -o res.csv -L -LM flock
+        as above, with a kernel lock that is freed if the job dies. Locks of different
+        methods do not exclude each other: every job writing res.csv must use -LM flock
+
+    %(prog)s -w iteration_$i Result $val -o res.csv -J; %(prog)s --compact -o res.csv -L
+        journal entries from many parallel jobs without rewriting res.csv, then fold them in
+
     %(prog)s -d table.txt -D '\\t' -i -1 -k 2 3 1 -o stdout -O '\\t' -n | further_proc
         rearrange columns of tab-delimited file and forward output to stdout
+
+    export PYSHEET_SOCKET=/tmp/pysheet.sock; %(prog)s serve &
+        keep the sheets in memory between the commands that follow (see serve -h)
 """)
     groupI = parser.add_argument_group('Input')
     groupI.add_argument('--data', '-d', type=readable, nargs='*', metavar="FILE",
@@ -91,10 +226,15 @@ Examples:
             metavar='INT', help='Skip columns from the right of the file *')
     groupI.add_argument('--trans', '-t', type=yesNo, nargs='*', default=[False],
             metavar='Y|N', help='Read data transposed *')
+    groupI.add_argument('--transCells', type=int, default=Pysheet._TRANSPOSE_CELLS,
+            metavar='INT', help='Transpose (-t, -T) at most this many cells in memory, '
+            'spilling the rest to temporary files. Default is %d' % Pysheet._TRANSPOSE_CELLS)
     groupI.add_argument('--rstack', '-rs', action='store_true',
             help='Stack input files by rows (regardless of headers)')
     groupI.add_argument('--cstack', '-cs', action='store_true',
             help='Stack input files by columns (regardless of IDs)')
+    groupI.add_argument('--jobs', '-j', type=int, default=1, metavar='INT',
+            help='Read and merge input files in this many processes. Default is 1')
 
     groupO = parser.add_argument_group('Output')
     groupO.add_argument('--out', '-o', type=writeable, metavar="FILE",
@@ -108,6 +248,9 @@ Examples:
     groupO.add_argument('--outTrans', '-T', action='store_true', help='Write output transposed')
     groupO.add_argument('--outFname', '-OF', action='store_true',
             help='Add source filename as column')
+    groupO.add_argument('--snapshot', action='store_true',
+            help='Also save a binary snapshot of the output file (FILE.pysheet), '
+            'which is read instead of it for as long as it is unchanged')
 
     groupRW = parser.add_argument_group('Add/Remove')
     groupRW_me = groupRW.add_mutually_exclusive_group()
@@ -124,8 +267,22 @@ Examples:
             help="Remove columns with missing values")
     groupRW.add_argument('--lockFile', '-L', nargs='?', type=writeable,
             help="Read/write lock to prevent parallel jobs from overwriting the data. "
-            "Use in asynchronous loops. You may specify a filename (default is <out>.lock)",
+            "Use in asynchronous loops. You may specify a filename (default is <out>.lock). "
+            "By default waiters poll for the lock (see --lockMethod)",
                     const=True)
+    groupRW.add_argument('--journal', '-J', action='store_true',
+            help="Append --write cells to <out>.journal instead of rewriting the output. "
+            "The journal is folded in whenever the output is read and cleared when it is saved. "
+            "Other commands that save a journaled output must also use --lockFile")
+    groupRW.add_argument('--compact', action='store_true',
+            help="Fold <out>.journal into the output")
+    groupRW.add_argument('--lockMethod', '-LM', choices=sorted(_LOCKS.keys()),
+            default=_DEFAULT_LOCK, help="How to lock: flock or lockf (kernel locks on the "
+            "lock file), excl (exclusively created lock file, kept fresh while held) or "
+            "poll (legacy polling, which waits up to seconds after the lock is freed). "
+            "The methods do not exclude each other, so all jobs writing to a file must "
+            "use the same one. Default is %s, as in older versions: pass -LM flock to "
+            "wait in the kernel instead" % _DEFAULT_LOCK)
 
     groupC = parser.add_argument_group('Consolidate')
     groupC.add_argument('--consolidate', '-c', nargs='*', action='append',
@@ -142,11 +299,18 @@ Examples:
 
     groupQ = parser.add_argument_group('Query')
     groupQ.add_argument('--columns', '-k', nargs='*',
-            help="Extract specific columns from data. Default: print all columns")
+            help="Extract specific columns from data. Default: print all columns "
+            "(NOTE: a single file is read row by row only with --out stdout and "
+            "--idCol -1)")
     groupQ.add_argument('--query', '-q', nargs='*', help="Extract IDs that meet a query "
-            "(NOTE: will not return IDs with entry in special 'Exclude' column)")
+            "(NOTE: will not return IDs with entry in special 'Exclude' column. On its "
+            "own, a single file is read row by row, keeping only the matching IDs)")
     groupQ.add_argument('--printHeaders', '-H', action='store_true',
             help="Prints all column headers and their index")
+    groupQ.add_argument('--head', type=positive, metavar='INT',
+            help="Print only the first INT rows of --columns")
+    groupQ.add_argument('--page', type=positive, metavar='INT',
+            help="Print --columns in pages of INT rows, each with its own header")
 
     # this is for testing purposes. will sleep before writing to test locking stuff..
     parser.add_argument('--wait', type=int, help=argparse.SUPPRESS)
@@ -155,22 +319,64 @@ Examples:
 
     parser.add_argument('--version', '-V', action='version', version="%(prog)s v" + __version__)
     parser.add_argument('--verbose', '-v', action='count', help='verbosity level')
-
-    # if no arguments given
-    if len(sys.argv) < 2:
-        parser.print_usage()
-        sys.exit(1)
+    parser.add_argument('--unbuffered', '-u', action='store_true',
+            help='Write output to stdout as soon as it is produced. Default is to write it '
+            'in large blocks, or a line at a time to a terminal')
+    parser.add_argument('--profile', nargs='?', const=True, metavar='FILE',
+            help='Write the time spent loading, locking, merging, querying, saving etc. as '
+            'JSON to FILE (default is stderr)')
+    return parser
+
+def setupLogging(verbose):
+    """logs to the current stderr: warnings, or more with verbose"""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(sys.stderr)
+    if verbose:
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s - [%(name)s] - %(levelname)s - %(message)s'))
+        root.setLevel(logging.INFO if verbose == 1 else logging.DEBUG)
     else:
-        args = parser.parse_args()
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        root.setLevel(logging.WARNING)
+    root.addHandler(handler)
+
+def setupOutput(unbuffered=False):
+    """makes stdout write in blocks of _OUTPUT_BUFFER bytes, a line at a time to a
+    terminal, or every write at once if unbuffered. Returns the previous stdout"""
+    previous = sys.stdout
+    try:
+        fileno = previous.fileno()
+    except (AttributeError, ValueError):
+        return previous # not a file, leave it be
+    previous.flush()
+    size = 0 if unbuffered else 1 if os.isatty(fileno) else _OUTPUT_BUFFER
+    sys.stdout = os.fdopen(os.dup(fileno), 'w', size)
+    return previous
+
+def run(args, server=None):
+    """carries out a parsed command line. server is the SheetServer that runs it, if any"""
+    if not args.profile:
+        return _run(args, server)
+    profile = PysheetProfile().start()
+    try:
+        return _run(args, server)
+    finally:
+        profile.stop()
+        try:
+            profile.dump(None if args.profile == True else args.profile)
+        except IOError as e:
+            logging.warn("!!! Could not write the profile: %s" % e)
+
+def _run(args, server=None):
+    """carries out a parsed command line (see run)"""
 
     # setup logging
     myPid = str(os.getpid())
-    if args.verbose == 1:
-        logging.basicConfig(level="INFO",
-                format='%(asctime)s - [%(name)s] - %(levelname)s - %(message)s')
-    elif args.verbose > 1:
-        logging.basicConfig(level="DEBUG",
-                format='%(asctime)s - [%(name)s] - %(levelname)s - %(message)s')
+    setupLogging(args.verbose)
+    Pysheet._DEBUG = args.verbose > 1
+    Pysheet._TRANSPOSE_CELLS = args.transCells
 
     # are there leftover parameters?
     if args.catchall:
@@ -214,6 +420,40 @@ Examples:
                     logging.warn("!!! Too many %s: %d. Required up to: %d. Disregarding the rest" % (
                         check_name, len(check_values), numOfSheets))
 
+    # journaled writes and compaction
+    if args.journal:
+        if not args.write or not args.out or args.out == 'stdout':
+            logging.critical("!!! --journal needs cells to --write and an --out file")
+            sys.exit(1)
+        if (numOfSheets > 1 or args.clean or args.consolidate or args.removeMissingRows or
+                args.removeMissingColumns or args.columns != None or args.query != None or
+                args.outFname or args.outTrans or args.outHeader or args.outNoHeader or
+                args.compact):
+            logging.critical("!!! --journal can only be combined with --write")
+            sys.exit(1)
+        if [d for d in args.data if d != None and os.path.realpath(d) != os.path.realpath(
+                args.out)]:
+            logging.critical("!!! --journal writes to the journal of --out, not to --data: %s" %
+                    flatten(args.data))
+            sys.exit(1)
+        args.data = [None] # the sheet is not read
+        if not args.lockFile:
+            args.lockFile = True # appends must not interleave with compaction
+    if args.compact:
+        if not args.out or args.out == 'stdout':
+            logging.critical("!!! --compact needs an --out file")
+            sys.exit(1)
+        if not args.lockFile:
+            args.lockFile = True # nor must other saves
+        if args.data == [None]:
+            args.data = [args.out]
+            numOfSheets = 1
+            for check_name in ["delim", "idCol", "skipRow", "skipCol", "noHeader", "trans"]:
+                setattr(args, check_name, getattr(args, check_name)[:1])
+
+    # is the sheet kept in memory between commands?
+    resident = server.sheet(args, collapse) if server else None
+
     # save once at the end if needed
     save = False
     if args.out: save = True
@@ -230,6 +470,11 @@ Examples:
     if args.out:
         logging.info("+++ Output file: %s" % args.out)
 
+    if (not args.lockFile and args.out and args.out != 'stdout' and
+            os.path.isfile(args.out + Pysheet._JOURNAL_EXT)):
+        logging.warn("!!! %s is journaled: save it with --lockFile, or cells journaled "
+                "meanwhile may be lost" % args.out)
+
     # LOCKING
     lock = False
     if args.lockFile:
@@ -245,7 +490,8 @@ Examples:
                     if args.out and os.path.samefile(args.lockFile, args.out):
                         logging.critical("!!! lockFile can't be the same as your output file!")
                         sys.exit(1)
-                    if args.data and os.path.samefile(args.lockFile, args.data[0]):
+                    if args.data and args.data[0] and os.path.samefile(
+                            args.lockFile, args.data[0]):
                         logging.critical("!!! lockFile can't be the same as your data file!")
                         sys.exit(1)
                 except OSError: # file was deleted in the meantime
@@ -260,37 +506,16 @@ Examples:
 
     # perform locking ?
     if lock:
-        counter = 1.0
-        timeoutSec = 180.0
-        staleSec = timeoutSec + 2
-        # see if there are leftover locks
-        if os.path.isfile(args.lockFile):
-            try:
-                lockTime = datetime.fromtimestamp(os.path.getmtime(args.lockFile))
-                curTime = datetime.now()
-                if (curTime - lockTime).seconds > staleSec:
-                    logging.warn("!!! Removing stale lock: %s" % args.lockFile)
-                    os.remove(args.lockFile)
-            except OSError: # lock was already removed!
-                pass
-        # wait for all other instances to finish writing
-        while counter < timeoutSec:
-            if os.path.isfile(args.lockFile):
-                counter += random()
-                sleep(counter)
-            else: # attempt a lock
-                open(args.lockFile,'w').write(myPid)
-                sleep(random())
-                try:
-                    thisPid = open(args.lockFile,'rU').read()
-                    if thisPid == myPid: # we've successfully acquired a lock!
-                        break
-                except IOError: # somebody removed the lock externally...
-                    continue
-        if counter > 1:
-            logging.debug(">>> Process slept for %d sec waiting for lock..." % counter)
-        # we've exceeded the timeoutSec and a process is still writing. now what?
-        if counter >= timeoutSec:
+        timeoutSec = _LOCK_TIMEOUT
+        locker = getLock(args.lockMethod, args.lockFile)
+        logging.debug(">>> Grabbing lock (%s)..." % args.lockMethod)
+        acquired = locker.acquire(timeoutSec)
+        if _PROFILE is not None:
+            _PROFILE.add('lock', locker.waited)
+        if acquired:
+            logging.info(">>> Waited %.3f sec for lock" % locker.waited)
+        else:
+            # we've exceeded the timeoutSec and a process is still writing. now what?
             args.out += "." + myPid
             logging.critical("""
 !!! LOCK TIMEOUT LIMIT EXCEEDED (%(lt)d seconds)
@@ -300,8 +525,39 @@ Examples:
 !!! %(prog)s %(ds)s %(os)s -o %(ds)s""" % {
 "lt":timeoutSec, "ds":args.data[0], "os":args.out, "prog":sys.argv[0]})
             lock = False
-        else:
-            logging.debug(">>> Grabbing lock...")
+            if resident != None: # the changes are not for the sheet in memory
+                server.detach()
+                resident = None
+
+    # append to the journal and leave the sheet alone
+    if args.journal:
+        try:
+            ncells = appendJournal(args.out + Pysheet._JOURNAL_EXT,
+                    _groups(args.write, 3), args.mode, collapse)
+            logging.info("=== Journaled %d cell%s.." % (ncells, '' if ncells==1 else 's'))
+            _count('cells journaled', ncells)
+        except ValueError:
+            logging.critical("!!! Cell entries must be of the form 'ID header value': %s" % flatten(
+                args.write))
+            sys.exit(1)
+        finally:
+            if lock:
+                logging.debug(">>> Releasing lock...")
+                locker.release()
+        return
+
+    # can we answer this row by row, without loading the whole sheet?
+    streamMode = streamable(args) if resident == None else None
+    if streamMode:
+        try:
+            streamQuery(args, streamMode)
+        except PysheetException as e:
+            logging.critical(e.message)
+            sys.exit(3)
+        except KeyboardInterrupt:
+            logging.critical("!!! Interrupted")
+            sys.exit(1)
+        return
 
     # check if output exists
     if args.out and args.out != 'stdout' and os.path.isfile(args.out) and not args.out in args.data:
@@ -311,34 +567,30 @@ Examples:
 
     try:
         # now read the file
-        mycsv = Pysheet(args.data[0], delimiter=args.delim[0], idColumn=args.idCol[0],
-                skip=args.skipRow[0], skipColR=args.skipCol[0], noHeader=args.noHeader[0],
-                rstack=args.rstack, cstack=args.cstack, trans=args.trans[0])
-        mycsv._COLLAPSE = collapse
-
-        # add filename column?
-        if args.outFname:
-            mycsv.insertColumn("filename", init = mycsv.filename)
+        specs = [(args.data[m], dict(delimiter=args.delim[m], idColumn=args.idCol[m],
+                skip=args.skipRow[m], skipColR=args.skipCol[m], noHeader=args.noHeader[m],
+                rstack=args.rstack, cstack=args.cstack, trans=args.trans[m]))
+                for m in range(len(args.data))]
+        if resident != None:
+            mycsv = resident
+        else:
+            mycsv = loadSheet(specs[0][0], collapse, args.outFname, lazy=lazyReadable(args),
+                    **specs[0][1])
 
         # merge
-        if numOfSheets > 1:
-            for m in range(1, numOfSheets):
-                myothercsv = Pysheet(args.data[m], delimiter=args.delim[m],
-                        idColumn=args.idCol[m], skip=args.skipRow[m],
-                        skipColR=args.skipCol[m],
-                        noHeader=args.noHeader[m], rstack=args.rstack,
-                        cstack=args.cstack, trans=args.trans[m])
-                myothercsv._COLLAPSE = collapse
-                # add filename column?
-                if args.outFname:
-                    myothercsv.insertColumn("filename", init = myothercsv.filename)
+        if numOfSheets > 1 and args.jobs > 1:
+            mycsv = mergeFiles(mycsv, specs[1:], args.mode, collapse, args.outFname,
+                    args.jobs)
+        elif numOfSheets > 1:
+            for filename, kwargs in specs[1:]:
+                myothercsv = loadSheet(filename, collapse, args.outFname, **kwargs)
                 mycsv += myothercsv # __add__
                 mycsv.contract(mode=args.mode) # merge same columns
 
         # remove cells
         if args.remove:
             try:
-                cells = reshape(args.remove,(len(args.remove)/2,2))
+                cells = _groups(args.remove, 2)
                 printed = 0
                 for i in range(len(cells)):
                     if cells[i][1].lower() == "none":
@@ -353,6 +605,7 @@ Examples:
                         sys.stdout.write(str(ret))
                         printed += 1
                 logging.info("=== Deleted %d cell%s.." % (printed, '' if printed==1 else 's'))
+                _count('cells deleted', printed)
             except ValueError:
                 logging.critical("!!! Cell entries must be of the form 'ID header': %s" % flatten(
                     args.remove))
@@ -362,18 +615,14 @@ Examples:
         # add cells
         if args.write:
             try:
-                cells = reshape(args.write,(len(args.write)/3,3))
+                cells = _groups(args.write, 3)
                 #save = True
-                ncells = len(cells)
+                ncells = 0
                 for i in range(len(cells)):
-                    if cells[i][0].lower() == "none":
-                        mycsv.insertColumn(cells[i][1], init=cells[i][2])
-                        ncells = ncells - 2 + mycsv.height()
-                    elif cells[i][1].lower() == "none":
-                        mycsv.addCell(cells[i][0], mode=args.mode)
-                    else:
-                        mycsv.addCell(cells[i][0],cells[i][1],cells[i][2], mode=args.mode)
+                    ncells += mycsv.writeCell(cells[i][0], cells[i][1], cells[i][2],
+                            mode=args.mode)
                 logging.info("=== Added %d cell%s.." % (ncells, '' if ncells==1 else 's'))
+                _count('cells added', ncells)
             except ValueError:
                 logging.critical("!!! Cell entries must be of the form 'ID header value': %s" % flatten(
                     args.write))
@@ -408,7 +657,7 @@ Examples:
                 cols.load(mycsv.getColumns(args.columns, blanks=True, exclude=False))
                 mycsv = cols # make this the current spreadsheet
             if not args.out and not args.query and not args.read and not args.printHeaders:
-                sys.stdout.write(str(mycsv))
+                sys.stdout.writelines(mycsv.iterTable(args.head, args.page))
         # print headers
         if args.printHeaders:
             for hi in range(len(mycsv.getHeaders())):
@@ -420,13 +669,14 @@ Examples:
             retList.sort()
             logging.info("=== Query '%s' returned %d ID%s.." % (flatten(args.query),
                 len(retList), '' if len(retList)==1 else 's'))
-            for item in retList:
-                sys.stdout.write(item+"\n")
+            _count('ids returned', len(retList))
+            sys.stdout.writelines(item+"\n" for item in retList)
         # by cells
         if args.read:
             try:
-                cells = reshape(args.read,(len(args.read)/2,2))
+                cells = _groups(args.read, 2)
                 printed = 0
+                start = time() # grab() is too quick to time each call
                 for i in range(len(cells)):
                     if cells[i][1].lower() == "none":
                         ret = mycsv.grab(key=cells[i][0])
@@ -438,6 +688,10 @@ Examples:
                         sys.stdout.write(str(ret))
                         printed += 1
                 logging.info("=== Printed %d cell%s.." % (printed, '' if printed==1 else 's'))
+                if _PROFILE is not None:
+                    _PROFILE.add('query', time() - start, mycsv.height() - 1,
+                            (mycsv.height() - 1) * len(mycsv))
+                _count('cells printed', printed)
             except ValueError:
                 logging.critical("!!! Cell entries must be of the form 'ID header': %s" % flatten(
                     args.read))
@@ -448,8 +702,12 @@ Examples:
             if args.wait:
                 logging.debug(">>> Sleeping %d sec" % args.wait)
                 sleep(args.wait)
-            mycsv.save(args.out, args.outDelim, not args.outNoHeader, args.outHeader, args.outTrans)
-            logging.info("=== Saved as: %s" % args.out)
+            if server and server.saved(mycsv, args):
+                logging.info("=== Saving as: %s" % args.out)
+            else:
+                mycsv.save(args.out, args.outDelim, not args.outNoHeader, args.outHeader,
+                        args.outTrans, args.snapshot)
+                logging.info("=== Saved as: %s" % args.out)
 
     # catch all exception thrown by Pysheet objects
     except PysheetException as e:
@@ -458,12 +716,771 @@ Examples:
     except KeyboardInterrupt:
         logging.critical("!!! Interrupted")
         sys.exit(1)
+    finally:
+        if lock:
+            logging.debug(">>> Releasing lock...")
+            locker.release()
+
+
+
+def _groups(items, size):
+    """splits the items of a command line option into lists of size items. Raises
+    ValueError if there are items left over"""
+    if len(items) % size:
+        raise ValueError("%d items are not in groups of %d" % (len(items), size))
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+def streamable(args):
+    """returns 'query' or 'columns' if the command line can be answered by streaming
+    the (single) input file row by row, or None if the whole sheet is needed"""
+    if len(args.data) != 1 or not args.data[0] or args.trans[0] or args.rstack or args.cstack:
+        return None
+    if (args.write or args.read or args.remove or args.clean or args.consolidate or
+            args.removeMissingRows or args.removeMissingColumns or args.printHeaders or
+            args.outFname or args.outTrans or args.lockFile):
+        return None
+    if any('=UNIQUE' in str(c) for c in (args.query or []) + (args.columns or [])):
+        return None # needs all rows
+    if os.path.isfile(args.data[0] + Pysheet._JOURNAL_EXT):
+        return None # journaled cells are folded into the loaded sheet
+    if Pysheet(delimiter=args.delim[0])._openSnapshot(args.data[0], (args.idCol[0],
+            args.skipRow[0], args.skipCol[0], args.noHeader[0], False, False, False)):
+        return None # loading the snapshot is quicker
+    if args.query and args.columns == None and not args.out:
+        return 'query' # only the matching IDs are kept (for sorting)
+    if args.columns and not args.query and args.out == 'stdout' and args.idCol[0] < 0:
+        return 'columns' # auto IDs are not sorted on output
+    return None
+
+def lazyReadable(args):
+    """returns True if the command line only reads cells of a single input file, so
+    that just the rows asked for need to be parsed (see LazyRows)"""
+    if (len(args.data) != 1 or not args.data[0] or args.data[0] == 'stdin' or
+            not args.read or args.idCol[0] < 0 or args.noHeader[0] or args.trans[0] or
+            args.rstack or args.cstack):
+        return False
+    return not (args.out or args.clean or args.consolidate or args.removeMissingRows or
+            args.removeMissingColumns or args.columns != None or args.query != None or
+            args.printHeaders or args.outFname)
+
+@_phase('query')
+def streamQuery(args, mode):
+    """answers a --query (mode='query') or writes --columns to stdout (mode='columns')
+    reading the input file row by row"""
+    sheet = Pysheet(delimiter=args.delim[0], idColumn=args.idCol[0])
+    rows = sheet.iterColumns(args.query if mode == 'query' else args.columns,
+            blanks=mode != 'query', exclude=mode == 'query', filename=args.data[0],
+            idColumn=args.idCol[0], skip=args.skipRow[0], skipColR=args.skipCol[0],
+            noHeader=args.noHeader[0])
+    if mode == 'query':
+        matches = {} # only the keys that match are kept
+        for key, row in rows:
+            if key == sheet._HEADERS_ID:
+                continue
+            if row and row[0] != None:
+                matches[key] = row[0]
+            else:
+                matches.pop(key, None) # last duplicate wins, like load
+        retList = matches.values()
+        retList.sort()
+        logging.info("=== Query '%s' returned %d ID%s.." % (flatten(args.query),
+            len(retList), '' if len(retList)==1 else 's'))
+        _count('ids returned', len(retList))
+        sys.stdout.writelines(item+"\n" for item in retList)
+        return
+    # same as loading the extracted columns into a new sheet and saving it
+    delimiter = "\t" if args.outDelim == r'\t' else args.outDelim
+    writer = csv.writer(sys.stdout, delimiter=delimiter)
+    for key, row in rows:
+        if key == sheet._HEADERS_ID:
+            header = [str(row[i]).strip() if str(row[i]).strip() else "V%03d" % i
+                    for i in range(len(row))][1:] # drop the auto IDs
+            if args.outHeader and len(args.outHeader) != len(header):
+                raise PysheetException(("Output headers given do not match number of "
+                "output columns (%d)!\n%s") % (len(header), flatten(args.outHeader, ", ")))
+            elif args.outHeader:
+                header = args.outHeader
+            if not args.outNoHeader:
+                writer.writerow(header)
+        elif row:
+            writer.writerow([cellString(x) for x in row[1:]])
+
+def appendJournal(path, cells, mode='smart_append', collapse=';'):
+    """appends (ID, header, value) cells to the journal at path, without reading the
+    sheet it belongs to. They are folded in by Pysheet.replayJournal when the sheet is
+    loaded. Returns the number of cells appended"""
+    buf = StringIO()
+    writer = csv.writer(buf)
+    ncells = 0
+    for key, header, value in cells:
+        writer.writerow([key, header, value, mode, collapse])
+        ncells += 1
+    data = buf.getvalue()
+    while True:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        _lockFile(fd) # waits while the journal is being dropped
+        try:
+            if os.path.samestat(os.fstat(fd), os.stat(path)):
+                break
+        except OSError: # dropped while we waited
+            pass
+        os.close(fd) # replaced while we waited
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+    return ncells
+
+def loadSheet(filename, collapse=';', outFname=False, idHeader=None, **kwargs):
+    """reads a sheet to be merged. kwargs are passed on to Pysheet. idHeader renames
+    the ID column, as adding it to a sheet with that ID header would"""
+    sheet = Pysheet(filename, **kwargs)
+    sheet._COLLAPSE = collapse
+    # add filename column?
+    if outFname:
+        sheet.insertColumn("filename", init = sheet.filename)
+    if idHeader != None and sheet.getHeaders():
+        sheet.getHeaders()[sheet.idColumn] = idHeader
+        sheet._headerMap = None
+    return sheet
+
+def mergeSheets(sheets, mode='smart_append', final=True):
+    """merges a list of sheets pairwise, level by level. The result is the same as adding
+    them up from left to right and contracting after each one: 'overwrite' and 'append'
+    are contracted at every level, the other modes (which depend on the order of merging)
+    only merge the ID columns until the end, unless final=False"""
+    idsOnly = mode not in _ASSOCIATIVE_MODES
+    # sheets with columns named as the ID column re-key the rows merged so far (see
+    # contract), so they are added to everything on their left, and everything on
+    # their right is added to the result
+    cuts = [i for i in range(1, len(sheets))
+            if sheets[i].idClashes() or sheets[i-1].idClashes()]
+    merged = None
+    for start, end in izip([0] + cuts, cuts + [len(sheets)]):
+        run = sheets[start:end]
+        if merged is not None:
+            run = [_mergeTree([merged, run[0]], mode, idsOnly)] + run[1:]
+        merged = _mergeTree(run, mode, idsOnly)
+    if final and idsOnly and len(sheets) > 1:
+        merged.contract(mode=mode)
+    return merged
+
+def _mergeTree(sheets, mode, idsOnly):
+    """adds up sheets pairwise until one is left"""
+    while len(sheets) > 1:
+        level = []
+        for i in range(0, len(sheets) - 1, 2):
+            sheet = sheets[i] + sheets[i+1] # __add__
+            sheet.contract(mode=mode, idsOnly=idsOnly) # merge same columns
+            level.append(sheet)
+        if len(sheets) % 2:
+            level.append(sheets[-1])
+        sheets = level
+    return sheets[0]
+
+def _loadChunk(specs, mode, collapse, outFname, idHeader):
+    """loads and merges a list of (filename, kwargs) in a worker process. Sheets that
+    re-key rows (see mergeSheets) are returned on their own, in between merged runs"""
+    runs = []
+    for filename, kwargs in specs:
+        sheet = loadSheet(filename, collapse, outFname, idHeader, **kwargs)
+        if not runs or sheet.idClashes() or runs[-1][0].idClashes():
+            runs.append([])
+        runs[-1].append(sheet)
+    return [_mergeTree(run, mode, mode not in _ASSOCIATIVE_MODES) for run in runs]
+
+def _initWorker():
+    """reseeds forked workers so that their sheets get distinct object IDs"""
+    import random
+    random.seed()
+
+@_phase('merge')
+def mergeFiles(first, specs, mode='smart_append', collapse=';', outFname=False, jobs=2):
+    """merges the files in specs, a list of (filename, kwargs), into the first sheet.
+    Files are split into as many runs as jobs, each read and merged in its own process,
+    and the runs are then merged together (see mergeSheets). stdin is read here"""
+    from multiprocessing import Pool
+    idHeader = first.getHeaders()[first.idColumn] if first.getHeaders() else None
+    sheets = [first]
+    if first.idClashes() and specs:
+        # first re-keys the rows of the next file alone, so that is not merged ahead
+        sheets.extend(_loadChunk(specs[:1], mode, collapse, outFname, idHeader))
+        specs = specs[1:]
+    if not specs:
+        return mergeSheets(sheets, mode)
+    size = -(-len(specs) // jobs)
+    chunks = [specs[i:i+size] for i in range(0, len(specs), size)]
+    pool = Pool(min(jobs, len(chunks)), initializer=_initWorker)
+    try:
+        results = [None if 'stdin' in [f for f, _ in chunk] else
+                pool.apply_async(_loadChunk, (chunk, mode, collapse, outFname, idHeader))
+                for chunk in chunks]
+        pool.close()
+        for chunk, result in izip(chunks, results):
+            if result == None:
+                sheets.extend(_loadChunk(chunk, mode, collapse, outFname, idHeader))
+            else:
+                sheets.extend(result.get())
+        pool.join()
+    finally:
+        pool.terminate()
+    return mergeSheets(sheets, mode)
 
-    if lock:
-        logging.debug(">>> Releasing lock...")
-        os.remove(args.lockFile)
+####################################
+############# LOCKING ##############
+####################################
+
+class PysheetLock(object):
+    """Base class for the --lockFile backends. acquire() waits for the lock and
+    records the time it waited in self.waited. Subclasses provide _tryAcquire(), which
+    attempts to take the lock without waiting, and release(), which releases it and
+    removes the lock file"""
+    _MAX_DELAY = 0.05 # the longest a waiter sleeps before trying again (sec)
+
+    def __init__(self, path):
+        self.path = path
+        self.waited = 0.0
+
+    def acquire(self, timeout=180.0):
+        """takes the lock. Returns False if it could not be taken within timeout seconds"""
+        start = time()
+        delay = 0.001
+        while not self._tryAcquire():
+            self.waited = time() - start
+            if self.waited >= timeout:
+                return False
+            sleep(delay)
+            delay = min(delay * 2, self._MAX_DELAY)
+        self.waited = time() - start
+        return True
+
+def _interrupt(signum, frame):
+    """SIGALRM handler that only interrupts the blocking call it arrives in"""
+    pass
+
+class FlockLock(PysheetLock):
+    """Locks with fcntl.flock on the lock file. The kernel drops the lock if we die"""
+    def _lock(self, fd, block=False):
+        import fcntl
+        fcntl.flock(fd, fcntl.LOCK_EX | (0 if block else fcntl.LOCK_NB))
+
+    def acquire(self, timeout=180.0):
+        """waits for the lock in the kernel, until SIGALRM interrupts the wait at timeout.
+        Signals are only delivered to the main thread, so other threads poll instead"""
+        import threading
+        if not isinstance(threading.current_thread(), threading._MainThread):
+            return PysheetLock.acquire(self, timeout)
+        start = time()
+        handler = signal(SIGALRM, _interrupt)
+        try:
+            while True:
+                self.waited = time() - start
+                if self.waited >= timeout:
+                    return False
+                setitimer(ITIMER_REAL, timeout - self.waited)
+                try:
+                    if self._tryAcquire(block=True):
+                        break
+                finally:
+                    setitimer(ITIMER_REAL, 0)
+        finally:
+            signal(SIGALRM, handler if handler != None else SIG_DFL)
+        self.waited = time() - start
+        return True
+
+    def _tryAcquire(self, block=False):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            self._lock(fd, block)
+            # whoever held it may have removed the file, in which case we locked a stale copy
+            if os.path.samestat(os.fstat(fd), os.stat(self.path)):
+                os.ftruncate(fd, 0)
+                os.write(fd, str(os.getpid()))
+                self._fd = fd
+                return True
+        except IOError as e: # held by another process, or the wait timed out (EINTR)
+            if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EINTR):
+                os.close(fd)
+                raise
+        except OSError as e: # lock file was removed
+            if e.errno != errno.ENOENT:
+                os.close(fd)
+                raise
+        os.close(fd)
+        return False
+
+    def release(self):
+        try:
+            os.remove(self.path) # while still holding the lock
+        except OSError:
+            pass
+        os.close(self._fd) # releases the lock
+
+class LockfLock(FlockLock):
+    """Locks with fcntl.lockf (POSIX record locks, which also work over NFS)"""
+    def _lock(self, fd, block=False):
+        import fcntl
+        fcntl.lockf(fd, fcntl.LOCK_EX | (0 if block else fcntl.LOCK_NB))
+
+class ExclLock(PysheetLock):
+    """Creates the lock file with O_CREAT|O_EXCL. While the lock is held a thread
+    touches the file every _HEARTBEAT seconds; older lock files are stale"""
+    _HEARTBEAT = 2.0
+    _STALE = 30.0
 
+    def _tryAcquire(self):
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            try:
+                found = os.stat(self.path)
+                if time() - found.st_mtime > self._STALE:
+                    self._removeStale(found)
+            except OSError: # lock was already removed!
+                pass
+            return False
+        os.write(fd, str(os.getpid()))
+        os.close(fd)
+        import threading
+        self._stop = threading.Event()
+        self._heart = threading.Thread(target=self._heartbeat)
+        self._heart.daemon = True
+        self._heart.start()
+        return True
 
+    def _removeStale(self, found):
+        """removes the lock file if it is still the stale one found (its stat). Waiters
+        take turns at this by creating <lock>.break exclusively, and check the lock file
+        again before removing it, so a lock taken since it was found is left alone"""
+        breaker = self.path + ".break"
+        try:
+            fd = os.open(breaker, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            if time() - os.stat(breaker).st_mtime > self._STALE:
+                os.remove(breaker) # left by a waiter that died
+            return
+        os.close(fd)
+        try:
+            current = os.stat(self.path)
+            if os.path.samestat(current, found) and current.st_mtime == found.st_mtime:
+                logging.warn("!!! Removing stale lock: %s" % self.path)
+                os.remove(self.path)
+        finally:
+            os.remove(breaker)
+
+    def _heartbeat(self):
+        """keeps the lock file fresh until the lock is released"""
+        while True:
+            self._stop.wait(self._HEARTBEAT)
+            if self._stop.is_set():
+                return
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                pass
+
+    def release(self):
+        self._stop.set()
+        self._heart.join()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class PollLock(PysheetLock):
+    """The original lock: polls for the lock file, writes our pid to it and reads it
+    back after a random sleep"""
+    _STALE = 182.0
+
+    def acquire(self, timeout=180.0):
+        myPid = str(os.getpid())
+        counter = 1.0
+        start = time()
+        # see if there are leftover locks
+        if os.path.isfile(self.path):
+            from datetime import datetime
+            try:
+                lockTime = datetime.fromtimestamp(os.path.getmtime(self.path))
+                curTime = datetime.now()
+                if (curTime - lockTime).seconds > self._STALE:
+                    logging.warn("!!! Removing stale lock: %s" % self.path)
+                    os.remove(self.path)
+            except OSError: # lock was already removed!
+                pass
+        # wait for all other instances to finish writing
+        while counter < timeout:
+            if os.path.isfile(self.path):
+                counter += random()
+                sleep(counter)
+            else: # attempt a lock
+                open(self.path,'w').write(myPid)
+                sleep(random())
+                try:
+                    thisPid = open(self.path,'rU').read()
+                    if thisPid == myPid: # we've successfully acquired a lock!
+                        break
+                except IOError: # somebody removed the lock externally...
+                    continue
+        self.waited = time() - start
+        return counter < timeout
+
+    def release(self):
+        os.remove(self.path)
+
+_LOCKS = {'flock': FlockLock, 'lockf': LockfLock, 'excl': ExclLock, 'poll': PollLock}
+_DEFAULT_LOCK = 'poll' # the methods do not exclude each other, so keep the old one
+
+def getLock(method, path):
+    """returns a lock object of the given method ('flock', 'lockf', 'excl' or 'poll')"""
+    try:
+        return _LOCKS[method](path)
+    except KeyError:
+        raise PysheetException("Lock method '%s' is invalid! Choose one of: %s" % (
+            method, flatten(sorted(_LOCKS.keys()), ", ")))
+
+####################################
+############## SERVER ##############
+####################################
+
+def serve(argv):
+    """runs a SheetServer until it is stopped (SIGINT or SIGTERM)"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="%s serve" % os.path.basename(sys.argv[0]),
+    description="Keeps sheets in memory for the pysheet commands sent to it. Commands are "
+    "sent to the server instead of run whenever $%s names its socket" % _SOCKET_ENV)
+    parser.add_argument('--socket', metavar='FILE', default=os.environ.get(_SOCKET_ENV),
+            help='Unix socket to listen on. Default is $%s' % _SOCKET_ENV)
+    parser.add_argument('--flush', type=float, default=1.0, metavar='SEC',
+            help='Save the cells written to a sheet at most this many seconds later. '
+            'Default is 1')
+    parser.add_argument('--verbose', '-v', action='count', help='verbosity level')
+    args = parser.parse_args(argv)
+    if not args.socket:
+        parser.error("no --socket given and $%s is not set" % _SOCKET_ENV)
+    setupLogging(args.verbose)
+    server = SheetServer(args.socket, args.flush, args.verbose)
+    signal(SIGINT, lambda signum, frame: server.stop())
+    signal(SIGTERM, lambda signum, frame: server.stop())
+    server.serve()
+
+def forward(path, argv):
+    """sends a command line to the server listening on path and writes out what it
+    printed. Returns its exit code, or None if no server is listening"""
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error:
+        client.close()
+        return None
+    try:
+        client.sendall(marshal.dumps((list(argv), os.getcwd())))
+        client.shutdown(socket.SHUT_WR)
+        code, out, err = marshal.loads(_receive(client))
+    except (socket.error, EOFError, ValueError, TypeError) as e:
+        logging.critical("!!! Lost the server at %s: %s" % (path, e))
+        return 1
+    finally:
+        client.close()
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    return code
+
+def _receive(connection):
+    """reads a socket until the other end is done writing"""
+    chunks = []
+    for chunk in iter(lambda: connection.recv(65536), ''):
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+class SheetServer(object):
+    """Runs the command lines sent by forward, one at a time, on a Unix socket. The sheet
+    of a command that reads a single file is kept in memory for the next commands that
+    read it the same way, for as long as the file (and its journal) is unchanged. When
+    such a command saves the sheet back to the file, the save is held back for up to
+    flush seconds, so that the cells of many commands are saved at once"""
+    _TIMEOUT = 180.0 # how long a flush waits for the --lockFile of the commands (sec)
+
+    def __init__(self, path, flush=1.0, verbose=None):
+        self.path = os.path.abspath(path) # commands change the working directory
+        self.flush = flush
+        self.verbose = verbose
+        self._sheets = {}     # maps load parameters to their _Resident
+        self._current = None  # the _Resident of the command being run
+        self._running = False
+
+    def serve(self):
+        """answers commands until stop() is called"""
+        import socket, select
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(self.path):
+            try:
+                listener.connect(self.path)
+            except socket.error:
+                os.remove(self.path) # left over
+            else:
+                listener.close()
+                raise PysheetException("A server is already listening on %s" % self.path)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0177) # commands run as this user, so only this user may send them
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen(64)
+        logging.info("+++ Serving on %s" % self.path)
+        self._running = True
+        try:
+            while self._running:
+                try:
+                    ready = select.select([listener], [], [], self._nextFlush())[0]
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+                if ready:
+                    connection = listener.accept()[0]
+                    try:
+                        self._answer(connection)
+                    except socket.error as e:
+                        logging.warn("!!! Could not answer a command: %s" % e)
+                    finally:
+                        connection.close()
+                self.flushSheets(time() - self.flush)
+        finally:
+            listener.close()
+            os.remove(self.path)
+            self.flushSheets()
+            logging.info("+++ Stopped serving on %s" % self.path)
+
+    def stop(self):
+        """stops serve() once the command being run (if any) is done"""
+        self._running = False
+
+    def _nextFlush(self):
+        """returns the seconds until the next flush is due (at most one, to notice stop)"""
+        due = [r.dirty for r in self._sheets.itervalues() if r.dirty != None]
+        return min([1.0] + [max(0.0, d + self.flush - time()) for d in due])
+
+    def _answer(self, connection):
+        """runs the command line read from connection and sends back (exit code, stdout,
+        stderr)"""
+        try:
+            argv, cwd = marshal.loads(_receive(connection))
+        except (EOFError, ValueError, TypeError):
+            logging.warn("!!! Ignoring a malformed command")
+            return
+        code, out, err, resident = self._run(argv, cwd)
+        if resident != None and resident.changing:
+            if not code and resident.dirty != None:
+                resident.log.append((argv, cwd))
+            elif code and resident.log:
+                logging.warn("!!! Undoing a failed command on %s" % resident.path)
+                self._replay(resident) # half done, after changes that were not saved
+            elif code:
+                self._drop(resident) # half done
+        connection.sendall(marshal.dumps((code, out, err)))
+
+    def _run(self, argv, cwd, locked=False):
+        """runs a command line in cwd. Returns its exit code, what it printed to stdout and
+        stderr, and the _Resident of its sheet (None if it loaded its own). locked=True
+        runs it without its --lockFile, which the caller holds. It may be run while
+        another command is (see _flush), so what that one set up is put back"""
+        out, err = StringIO(), StringIO()
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = out, err
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        current, self._current = self._current, None
+        workdir = os.getcwd()
+        code = 0
+        try:
+            os.chdir(cwd)
+            parser = argParser()
+            if not argv:
+                parser.print_usage()
+                code = 1
+            else:
+                args = parser.parse_args(argv)
+                if locked:
+                    args.lockFile = None
+                run(args, self)
+        except SystemExit as e:
+            if e.code == None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                err.write("%s\n" % e.code)
+                code = 1
+        except PysheetException as e: # reading the sheet kept in memory
+            logging.critical(e.message)
+            code = 3
+        except Exception:
+            traceback.print_exc(file=err)
+            code = 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            root.handlers[:] = handlers
+            root.setLevel(level)
+            resident, self._current = self._current, current
+            os.chdir(workdir)
+        return code, out.getvalue(), err.getvalue(), resident
+
+    def _replay(self, resident, locked=False):
+        """reads a sheet again and runs again the commands whose changes to it were held
+        back. This undoes a command that failed half way through changing the sheet, and
+        keeps what was saved to its file since it was read. Returns the new _Resident
+        that holds the changes, or None if they could not be made again"""
+        self._sheets.pop(resident.key, None)
+        for argv, cwd in resident.log:
+            code, out, err, replayed = self._run(argv, cwd, locked)
+            if code or replayed == None:
+                logging.critical("!!! Could not run again: %s\n%s" % (flatten(argv), err))
+                if replayed != None:
+                    self._drop(replayed)
+                return
+            replayed.log.append((argv, cwd))
+        replayed.dirty = resident.dirty # still due when it was
+        replayed.save = resident.save # with its --lockFile
+        resident.dirty, resident.log = None, [] # moved over
+        return replayed
+
+    def _key(self, args, collapse):
+        """returns the load parameters of the sheet of a command, or None if the command
+        needs a sheet of its own"""
+        if (len(args.data) != 1 or args.data[0] in (None, 'stdin') or args.journal or
+                args.compact or args.outFname or not os.path.isfile(args.data[0])):
+            return None
+        if args.write and len(args.write) % 3 or args.remove and len(args.remove) % 2:
+            return None # fails before it is done
+        path = os.path.realpath(args.data[0])
+        changing = bool(args.remove or args.write or args.clean or args.consolidate or
+                args.removeMissingRows or args.removeMissingColumns)
+        if args.out and args.out != 'stdout' and os.path.realpath(args.out) == path:
+            if (args.columns != None or args.outNoHeader or args.outHeader or args.outTrans):
+                return None # the file won't read back as the sheet
+        elif changing:
+            return None # the changes are not saved to the file
+        return (path, args.delim[0], args.idCol[0], args.skipRow[0], args.skipCol[0],
+                args.noHeader[0], args.trans[0], args.rstack, args.cstack, collapse)
+
+    def sheet(self, args, collapse):
+        """returns the sheet kept in memory for a command, loading it if needed, or None
+        if the command is to load its own. In that case the sheets saved later than
+        asked are saved first, as the command may read them"""
+        key = self._key(args, collapse)
+        if key == None:
+            self.flushSheets()
+            return None
+        path = key[0]
+        for resident in self._sheets.values():
+            if resident.path == path and resident.key != key:
+                self._flush(resident) # saved in another way
+        resident = self._sheets.get(key)
+        if resident != None and resident.signature != _signature(path):
+            if resident.dirty != None:
+                self._flush(resident) # reads it again, with the changes held back
+            self._drop(resident)
+            resident = None
+        if resident == None:
+            resident = _Resident(key, loadSheet(args.data[0], collapse, delimiter=key[1],
+                idColumn=key[2], skip=key[3], skipColR=key[4], noHeader=key[5], trans=key[6],
+                rstack=key[7], cstack=key[8]))
+            self._sheets[key] = resident
+        resident.changing = bool(args.remove or args.write or args.clean or
+                args.consolidate or args.removeMissingRows or args.removeMissingColumns)
+        if resident.changing and (args.clean or args.consolidate or args.removeMissingRows or
+                args.removeMissingColumns):
+            self._flush(resident) # in case it fails half way
+        self._current = resident
+        return resident.sheet
+
+    def detach(self):
+        """leaves the sheet in memory out of the command being run. It is dropped unless it
+        holds changes to save"""
+        resident, self._current = self._current, None
+        if resident != None and resident.dirty == None:
+            self._drop(resident)
+
+    def saved(self, sheet, args):
+        """holds back the save of the sheet of the command being run, if it is kept in
+        memory and saved to its file. Returns False if it is for the command to save"""
+        resident = self._current
+        if (resident == None or resident.sheet is not sheet or args.out == 'stdout' or
+                os.path.realpath(args.out) != resident.path):
+            return False
+        if resident.dirty == None:
+            resident.dirty = time()
+        resident.save = (args.out, args.outDelim, args.snapshot, args.lockMethod,
+                args.lockFile if args.lockFile not in (None, True) else None)
+        return True
+
+    def flushSheets(self, before=None):
+        """saves the sheets whose save has been held back (since before, if given)"""
+        for resident in self._sheets.values():
+            if resident.dirty != None and (before == None or resident.dirty <= before):
+                self._flush(resident)
+
+    def _flush(self, resident):
+        """saves a sheet whose save has been held back"""
+        if resident.dirty == None:
+            return
+        out, delimiter, snapshot, method, lockFile = resident.save
+        locker = getLock(method, lockFile) if lockFile else None
+        if locker and not locker.acquire(self._TIMEOUT):
+            logging.critical("!!! Could not lock %s to save %s. Keeping it in memory" % (
+                lockFile, out))
+            return
+        try:
+            if resident.signature != _signature(resident.path):
+                logging.warn("!!! %s has changed since it was read. Reading it again" % out)
+                resident = self._replay(resident, locked=locker != None)
+                if resident == None:
+                    return
+            resident.sheet.save(out, delimiter, snapshot=snapshot)
+            resident.dirty = None
+            resident.log = []
+            resident.signature = _signature(resident.path)
+            logging.info("=== Saved as: %s" % out)
+        except (PysheetException, IOError, OSError) as e:
+            logging.critical("!!! Could not save %s: %s" % (out, e))
+            self._drop(resident)
+        finally:
+            if locker:
+                locker.release()
+
+    def _drop(self, resident):
+        """forgets a sheet, and any changes to it that were not saved"""
+        if resident.dirty != None:
+            logging.warn("!!! Dropping changes to %s that were not saved" % resident.path)
+        self._sheets.pop(resident.key, None)
+
+class _Resident(object):
+    """a sheet kept in memory by SheetServer"""
+    def __init__(self, key, sheet):
+        self.key = key
+        self.path = key[0]
+        self.sheet = sheet
+        self.signature = _signature(self.path)
+        self.dirty = None     # when its save was first held back
+        self.save = None      # (out, delimiter, snapshot, lockMethod, lockFile) to save it
+        self.changing = False # whether the command being run changes it
+        self.log = []         # (argv, cwd) of the commands whose changes are held back
+
+def _signature(path):
+    """returns what tells that a file or its journal has changed"""
+    ret = []
+    for f in (path, path + Pysheet._JOURNAL_EXT):
+        try:
+            stat = os.stat(f)
+            ret.append((stat.st_size, stat.st_mtime, stat.st_ino))
+        except OSError:
+            ret.append(None)
+    return tuple(ret)
 
 ####################################
 ######## CLASS STARTS HERE #########
@@ -481,18 +1498,42 @@ class Pysheet:
     _BLANK_VALUE     = ''            # default value used for empty cells
     _FLAG_VALUE      = '__flag__'    # flags a row for filtering
     _MAX_PRINT_WIDTH = 200           # the max width of a printout on the command line
+    _TABLE_WIDTH     = 80            # the width of the tables drawn by iterTable
+    _DEBUG           = False         # check internal indices for consistency (slow)
+    _JOURNAL_EXT     = '.journal'    # suffix of the sidecar log of journaled writes
+    _SNAPSHOT_EXT    = '.pysheet'    # suffix of the sidecar binary snapshot of a saved sheet
+    _SNAPSHOT_VERSION = 4            # bump when the snapshot layout changes
+    _INDEX_EXT       = '.pysheet-idx' # suffix of the sidecar index of IDs to byte offsets
+    _INDEX_VERSION   = 1             # bump when the index layout changes
+    _TRANSPOSE_CELLS = 10000000      # cells transposed in memory before spilling to disk
 
     # parameters
     filename  = None # the input/output path and name
     delimiter = None # the sheet delimiter
     _rows     = None # the dictionary that maps an ID to its row
     idColumn  = 0    # the column index that contains the IDs
+    storage   = 'rows' # 'rows' (a list per ID) or 'columnar' (a list per column)
     _objid    = None # an id to distinguish between objects
+    _headerMap = None # maps normalised header names to their column index
+    _journal  = None # (path, bytes) of the journal replayed into this sheet
+    typed     = False # vectorize numeric columns with cached NumPy arrays (see inferTypes)
+    _arrays   = None # maps column index to its (values, numeric, ints, type) arrays
+    _arrayKeys = None # the row keys that the arrays follow
+    indexed   = False # keep an index of the cells of each column looked up by value
+    _indexes  = None # maps column index to its ValueIndex (None if it can't be indexed)
+    _order    = None # maps row keys to their position, for indexed lookups in row order
+    _layout   = None # where the rows of the file last saved (or loaded from its snapshot) are
+    _natural  = None # (sort keys, row keys) of the rows in the order that save() writes them
 
     def __init__(self, filename=None, delimiter=None, iterable=None, idColumn=None, skip=0,
-            skipColR=0, skipColL=0, noHeader=False, rstack=False, cstack=False, trans=False):
+            skipColR=0, skipColL=0, noHeader=False, rstack=False, cstack=False, trans=False,
+            storage=None, typed=False, lazy=False, indexed=False):
         """initializes the object and reads in a sheet from a file or an iterable.
-        Optionally specify the column number that contains the unique IDs (starting from 0)"""
+        Optionally specify the column number that contains the unique IDs (starting from 0)
+        storage='columnar' keeps one list per column instead of one list per row
+        typed=True infers column types once loaded (see inferTypes)
+        lazy=True maps the file read-only and only parses the rows asked for (see LazyRows)
+        indexed=True looks up grab(), levels() and '=' queries in column indexes (see ValueIndex)"""
         # set IDs
         if not self._objid:
             self._objid = "_" + randomId() #str(id(self))
@@ -501,6 +1542,12 @@ class Pysheet:
             #self._FLAG_VALUE = self._FLAG_VALUE + self._objid
         else:
             logging.warn("!!! Re-initialising %s\n" % self._objid)
+        # set storage backend
+        if storage != None:
+            if storage not in _STORAGE_CHOICES:
+                raise PysheetException("Storage '%s' is invalid! Choose one of: %s" % (
+                    storage, flatten(_STORAGE_CHOICES, ", ")))
+            self.storage = storage
         # set filename
         self.filename = filename
         # set ID column
@@ -519,18 +1566,231 @@ class Pysheet:
         # and call the appropriate loader
         if filename and (os.path.exists(filename) or filename == 'stdin'):
             self.loadFile(self.filename, self.idColumn, skip, skipColR, skipColL,
-                    noHeader, rstack, cstack, trans)
+                    noHeader, rstack, cstack, trans, lazy)
+        elif filename and os.path.isfile(filename + self._JOURNAL_EXT):
+            self.clear() # only journaled cells so far
+            self.replayJournal(filename + self._JOURNAL_EXT)
         elif iterable:
             self.load(iterable, self.idColumn, skip, skipColR, skipColL, noHeader,
                     rstack, cstack, trans)
         else:
             self.clear()
+        self.indexed = indexed
+        if typed:
+            self.inferTypes()
 
+    @_phase('load')
     def loadFile(self, filename, idColumn=None, skip=0, skipColR=0, skipColL=0,
-            noHeader=False, rstack=False, cstack=False, trans=False):
+            noHeader=False, rstack=False, cstack=False, trans=False, lazy=False):
         """loads the sheet into a dictionary where the IDs in the first column are
         mapped to their rows. Optionally specify the column number that contains
-        the unique IDs (starting from 0)"""
+        the unique IDs (starting from 0). A fresh snapshot (see save) is read instead
+        of the file. lazy=True only reads the rows asked for, if it can (see LazyRows)"""
+        self.filename = filename
+        if idColumn != None:
+            try:
+                self.idColumn = int(idColumn)
+            except ValueError as e:
+                self.idColumn = 0
+        if lazy and not (noHeader or rstack or cstack or trans) and self._loadLazy(
+                filename, skip, skipColR):
+            return
+        if not self._loadSnapshot(filename, (self.idColumn, skip, skipColR, noHeader, rstack,
+                cstack, trans)):
+            reader = self._openReader(filename)
+            self.load(reader, self.idColumn, skip, skipColR, skipColL, noHeader, rstack, cstack,
+                    trans)
+        if filename != 'stdin' and os.path.isfile(filename + self._JOURNAL_EXT):
+            self.replayJournal(filename + self._JOURNAL_EXT)
+
+    def _openSnapshot(self, filename, params):
+        """returns (the snapshot of filename, open at its rows, and the stat of filename),
+        or None if there is no snapshot that matches the file and the load parameters"""
+        if not filename or filename == 'stdin':
+            return None
+        params = tuple(int(x or 0) for x in params)
+        try:
+            snapshot = open(filename + self._SNAPSHOT_EXT, 'rb')
+            stat = os.stat(filename)
+            version, found, saved, delimiter = marshal.load(snapshot)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        # the inode tells a file renamed over it within the resolution of mtimes
+        if (version != (self._SNAPSHOT_VERSION, marshal.version) or saved != params or
+                found != (stat.st_size, stat.st_mtime, stat.st_ino) or
+                self.delimiter not in (None, delimiter)):
+            snapshot.close()
+            return None
+        self.delimiter = delimiter
+        return snapshot, stat
+
+    def _loadSnapshot(self, filename, params):
+        """loads the snapshot of filename (see _openSnapshot). Returns True if it did"""
+        opened = self._openSnapshot(filename, params)
+        if opened is None:
+            return False
+        snapshot, stat = opened
+        collect = gc.isenabled()
+        gc.disable() # nothing to collect among millions of new cells
+        try:
+            idColumn, keys, headers, columns, spans, natural = marshal.load(snapshot)
+            self.clear()
+            self.idColumn = idColumn
+            self._rows[self._HEADERS_ID] = headers
+            cells = zip(*columns)
+            if self.storage == 'columnar':
+                self._rows.setColumns(keys, columns)
+            else:
+                self._rows.update(izip(keys, imap(list, cells)))
+            # the file is as save() wrote it, so the rows that don't change can be copied
+            self._layout = (os.path.realpath(filename), (stat.st_size, stat.st_mtime,
+                stat.st_ino), self.delimiter, list(headers), keys, spans,
+                [c if span is not None else None for c, span in izip(cells, spans)])
+            if natural is not None: # and the rows are already in order
+                self._natural = (natural, list(keys))
+        except (EOFError, ValueError, TypeError):
+            return False
+        finally:
+            snapshot.close()
+            if collect:
+                gc.enable()
+        logging.info("+++ %s: %d rows, %d columns (snapshot)\n" % (
+            os.path.basename(filename), self.height(), len(self)))
+        return True
+
+    def _saveSnapshot(self, output, layout):
+        """writes the snapshot of the sheet just saved in output, from its layout (see
+        _writeRows): the rows it is read back as with default parameters (and this ID
+        column), column by column, the spans of output of the rows and their sort keys, if
+        they are read back in order (see _sortedKeys). The rows are the cells as written,
+        so there is no snapshot if some of them would not be read back as they are"""
+        path, stat, delimiter, header, keys, spans, cells = layout
+        comment = self._COMMENT_CHAR
+        if (len(header) < max(self._MIN_LINE_LEN, 1) or str(header[0]).startswith(comment) or
+                any(not isinstance(h, str) or not h or h != h.strip() for h in header) or
+                any(line[0].startswith(comment) or clean(sanitize(line[self.idColumn])) != k
+                for k, line in izip(keys, cells))):
+            if os.path.isfile(output + self._SNAPSHOT_EXT):
+                os.remove(output + self._SNAPSHOT_EXT)
+            return
+        columns = [list(c) for c in izip(*cells)] if cells else [[] for h in header]
+        known = dict(izip(self._natural[1], self._natural[0])) if self._natural else {}
+        key = _naturalKey()
+        natural = [known[k] if k in known else key(k) for k in keys]
+        if any(imap(gt, natural, islice(natural, 1, None))):
+            natural = None
+        temp = "%s%s.%d" % (output, self._SNAPSHOT_EXT, os.getpid())
+        with open(temp, 'wb') as snapshot:
+            marshal.dump(((self._SNAPSHOT_VERSION, marshal.version), stat,
+                (self.idColumn, 0, 0, 0, 0, 0, 0), delimiter), snapshot)
+            marshal.dump((self.idColumn, keys, list(header), columns, spans, natural), snapshot)
+        os.rename(temp, output + self._SNAPSHOT_EXT)
+
+    def _loadLazy(self, filename, skip=0, skipColR=0):
+        """maps filename read-only as LazyRows, with the index of its IDs (building it
+        if it is missing or stale). Returns False if the file can't be read lazily"""
+        if (filename == 'stdin' or self.idColumn < 0 or
+                os.path.isfile(filename + self._JOURNAL_EXT) or not os.path.getsize(filename)):
+            return False
+        with open(filename, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        params = (self.idColumn, int(skip or 0), int(skipColR or 0))
+        index = self._openIndex(filename, params)
+        if index is None:
+            index = self._indexFile(filename, data, params)
+        if index is None:
+            return False
+        header, records, start = index
+        fmt, idColumn, headers, width, count = header
+        self.delimiter = fmt['delimiter']
+        self.idColumn = idColumn
+        self._rows = LazyRows(self._HEADERS_ID, headers, data, records, start, count, fmt,
+                width, idColumn, self._BLANK_VALUE)
+        self._headerMap = None
+        self._arrays = None
+        self._indexes = self._order = None
+        self._layout = self._natural = None
+        logging.info("+++ %s: %d rows, %d columns (lazy)\n" % (
+            os.path.basename(filename), count, len(headers)))
+        return True
+
+    def _openIndex(self, filename, params):
+        """returns (header, records, start) of the index of filename (see _indexFile), or
+        None if there is none that matches the file and the load parameters"""
+        try:
+            with open(filename + self._INDEX_EXT, 'rb') as f:
+                records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.stat(filename)
+            length = unpack('>Q', records[:8])[0]
+            version, size, mtime, saved, header = marshal.loads(records[8:8+length])
+        except (IOError, OSError, EOFError, ValueError, TypeError, mmap.error):
+            return None
+        if (version != (self._INDEX_VERSION, marshal.version) or size != stat.st_size or
+                mtime != stat.st_mtime or saved != params or
+                self.delimiter not in (None, header[0]['delimiter'])):
+            return None
+        return header, records, 8 + length
+
+    def _indexFile(self, filename, data, params):
+        """parses filename (mapped as data) for the byte offset of each ID's row and
+        writes them to the index, sorted by a hash of the ID so that rows can be found
+        by bisection. Lines are split with universalLines as in the eager read, and a
+        file with a lone \\r line end is not indexed. Returns what _openIndex would"""
+        if self.delimiter:
+            fmt = {'delimiter': self.delimiter}
+        else:
+            # sniff the same newline-translated text as _openReader, not the raw bytes
+            try:
+                with open(filename, "rUb") as f:
+                    dialect = csv.Sniffer().sniff(f.read(5000))
+            except csv.Error:
+                return None
+            fmt = dict((a, getattr(dialect, a)) for a in ['delimiter', 'quotechar',
+                'doublequote', 'skipinitialspace', 'quoting', 'escapechar'])
+        stat = os.stat(filename)
+        # parse as usual, keeping track of where each line starts
+        end = [0]
+        start = [0]
+        def lines():
+            data.seek(0)
+            for line in universalLines(data):
+                end[0] = data.tell()
+                yield line
+        reader = csv.reader(lines(), **fmt)
+        def rows():
+            while True:
+                start[0] = end[0]
+                yield reader.next()
+        sheet = Pysheet(delimiter=fmt['delimiter'])
+        sheet.clear()
+        status = {}
+        offsets = {}
+        try:
+            for key, row in sheet._parse(rows(), params[0], params[1], params[2],
+                    status=status):
+                offsets[key] = start[0]
+        except (csv.Error, ValueError, StopIteration):
+            return None
+        records = ''.join(sorted(md5(k).digest()[:8] + pack('>Q', offset)
+            for k, offset in offsets.iteritems()))
+        header = (fmt, sheet.idColumn, sheet._headers(), max(status['head_len'], 0),
+            len(offsets))
+        head = marshal.dumps(((self._INDEX_VERSION, marshal.version), stat.st_size,
+            stat.st_mtime, params, header))
+        temp = "%s%s.%d" % (filename, self._INDEX_EXT, os.getpid())
+        try:
+            with open(temp, 'wb') as f:
+                f.write(pack('>Q', len(head)))
+                f.write(head)
+                f.write(records)
+            os.rename(temp, filename + self._INDEX_EXT)
+        except (IOError, OSError) as e:
+            logging.warn("!!! Could not save the index of %s: %s" % (filename, e))
+        return header, records, 0
+
+    def _openReader(self, filename):
+        """returns a csv reader for filename (or 'stdin'), auto-detecting the delimiter
+        if it has not been set"""
         try:
             if filename == 'stdin':
                 csvfile = sys.stdin
@@ -551,14 +1811,9 @@ class Pysheet:
             raise PysheetException(e, filename)
         except IOError as e:
             raise PysheetException("Delimiter could not be auto-detected. Please supply -D", filename)
-        self.filename = filename
-        if idColumn != None:
-            try:
-                self.idColumn = int(idColumn)
-            except ValueError as e:
-                self.idColumn = 0
-        self.load(reader, self.idColumn, skip, skipColR, skipColL, noHeader, rstack, cstack, trans)
+        return reader
 
+    @_phase('load')
     def load(self, iterable, idColumn=None, skip=0, skipColR=0, skipColL=0,
             noHeader=False, rstack=False, cstack=False, trans=False):
         """creates a Pysheet object from an iterable.
@@ -575,6 +1830,50 @@ class Pysheet:
         except TypeError:
             raise PysheetException("%s is not iterable!" % iterable)
 
+        # clear the object
+        self.clear()
+
+        # start reading
+        status = {}
+        try:
+            for key, thisline in self._parse(iterator, idColumn, skip, skipColR, noHeader,
+                    rstack, cstack, trans, status):
+                self._rows[key] = thisline
+        except Exception as e:
+            printStackTrace()
+            raise PysheetException(e.message)
+
+        # print some status messages
+        row, head_len, line = status['row'], status['head_len'], status['line']
+        discarded = row - self.height()
+        if self.delimiter == '\t':
+            delim = 'tab'
+        else:
+            delim = self.delimiter
+        if head_len == -1 and line != None:
+            logging.info("+++ %s: empty (wrong delimiter [%s]  or too few columns)\n" % (
+                name, delim))
+        elif head_len == -1:
+            logging.info("+++ %s: empty\n" % name)
+        elif discarded > 0:
+            logging.info(("+++ %s: %d rows (%d discarded: duplicate ids), "
+            "%d columns [%s]\n") % (
+                name, self.height(), discarded, head_len, delim))
+        else:
+            if delim:
+                logging.info("+++ %s: %d rows, %d columns [%s]\n" % (
+                    name, self.height(), head_len, delim))
+            else:
+                logging.info("+++ %s: %d rows, %d columns\n" % (
+                    name, self.height(), head_len))
+
+    def _parse(self, iterator, idColumn=None, skip=0, skipColR=0, noHeader=False,
+            rstack=False, cstack=False, trans=False, status=None):
+        """parses the lines of iterator: sets the header row of the (cleared) object
+        and yields (key, row) for every data row, without storing it.
+        Parsing statistics are recorded in the status dictionary"""
+        if status is None:
+            status = {}
         # if rstack (rows) then we need auto headers internally
         if rstack:
             noHeader = True
@@ -601,129 +1900,130 @@ class Pysheet:
             discard = iterator.next()
             skip_counter += 1
 
-        # do transpose
+        # do transpose, skipping blanks and comments
         if trans:
-            cols = []
-            max_line_len = 0
-            try:
-                while True: # need to go through file to remove comments & make sure it's square
-                    line = iterator.next()
-                    line_len = len(line)
-                    # skip blanks and comments
-                    if line_len < max(self._MIN_LINE_LEN, 1) or str(
-                            line[0]).startswith(self._COMMENT_CHAR):
-                        continue
-                    if line_len < max_line_len:
-                        line = line + [self._BLANK_VALUE] * (max_line_len - line_len)
-                    elif line_len > max_line_len: # we need to adjust all previous lines..
-                        for i in range(len(cols)):
-                            cols[i] += [self._BLANK_VALUE] * (line_len - max_line_len)
-                        max_line_len = line_len
-                    cols.append(line)
-            except StopIteration:
-                pass
-            iterator = iter(zip(*cols))
-        
-        # clear the object
-        self.clear()
-
-        # start reading
-        try:
-            line = None
-            while True:
-                line = iterator.next()
-                line_len = len(line) - skipColR
-                # skip blank, short lines and comments
-                if line_len < max(self._MIN_LINE_LEN, 1) or str(line[0]).startswith(self._COMMENT_CHAR):
-                    continue
-                # header row
-                if row == 0:
-                    head_len = line_len
-                    if self.idColumn >= head_len:
-                        raise PysheetException("Invalid id column. Maximum is %d (starting from 0)" % (
-                            head_len-1))
-                    # load headers
-                    if noHeader:
-                        if rstack:
-                            self._rows[self._HEADERS_ID] = ["C%03d" % (col+1) for col in range(
-                                head_len)]
-                        else: # else add the object's unique id
-                            self._rows[self._HEADERS_ID] = ["C%03d%s" % (
-                                col+1, self._objid) for col in range(head_len)]
-                        row+=1 # so that this line gets added below
-                    else:
-                        # replace blank headers by V00i
-                        self._rows[self._HEADERS_ID] = [str(line[i]).strip() if str(
-                            line[i]).strip() else "V%03d" % i for i in range(len(line))]
-                    # did they request auto ids?
-                    if self.idColumn == -1:
-                        self._rows[self._HEADERS_ID].append(self._AUTO_ID_HEADER)
-                # rest or rows
-                if row > 0:
-                    thisline = []
-                    for value in line[:head_len]:
-                        thisline.append(value)
-                    if line_len > head_len: # we have a problem
-                        logging.warn(("!!! Line %d is longer than your header line (%d vs %d) and "
-                        "will be truncated!! Please make sure every column has a header\n") % (
-                            row+1, line_len, head_len))
-                        line_len = head_len
-                    elif line_len < head_len:
-                        while line_len < head_len:
-                            thisline.append(self._BLANK_VALUE)
-                            line_len += 1
-                    if self.idColumn == -1: # auto-generate ids!
-                        if cstack:
-                            thisline.append("R%05d" % row)
-                        else:
-                            thisline.append("R%05d%s" % (row, self._objid))
+            iterator = transposeLines((line for line in iterator if len(line) >= max(
+                self._MIN_LINE_LEN, 1) and not str(line[0]).startswith(self._COMMENT_CHAR)),
+                self._BLANK_VALUE, self._TRANSPOSE_CELLS)
+
+        line = None
+        status.update(row=row, head_len=head_len, line=line)
+        for line in iterator:
+            status['line'] = line
+            line_len = len(line) - skipColR
+            # skip blank, short lines and comments
+            if line_len < max(self._MIN_LINE_LEN, 1) or str(line[0]).startswith(self._COMMENT_CHAR):
+                continue
+            # header row
+            if row == 0:
+                head_len = line_len
+                status['head_len'] = head_len
+                if self.idColumn >= head_len:
+                    raise PysheetException("Invalid id column. Maximum is %d (starting from 0)" % (
+                        head_len-1))
+                # load headers
+                if noHeader:
+                    if rstack:
+                        self._rows[self._HEADERS_ID] = ["C%03d" % (col+1) for col in range(
+                            head_len)]
+                    else: # else add the object's unique id
+                        self._rows[self._HEADERS_ID] = ["C%03d%s" % (
+                            col+1, self._objid) for col in range(head_len)]
+                    row+=1 # so that this line gets added below
+                    status['row'] = row
+                else:
+                    # replace blank headers by V00i
+                    self._rows[self._HEADERS_ID] = [str(line[i]).strip() if str(
+                        line[i]).strip() else "V%03d" % i for i in range(len(line))]
+                # did they request auto ids?
+                if self.idColumn == -1:
+                    self._rows[self._HEADERS_ID].append(self._AUTO_ID_HEADER)
+                self._headerMap = None
+            # rest or rows
+            if row > 0:
+                thisline = []
+                for value in line[:head_len]:
+                    thisline.append(value)
+                if line_len > head_len: # we have a problem
+                    logging.warn(("!!! Line %d is longer than your header line (%d vs %d) and "
+                    "will be truncated!! Please make sure every column has a header\n") % (
+                        row+1, line_len, head_len))
+                    line_len = head_len
+                elif line_len < head_len:
+                    while line_len < head_len:
+                        thisline.append(self._BLANK_VALUE)
                         line_len += 1
-                    self._rows[clean(sanitize(thisline[self.idColumn]))] = thisline
-                # move to next row
-                row += 1
-
-        except StopIteration:
-            # print some status messages
-            discarded = row - self.height()
-            if self.delimiter == '\t':
-                delim = 'tab'
-            else:
-                delim = self.delimiter
-            if head_len == -1 and line != None:
-                logging.info("+++ %s: empty (wrong delimiter [%s]  or too few columns)\n" % (
-                    name, delim))
-            elif head_len == -1:
-                logging.info("+++ %s: empty\n" % name)
-            elif discarded > 0:
-                logging.info(("+++ %s: %d rows (%d discarded: duplicate ids), "
-                "%d columns [%s]\n") % (
-                    name, self.height(), discarded, head_len, delim))
+                if self.idColumn == -1: # auto-generate ids!
+                    if cstack:
+                        thisline.append("R%05d" % row)
+                    else:
+                        thisline.append("R%05d%s" % (row, self._objid))
+                    line_len += 1
+                yield clean(sanitize(thisline[self.idColumn])), thisline
+            # move to next row
+            row += 1
+            status['row'] = row
+
+        # set proper idColumn if auto
+        if self.idColumn == -1:
+            self.idColumn = head_len
+
+    def iterColumns(self, cols=None, blanks=False, exclude=True, filename=None, idColumn=None,
+            skip=0, skipColR=0, noHeader=False):
+        """reads a sheet from a file row by row and yields (key, row) for each of its rows,
+        where row is what getColumns(cols, blanks, exclude) would return for it, or None if
+        the row is filtered out. The header row comes first. Only the headers are kept in
+        memory, so rows come in file order and duplicate IDs are not collapsed.
+        The =UNIQUE operator needs all the rows and is not supported"""
+        if filename:
+            self.filename = filename
+        if not self.filename:
+            raise PysheetException("No file to stream!")
+        self.clear()
+        rows = self._parse(iter(self._openReader(self.filename)), idColumn, skip, skipColR,
+                noHeader)
+        first = next(rows, None) # parses the headers
+        query = self._extractSpec(cols)
+        if 'UNIQUE' in query.args:
+            raise PysheetException("=UNIQUE is not supported when streaming")
+        query.bind(None) # rows are not kept
+        excludeIndex = self._excludeIndex(exclude)
+        yield self._HEADERS_ID, query.header(self._rows[self._HEADERS_ID], self.idColumn)
+        if first is None:
+            return
+        for key, line in chain([first], rows):
+            if excludeIndex >= 0 and not self.isBlank(line[excludeIndex]):
+                yield key, None
+                continue
+            add = query.row(line)
+            if add is None or not (blanks or not self._hasBlanks(add)):
+                yield key, None
             else:
-                if delim:
-                    logging.info("+++ %s: %d rows, %d columns [%s]\n" % (
-                        name, self.height(), head_len, delim))
-                else:
-                    logging.info("+++ %s: %d rows, %d columns\n" % (
-                        name, self.height(), head_len))
-            # set proper idColumn if auto
-            if self.idColumn == -1:
-                self.idColumn = head_len
-        except Exception as e:
-            printStackTrace()
-            raise PysheetException(e.message)
+                yield key, [line[self.idColumn]] + add
 
     def clear(self):
         """clears the object"""
-        self._rows = OrderedDict()
+        if self.storage == 'columnar':
+            self._rows = ColumnarRows(self._HEADERS_ID, self._BLANK_VALUE)
+        else:
+            self._rows = OrderedDict()
         self._rows[self._HEADERS_ID] = ["ID"]
+        self._headerMap = None
+        self._arrays = None
+        self._indexes = self._order = None
+        self._layout = self._natural = None
 
     def __iter__(self):
-        """returns an iterator over the ID:row items in the csv"""
+        """returns an iterator over the ID:row items in the csv. The rows may be changed
+        in place, so the typed arrays, the indexes and the header map are dropped"""
+        self._arrays = None
+        self._indexes = self._order = None
+        self._headerMap = None
         return self._rows.iteritems()
 
     def __len__(self):
         """returns the length of the header row in the dictionary"""
-        return len(self.getHeaders())
+        return len(self._headers())
 
     def height(self):
         """returns the number of rows in the dictionary"""
@@ -731,6 +2031,11 @@ class Pysheet:
 
     def pop(self, x, default=None):
         """pops an item out of the dictionary"""
+        self._arrays = None
+        if self._indexes is not None:
+            self._reindexRow(clean(x), None)
+        if self._natural is not None and clean(x) in self._rows:
+            self._unsortKey(clean(x))
         return self._rows.pop(clean(x),default)
 
     def keys(self, headers=True, exclude=True, lockedRows=True):
@@ -738,9 +2043,10 @@ class Pysheet:
         headers=True adds columnheaders to the list returned
         exclude=True skips rows with a non-blank __exclude__ column
         lockedRows=True also returns rows whose ID starts with '__'"""
-        return [self[x][self.idColumn] for x in self._rows.keys() if (
+        excludeIndex = self._excludeIndex(exclude)
+        return [row[self.idColumn] for x, row in self._rows.iteritems() if (
             headers or x != self._HEADERS_ID) and (lockedRows or not x.startswith('__')) and (
-                not exclude or not self.excluded(x))]
+                excludeIndex < 0 or x == self._HEADERS_ID or self.isBlank(row[excludeIndex]))]
 
     def getIds(self):
         """returns all keys of the dictionary, except the header
@@ -748,14 +2054,24 @@ class Pysheet:
         return self.keys(headers=False, exclude=True, lockedRows=False)
 
     def __getitem__(self, key, default=None):
-        """gets the row of an ID from the dictionary"""
-        return self._rows.get(clean(sanitize(key)), default)
+        """gets the row of an ID from the dictionary. The row may be changed in place, so
+        the typed arrays and the indexes are dropped"""
+        row = self._rows.get(clean(sanitize(key)), default)
+        if row is not None:
+            self._arrays = None
+            self._indexes = self._order = None
+            self._headerMap = None
+        return row
     def getRow(self, key, default=None):
         """gets the row of an ID from the dictionary"""
         return self.__getitem__(key, default)
+    def _row(self, key, default=None):
+        """gets the row of an ID, for reading it (or changing it and updating the typed
+        arrays and indexes)"""
+        return self._rows.get(clean(sanitize(key)), default)
     def getCell(self, key, header):
         """gets a cell by key and header name"""
-        return self[key][self.headerIndex(header)]
+        return self._row(key)[self.headerIndex(header)]
 
     def __setitem__(self, key, row):
         """changes the row of an ID in the dictionary"""
@@ -763,6 +2079,14 @@ class Pysheet:
                 row[self.idColumn]) != clean(key):
             raise PysheetException("Key inconsistency: %s %s" % (
                 clean(row[self.idColumn]), clean(key))) # keep key consistency
+        if key == self._HEADERS_ID:
+            self._headerMap = None
+        else:
+            if self._indexes is not None:
+                self._reindexRow(clean(key), row)
+            if self._natural is not None and clean(key) not in self._rows:
+                self._sortKey(clean(key))
+        self._arrays = None
         self._rows[clean(key)] = row
     def setRow(self, key, row):
         """changes the row of an ID in the dictionary"""
@@ -771,43 +2095,181 @@ class Pysheet:
         """sets a cell value by key and header name
         updates dictionary keys as necessary"""
         hi = self.headerIndex(header)
-        row = self[key][:]
+        row = self._row(key)[:]
         row[hi] = value
         if hi == self.idColumn: # remove old key
-            oldkey = self[key][hi]
+            oldkey = self._row(key)[hi]
             del self[oldkey]
             key = value
         self[key] = row
 
     def __delitem__(self, key):
         """deletes a row from the dictionary"""
+        self._arrays = None
+        if self._indexes is not None:
+            self._reindexRow(clean(key), None)
+        if self._natural is not None and clean(key) in self._rows:
+            self._unsortKey(clean(key))
         del self._rows[clean(key)]
 
+    def _sortedKeys(self):
+        """returns the row keys, but the header's, in the order that save() writes them:
+        natsorted, ignoring case. The order is kept as rows are added and deleted, so
+        it is only sorted again after the rows are replaced wholesale"""
+        if self._natural is None:
+            keys = [k for k in self._rows.keys() if k != self._HEADERS_ID]
+            pairs = sorted(izip(imap(_naturalKey(), keys), keys), key=itemgetter(0))
+            self._natural = ([n for n, k in pairs], [k for n, k in pairs])
+        return self._natural[1]
+
+    def _sortKey(self, key):
+        """places a new (clean) key in the order of the rows, after any equal ones"""
+        natural, keys = self._natural
+        n = _naturalKey()(key)
+        i = bisect_right(natural, n)
+        natural.insert(i, n)
+        keys.insert(i, key)
+
+    def _unsortKey(self, key):
+        """takes a (clean) key out of the order of the rows"""
+        natural, keys = self._natural
+        n = _naturalKey()(key)
+        i = bisect_left(natural, n)
+        while i < len(keys) and natural[i] == n and keys[i] != key:
+            i += 1
+        if i < len(keys) and keys[i] == key:
+            del natural[i]
+            del keys[i]
+        else:
+            self._natural = None # out of step; sort again when asked
+
+    def _valueIndex(self, index):
+        """returns the ValueIndex of a column, building it on first use, or None if the
+        sheet is not indexed or the column holds cells that can't be indexed"""
+        if not self.indexed:
+            return None
+        if self._indexes is None:
+            self._indexes = {}
+        if index not in self._indexes:
+            values = ValueIndex()
+            try:
+                for k, row in self._rows.iteritems():
+                    if k != self._HEADERS_ID:
+                        values.add(row[index], k)
+            except (TypeError, IndexError):
+                values = None
+            self._indexes[index] = values
+        elif self._DEBUG and self._indexes[index] is not None:
+            self._checkIndex(index)
+        return self._indexes[index]
+
+    def _checkIndex(self, index):
+        """raises an exception if the index of a column is out of sync with its cells"""
+        cached = self._indexes.pop(index)
+        fresh = self._valueIndex(index)
+        self._indexes[index] = cached # with its views
+        if fresh is None or cached.keys != fresh.keys:
+            raise PysheetException("Value index out of sync: %s" % self._headers()[index])
+
+    def _rowOrder(self):
+        """returns the map of row keys to their position in the sheet"""
+        if self._order is None:
+            self._order = dict((k, i) for i, k in enumerate(self._rows.keys()))
+            self._orderEnd = len(self._order)
+        return self._order
+
+    def _reindexRow(self, key, row):
+        """updates the column indexes for row becoming the row of (clean) key, or for the
+        row of key being deleted if row is None"""
+        if key == self._HEADERS_ID:
+            return
+        old = self._rows.get(key)
+        if old is not None and (old is row or isinstance(old, ColumnarRow) and old == row):
+            self._indexes = self._order = None # changed in place, can't tell what changed
+            return
+        for c, values in self._indexes.items():
+            if values is None:
+                continue
+            try:
+                if old is not None:
+                    values.remove(old[c], key)
+                if row is not None:
+                    values.add(row[c], key)
+            except (TypeError, IndexError):
+                self._indexes[c] = None
+        if self._order is not None:
+            if row is None:
+                self._order.pop(key, None)
+            elif old is None:
+                self._order[key] = self._orderEnd
+                self._orderEnd += 1
+
+    def _reindexCell(self, key, index, cell):
+        """updates the index of a column for cell becoming the cell of (clean) key"""
+        values = self._indexes.get(index)
+        if values is not None:
+            try:
+                values.remove(self._rows[key][index], key)
+                values.add(cell, key)
+            except TypeError:
+                self._indexes[index] = None
+
     def headerIndex(self, header):
         """returns the index of a header in the dictionary"""
         # if a column number, return the index
         if header != None:
             header = clean(str(header)).replace('__','')
-            headers_lower = [l.lower().replace('__','') for l in self.getHeaders()]
-            if header in headers_lower:
-                return headers_lower.index(header)
+            hi = self._headerLookup().get(header, -1)
+            if hi >= 0:
+                return hi
             elif str(header).isdigit():
                 header = int(header)
                 if header >= 0 and header < len(self):
                     return header
         return -1 # all other cases return -1 to indicate error
 
+    def _headerLookup(self):
+        """returns the map of normalised header names to column indices, rebuilding it
+        if the headers have changed (it is dropped whenever they are changed or handed
+        out, see getHeaders)"""
+        if self._headerMap is None:
+            self._indexHeaders()
+        elif self._DEBUG:
+            self._checkHeaders()
+        return self._headerMap
+
+    def _indexHeaders(self):
+        """rebuilds the map of normalised header names to column indices"""
+        headers = self._rows[self._HEADERS_ID]
+        self._headerMap = {}
+        for i in range(len(headers)-1, -1, -1): # so that the first occurrence wins
+            self._headerMap[headers[i].lower().replace('__','')] = i
+
+    def _checkHeaders(self):
+        """raises an exception if the header map is out of sync with the headers"""
+        headerMap = self._headerMap
+        self._indexHeaders()
+        if headerMap != self._headerMap:
+            raise PysheetException("Header index out of sync: %s" % flatten(self._headers(), ", "))
+
     def getHeaders(self, idCol=True, index=False):
         """returns the headers of the columns in the dictionary
-        (indices instead if index=True)"""
+        (indices instead if index=True). The headers may be changed in place, so the
+        header map is dropped"""
         if index:
             ret = range(len(self))
         else:
-            ret = self[self._HEADERS_ID]
+            ret = self._headers()
+            self._headerMap = None
         if not idCol:
             del ret[self.idColumn]
         return ret
 
+    def _headers(self):
+        """gets the header row, for reading it (or changing it and dropping the header
+        map)"""
+        return self._row(self._HEADERS_ID)
+
     def containsColumn(self, header):
         """True if header exists in the csv header list"""
         return self.headerIndex(header) > -1
@@ -818,7 +2280,7 @@ class Pysheet:
         'add' (performs plus operation if values are numeric)"""
 
         cleankey = clean(sanitize(key))
-        if self[cleankey] == None:
+        if self._row(cleankey) == None:
             self[cleankey] = [key.strip()] + [self._BLANK_VALUE] * (len(self)-1)
         if header != None:
             header = header.strip()
@@ -831,46 +2293,134 @@ class Pysheet:
             if value == None:
                 value = self._BLANK_VALUE
             # add the value using the correct mode
-            self[cleankey][self.headerIndex(header)] = self.mergedValue(
-                    self[cleankey][self.headerIndex(header)], value, mode=mode)
+            self._arrays = None
+            hi = self.headerIndex(header)
+            value = self.mergedValue(self._row(cleankey)[hi], value, mode=mode)
+            if self._indexes is not None:
+                self._reindexCell(cleankey, hi, value)
+            self._row(cleankey)[hi] = value
+
+    def writeCell(self, key, header=None, value=None, mode='overwrite'):
+        """adds a cell like addCell, where key and header may be 'NONE' (case insensitive):
+        a NONE key adds a column initialised with value, a NONE header adds a blank row.
+        Returns the number of cells written"""
+        if key.lower() == "none":
+            self.insertColumn(header, init=value)
+            return self.height() - 1
+        if header == None or header.lower() == "none":
+            self.addCell(key, mode=mode)
+        else:
+            self.addCell(key, header, value, mode=mode)
+        return 1
+
+    @_phase('journal')
+    def replayJournal(self, path):
+        """folds the cells of a journal (see appendJournal) into the sheet, in the order
+        they were written. Returns the number of cells replayed"""
+        journal = open(path, "rb")
+        try:
+            _lockFile(journal.fileno(), shared=True)
+            data = journal.read()
+        finally:
+            journal.close()
+        complete = data.rfind("\n") + 1 # a writer may still be appending the last line
+        collapse = self._COLLAPSE
+        ncells = 0
+        try:
+            for rec in csv.reader(data[:complete].splitlines(True)):
+                if len(rec) != 5:
+                    logging.warn("!!! Skipping malformed journal entry in %s: %s" % (path, rec))
+                    continue
+                key, header, value, mode, self._COLLAPSE = rec
+                self.writeCell(key, header, value, mode=mode)
+                if key.lower() != "none" and header.lower() != "none":
+                    # as if each writer had saved the sheet
+                    cleankey = clean(sanitize(key))
+                    index = self.headerIndex(header.strip())
+                    value = cellString(self._row(cleankey)[index])
+                    if self._indexes is not None:
+                        self._reindexCell(cleankey, index, value)
+                    self._row(cleankey)[index] = value
+                ncells += 1
+        except csv.Error as e:
+            raise PysheetException(e, path)
+        finally:
+            self._COLLAPSE = collapse
+        self._journal = (path, complete)
+        logging.debug(">>> Replayed %d journaled cell%s from %s" % (
+            ncells, '' if ncells==1 else 's', path))
+        return ncells
+
+    def _dropJournal(self):
+        """removes the replayed part of the journal, keeping anything appended since"""
+        path, size = self._journal
+        self._journal = None
+        try:
+            journal = open(path, "rb")
+            try:
+                _lockFile(journal.fileno()) # appends wait, then go to the new journal
+                journal.seek(size)
+                tail = journal.read()
+                if not tail:
+                    os.remove(path)
+                else:
+                    tmp = "%s.%s" % (path, os.getpid())
+                    with open(tmp, "wb") as f:
+                        f.write(tail)
+                    os.rename(tmp, path)
+            finally:
+                journal.close()
+        except (IOError, OSError) as e:
+            logging.warn("!!! Could not drop journal %s: %s" % (path, e))
 
     def removeCell(self, key, header=None):
         """deletes a cell or a row from the dictionary"""
         ret = None
         cleankey = clean(sanitize(key))
-        if self[cleankey] != None:
+        if self._row(cleankey) != None:
             if header != None:
                 header = header.strip()
                 if self.headerIndex(header) != -1: # header exists
-                    ret = self[cleankey][self.headerIndex(header)]
-                    self[cleankey][self.headerIndex(header)] = self._BLANK_VALUE
+                    self._arrays = None
+                    hi = self.headerIndex(header)
+                    ret = self._row(cleankey)[hi]
+                    if self._indexes is not None:
+                        self._reindexCell(cleankey, hi, self._BLANK_VALUE)
+                    self._row(cleankey)[hi] = self._BLANK_VALUE
             else:
-                ret = self[cleankey]
-                del self[cleankey]
+                ret = self.pop(cleankey)
         return ret
 
     def insertColumn(self, header, index=None, init=None):
         """inserts a blank column in the dictionary at index (default=1)
         initializes with self._BLANK_VALUE"""
         header = str(header)
-        if not header.lower().replace('__','') in [
-                l.lower().replace('__','') for l in self.getHeaders()]:
+        if not header.lower().replace('__','') in self._headerLookup():
             if index == None:
                 index = 1
-                while index < len(self) and self.getHeaders()[index].startswith('__'):
+                while index < len(self) and self._headers()[index].startswith('__'):
                     index+=1
             else:
                 assert type(index) is IntType, "index is not an integer: %r" % index
                 assert index >= 0 and index <= len(
                         self), "index is not in a valid range [%d-%d]: %d" % (0, len(self), index)
 
-            for k in self._rows.keys():
-                if k == self._HEADERS_ID:
-                    if not header.strip().startswith('__'):
-                        header = '__'+header.strip()
-                    self[k].insert(index,header)
-                else:
-                    self[k].insert(index,self._BLANK_VALUE if not init else init)
+            if self.storage == 'columnar':
+                if not header.strip().startswith('__'):
+                    header = '__'+header.strip()
+                self.getHeaders().insert(index,header)
+                self._rows.insertColumn(index,self._BLANK_VALUE if not init else init)
+            else:
+                for k in self._rows.keys():
+                    if k == self._HEADERS_ID:
+                        if not header.strip().startswith('__'):
+                            header = '__'+header.strip()
+                        self._row(k).insert(index,header)
+                    else:
+                        self._row(k).insert(index,self._BLANK_VALUE if not init else init)
+            self._headerMap = None
+            self._arrays = None
+            self._indexes = self._order = None
             # did we insert before the idColumn?
             if index <= self.idColumn:
                 self.idColumn += 1
@@ -880,29 +2430,50 @@ class Pysheet:
         correspond to 'level' (header + level) from the dictionary. level='ALL' is valid"""
         if key != None:
             cleankey = clean(key)
-            if self[cleankey] == None:
+            if self._row(cleankey) == None:
                 return None
             if header != None:
                 header = header.strip()
                 if self.headerIndex(header) == -1:
                     return None
-                return self[cleankey][self.headerIndex(header)] # return the item
+                return self._row(cleankey)[self.headerIndex(header)] # return the item
             return self[cleankey] # return the whole row
         elif level != None and header != None:
             if self.headerIndex(header) == -1:
                 return None
             level = tryNumber(str(level).lower())
-            thiscol = self.produceColumn(header)
+            query = self.compileColumns(header)
+            ret = self._grabIndex(query, level)
+            if ret != None:
+                return ret
+            thiscol = self.produceColumn(query)
             ret = []
             for i in range(len(thiscol[0])):
                 if (level == 'all' and not self.isBlank(str(thiscol[1][i])) and not str(
-                    thiscol[0][i]).startswith('__')) or tryNumber(
+                    thiscol[0][i]).startswith('__')) or query.number(
                             str(thiscol[1][i]).lower()) == level:
                     ret.append(thiscol[0][i])
             return ret
         else:
             raise PysheetException("grab either requires a key, or a header AND a level!")
 
+    def _grabIndex(self, query, level):
+        """returns grab(header=query, level=level) from the index of a plain column, or None"""
+        if len(query.columns) != 1 or query.tests[0] != None or level == 'all' or (
+                self.height() < 2):
+            return None
+        values = self._valueIndex(query.columns[0])
+        if values is None:
+            return None
+        keys = values.find(level, 'level', lambda x: tryNumber(
+            '' if self.isBlank(x) else str(x).lower()))
+        if keys is None:
+            return None
+        rows = self._rows
+        excludeIndex = self._excludeIndex()
+        return [rows[k][self.idColumn] for k in sorted(keys, key=self._rowOrder().get)
+                if excludeIndex < 0 or self.isBlank(rows[k][excludeIndex])]
+
     def __add__(self, other, mergeHeaders=False):
         """merges two Pysheets together"""
         # see if it is a pysheet
@@ -915,44 +2486,102 @@ class Pysheet:
             except Exception:
                 printStackTrace()
                 raise PysheetException("I don't know how to add this. Please use a Pysheet")
-        # remember old length
-        oldlen = len(self)
-        # merge the existing IDs
-        merged = False
-        for i in self._rows.keys():
-            # check for headers row
-            if i == self._HEADERS_ID:
-                item = other.pop(other._HEADERS_ID)
-            else: # pops item i or None if not found
-                item = other.pop(i,None)
-            if item != None and isList(item) and len(item) > 0:
-                self[i] += item
-                merged = True # merged at least one thing
-        # loop through the rest of the IDs, blank-padding to the left
-        for i in other._rows.keys():
-            self[i] = [self._BLANK_VALUE] * oldlen + other[i]
-            merged = True
-        # make it sqare again
-        self.expand()
-        # make ID column header names the same so they will be merged in the next step!
-        if merged:
-            self.getHeaders()[oldlen + other.idColumn] = self.getHeaders()[self.idColumn]
+        self.join(other, how='outer')
         # merge common headers?
         if mergeHeaders:
             self.contract()
         return self
 
+    @_phase('merge')
+    def join(self, other, how='outer'):
+        """appends the columns of another Pysheet, matching rows by ID. how can be:
+        'outer' (keeps all rows, like +), 'inner' (only rows in both), 'left' (rows of
+        this sheet) or 'right' (rows of other, in its order). other is left untouched"""
+        if how not in _JOIN_CHOICES:
+            raise PysheetException("Unknown join: %s. Choose from %s" % (
+                how, flatten(_JOIN_CHOICES, ", ")))
+        left, right = self._rows, other._rows
+        headersKey = self._HEADERS_ID
+        oldlen = len(self)
+        otherlen = len(other._headers() or [])
+        # rows of the result, in order
+        if how == 'right':
+            keys = right.keys()
+        elif how == 'outer':
+            keys = left.keys() + [k for k in right.keys() if k not in left]
+        elif how == 'inner':
+            keys = [k for k in left.keys() if k in right]
+        else:
+            keys = left.keys()
+        keys = [k for k in keys if k != headersKey]
+        headers = self._headers() + list(other._headers() or [])
+        blank = self._BLANK_VALUE
+        if self.storage == 'columnar':
+            # gather the cells column by column, blank for rows missing on either side
+            columns = self._selectColumns(keys, oldlen) + other._selectColumns(
+                    keys, otherlen, blank)
+            self._rows = ColumnarRows(headersKey, blank)
+            self._rows[headersKey] = headers
+            self._rows.setColumns(keys, columns)
+        else:
+            if other.storage == 'columnar':
+                right = dict(izip(keys, izip(*other._selectColumns(keys, otherlen, blank))))
+            # one pre-sized row per key, filled from both sides
+            blanks = [blank] * (oldlen + otherlen)
+            rows = OrderedDict([(headersKey, headers)])
+            for k in keys:
+                row = blanks[:]
+                mine = left.get(k)
+                if mine is not None:
+                    row[:len(mine)] = mine
+                theirs = right.get(k)
+                if theirs is not None:
+                    row[oldlen:oldlen+len(theirs)] = theirs
+                rows[k] = row
+            self._rows = rows
+        # make ID column header names the same so they will be merged by contract()
+        if otherlen:
+            self.getHeaders()[oldlen + other.idColumn] = self.getHeaders()[self.idColumn]
+        self._headerMap = None
+        self._arrays = None
+        self._indexes = self._order = None
+        self._natural = None
+        return self
+
+    def _selectColumns(self, keys, width, blank=None):
+        """returns width lists with the cells of the rows of keys, column by column.
+        Missing rows and cells are blank"""
+        if blank is None:
+            blank = self._BLANK_VALUE
+        if self.storage == 'columnar':
+            return self._rows.select(keys, width, blank)
+        rows = [self._rows.get(k) for k in keys]
+        return [[row[c] if row is not None and c < len(row) else blank for row in rows]
+                for c in range(width)]
+
     def excluded(self, key):
         """returns True if an item's exclusion header is non-blank"""
-        if key == self._HEADERS_ID:
+        excludeIndex = self._excludeIndex()
+        if excludeIndex < 0 or clean(sanitize(key)) == self._HEADERS_ID:
             return False
-        return not self.isBlank(self.grab(key=key, header=self._EXCLUDE_HEADER))
+        row = self._row(key)
+        return row != None and not self.isBlank(row[excludeIndex])
+
+    def _excludeIndex(self, exclude=True):
+        """returns the index of the __exclude__ column, or -1 if there is none
+        (or exclude=False) so that callers can skip the check altogether"""
+        if not exclude:
+            return -1
+        return self.headerIndex(self._EXCLUDE_HEADER)
 
-    def parseColumns(self, cols):
+    def parseColumns(self, cols, unique=None):
         """parses the input column specification. For example expands ["5","1-3","Age>13"]
         to [[5,1,2,3,9],['','','','','>'],['','','','',13]]
-        Returns list of corresponding [[header index, ...], [operator, ...], [argument, ...]]"""
+        Returns list of corresponding [[header index, ...], [operator, ...], [argument, ...]]
+        If a list is given as unique, it is filled with the =UNIQUE group of each column:
+        '' or the position of the group's first column. 'Chr,Band=UNIQUE' makes one group"""
         ret = [[],[],[]]
+        groups = {} # position -> group of multi-column =UNIQUE
         if cols:
             if not isList(cols):
                 cols=[cols]
@@ -1022,153 +2651,221 @@ class Pysheet:
                                     ret[1].append(op)
                                     ret[2].append(tryNumber(arg))
                                     added = True
+                                elif op == '=' and arg == 'UNIQUE' and ',' in col:
+                                    # unique combinations of several columns
+                                    his = [self.headerIndex(x) for x in col.split(',')]
+                                    if min(his) >= 0:
+                                        first = len(ret[0])
+                                        for hi in his:
+                                            groups[len(ret[0])] = first
+                                            ret[0].append(hi)
+                                            ret[1].append(op)
+                                            ret[2].append(arg)
+                                        added = True
                 if not added:
                     raise PysheetException("Column '%s' cannot be parsed!" % c)
+        if unique != None:
+            unique.extend(groups.get(j, j) if ret[2][j] == 'UNIQUE' else ''
+                    for j in range(len(ret[0])))
         return ret
 
     def produceColumn(self, col=0, blanks=True, exclude=True):
         """extracts a column and corresponding IDs from the dictionary (no column headers)
         returns a 2D list where [0] is a list of IDs and [1] is the requested column
         Input a list of columns to make a hybrid column eg. col=[3,6,5]
+        (or a ColumnQuery from compileColumns)
         blanks=False will remove rows that contain *any* blank column entries whatsoever
         exclude=True will skip rows that have a value in the __exclude__ column
         Default is return a list of a list of IDs"""
         # first expand the column specification
-        cols = self.parseColumns(col)
+        query = self.compileColumns(col)
 
         # check if we have columns to join
-        if not cols[0]:
+        if not query.columns:
             return [self.keys(headers=False)] # return all IDs
 
         # case we have some columns to join
         ret = []
+        query.bind(self)
+        excludeIndex = self._excludeIndex(exclude)
         for i in self._rows.keys():
-            hybrid = []
-            if i == self._HEADERS_ID or (exclude and self.excluded(i)):
+            if i == self._HEADERS_ID or (excludeIndex >= 0 and not self.isBlank(
+                    self._rows[i][excludeIndex])):
                 continue
-            for j in range(len(cols[0])): # add in the columns that we want
-                if not cols[1][j] or not cols[2][j] or (
-                        cols[1][j] == '<' and (tryNumber(self[i][cols[0][j]]) < cols[2][j])) or (
-                        cols[1][j] == '>' and (tryNumber(self[i][cols[0][j]]) > cols[2][j])) or (
-                        cols[1][j] == '=' and (tryNumber(self[i][cols[0][j]]) == cols[2][j])) or (
-                        cols[1][j] == '~' and (str(cols[2][j]) in str(self[i][cols[0][j]]))) or (
-                        cols[1][j] == '!' and (tryNumber(self[i][cols[0][j]]) != cols[2][j])):
-                    hybrid.append(self[i][cols[0][j]])
-                else:
-                    hybrid.append(self._BLANK_VALUE)
+            hybrid = query.hybrid(self._row(i), self._BLANK_VALUE, i) # the columns that we want
             if not blanks and self._BLANK_VALUE in hybrid:
                 continue
-            ret.append([self[i][self.idColumn], "_".join([str(
+            ret.append([self._row(i)[self.idColumn], "_".join([str(
                 x) for x in hybrid if not self.isBlank(x)])]) # append the ID and a join of the requested columns
         return transpose(ret) # transpose so that [0] are IDs and [1] is group assignment
 
+    @_phase('query')
     def getColumns(self, cols=None, blanks=False, exclude=True):
         """extracts columns and corresponding IDs from the dictionary (with column headers)
         returns requested columns, row-by-row. Supports operators like cols='age>20'.
-        To get multiple columns e.g. set cols=[3,6,5]
+        To get multiple columns e.g. set cols=[3,6,5] (or a ColumnQuery from compileColumns)
         Valid column operators: > (greater than), < (less than), = (equals), ! (does not equal),
-        ~ (contains), =UNIQUE (will only keep one of each duplicate in the column)
+        ~ (contains), =UNIQUE (will only keep one of each duplicate in the column,
+        or of each combination for e.g. 'Chr,Band=UNIQUE')
         blanks=False will remove rows that contain *any* blank column entries whatsoever
         exclude=True will skip rows that have a value in the __exclude__ column
         Default is return all columns"""
         # first expand the column specification
-        extrct = self.parseColumns(cols)
-
-        # check if we have columns to return
-        if not extrct[0]: # return all columns
-            all_header_ind = range(self.idColumn) + range(self.idColumn+1, len(self))
-            extrct = [all_header_ind, [self._BLANK_VALUE]*len(all_header_ind), [
-                self._BLANK_VALUE]*len(all_header_ind)]
+        query = self._extractSpec(cols)
 
         # case we have some columns to return
         ret = []
+        query.bind(self)
+        candidates = query.candidates()
+        seen = query.uniqueSets()
+        excludeIndex = self._excludeIndex(exclude)
         for i in self._rows.keys():
-            if exclude and self.excluded(i):
-                continue
-            add = [] # initialize the row to be appended
-            for j in range(len(extrct[0])):
-                # add in the columns that we want (loops through column idices)
-                if i == self._HEADERS_ID: # add operator to the name of the header!
-                    if not extrct[2][j]:
-                        add.append(self[i][extrct[0][j]])
-                    else:
-                        if extrct[1][j] == '<':
-                            add.append(self[i][extrct[0][j]] + '<' + str(extrct[2][j]))
-                        if extrct[1][j] == '>':
-                            add.append(self[i][extrct[0][j]] + '>' + str(extrct[2][j]))
-                        if extrct[1][j] == '=':
-                            add.append(self[i][extrct[0][j]] + '=' + str(extrct[2][j]))
-                        if extrct[1][j] == '!':
-                            add.append(self[i][extrct[0][j]] + '!' + str(extrct[2][j]))
-                        if extrct[1][j] == '~':
-                            add.append(self[i][extrct[0][j]] + '~' + str(extrct[2][j]))
-                        if extrct[1][j] == '+':
-                            add.append(self[i][extrct[0][j]] + '+' + str(extrct[2][j]))
-                else: # if we have an operator and argument, check if we satify them
-                    if not extrct[1][j] or not extrct[2][j] or (
-                            extrct[1][j] == '<' and (tryNumber(self[i][extrct[0][j]]) < extrct[2][j])) or (
-                            extrct[1][j] == '>' and (tryNumber(self[i][extrct[0][j]]) > extrct[2][j])) or (
-                            extrct[1][j] == '=' and (tryNumber(self[i][extrct[0][j]]) == extrct[2][j])) or (
-                            extrct[1][j] == '~' and (str(extrct[2][j]) in str(self[i][extrct[0][j]]))) or (
-                            extrct[1][j] == '!' and (tryNumber(self[i][extrct[0][j]]) != extrct[2][j])) or (
-                            extrct[2][j] == 'UNIQUE' and (not ret or (
-                                ret and self[i][extrct[0][j]] not in transpose(ret)[j+1]))):
-                        add.append(self[i][extrct[0][j]]) # add this value to the new row
-                    elif extrct[1][j] == '+':
-                        try:
-                            add.append(tryNumber(self[i][extrct[0][j]]) + tryNumber(extrct[2][j])) # perform addition
-                        except TypeError:
-                            add.append(str(self[i][extrct[0][j]])+str(extrct[2][j]))
-                    else:
-                        add.append(self._FLAG_VALUE) # add blank to the new row
             if i == self._HEADERS_ID: # prepend
-                ret = [[self[i][self.idColumn]] + [x.replace('__','') for x in add]] + ret
-            elif self._FLAG_VALUE in add:
+                ret = [query.header(self._row(i), self.idColumn)] + ret
+                query.markUnique(seen, ret[0][1:])
+                continue
+            if candidates != None and i not in candidates:
+                continue
+            if excludeIndex >= 0 and not self.isBlank(self._rows[i][excludeIndex]):
+                continue
+            add = query.row(self._row(i), seen, i)
+            if add is None:
                 pass # skip this row
             # if all values there, append to return
-            elif blanks or not (any(j in add for j in [None, [], '', self._BLANK_VALUE])):
-                ret.append([self[i][self.idColumn]] + add)
+            elif blanks or not self._hasBlanks(add):
+                ret.append([self._row(i)[self.idColumn]] + add)
+                query.markUnique(seen, add)
         return ret
 
+    def compileColumns(self, cols):
+        """parses a column specification (see parseColumns) into a ColumnQuery, which
+        getColumns, produceColumn and iterColumns take in place of the specification"""
+        if isinstance(cols, ColumnQuery):
+            return cols
+        unique = []
+        extrct = self.parseColumns(cols, unique)
+        return ColumnQuery(extrct[0], extrct[1], extrct[2], unique)
+
+    def _extractSpec(self, cols):
+        """compiles a column specification for getColumns (default is all columns)"""
+        query = self.compileColumns(cols)
+
+        # check if we have columns to return
+        if not query.columns: # return all columns
+            all_header_ind = range(self.idColumn) + range(self.idColumn+1, len(self))
+            query = ColumnQuery(all_header_ind, [self._BLANK_VALUE]*len(all_header_ind), [
+                self._BLANK_VALUE]*len(all_header_ind))
+        return query
+
+    def _hasBlanks(self, cells):
+        """returns True if any of the cells is blank"""
+        return any(j in cells for j in [None, [], '', self._BLANK_VALUE])
+
     def expand(self):
         """blank-pads to make all rows as long as the headers"""
         headlen = len(self)
+        if self.storage == 'columnar':
+            self._rows.expand()
+            return
         for i in self._rows.keys():
-            thislen = len(self[i])
+            thislen = len(self._row(i))
             assert thislen <= headlen, ("Error in row %s. Greater than length "
-            "of headers row (%d): %d") % (i, headlen, len(self[i]))
-            if thislen < headlen:
-                self[i] += [self._BLANK_VALUE] * (headlen - thislen)
+            "of headers row (%d): %d") % (i, headlen, thislen)
+            if thislen < headlen: # in place: the cells of the other columns stay
+                self._rows[i] += [self._BLANK_VALUE] * (headlen - thislen)
 
-    def contract(self, mode='overwrite'):
+    @_phase('contract')
+    def contract(self, mode='overwrite', idsOnly=False):
         """concatenates columns that have the same header. mode can be:
         'append', 'overwrite', 'smart_append' (consolidates values if not already present)
-        or 'add' (performs plus operation for numeric values)"""
-
-        deleteme = []
-        for i in range(0,len(self)-1):
-            for j in range(i+1,len(self)):
-                if self.getHeaders()[i].lower().replace('__','') == self.getHeaders(
-                        )[j].lower().replace('__',''): # caught the same header!
-                    deleteme.append(j)
-                    # copy over new values
-                    for k in self._rows.keys():
-                        if k != self._HEADERS_ID: # skip headers
-                            if i == self.idColumn: # if merging IDs also use overwrite
-                                self[k][i] = self.mergedValue(self[k][i], self[k][j], mode='overwrite')
-                                self.rename(self[k][i], key=k) # re-index just in case
-                            else:
-                                self[k][i] = self.mergedValue(self[k][i], self[k][j], mode=mode)
+        or 'add' (performs plus operation for numeric values). idsOnly only merges the
+        columns named as the ID column (always with 'overwrite')"""
+
+        # group the columns by header, in order of appearance
+        groups = OrderedDict()
+        for c, header in enumerate(self._headers()):
+            groups.setdefault(header.lower().replace('__',''), []).append(c)
+        groups = [g for g in groups.itervalues() if len(g) > 1 and (
+            not idsOnly or g[0] == self.idColumn)]
+        if not groups:
+            return
+        self._arrays = None
+        self._indexes = self._order = None
+        merges = [(g[0], g[1:]) for g in groups if g[0] != self.idColumn]
+        idGroup = [g for g in groups if g[0] == self.idColumn]
+
+        # copy over new values, merging all columns of a row in one sweep
+        if merges:
+            for k in self._rows.keys():
+                if k == self._HEADERS_ID: # skip headers
+                    continue
+                row = self._rows[k]
+                for i, sources in merges:
+                    value = row[i]
+                    for j in sources:
+                        value = self.mergedValue(value, row[j], mode=mode)
+                    row[i] = value
+        if idGroup:
+            self._contractIds(idGroup[0])
+
         # now delete duplicate columns
-        if deleteme:
-            self.removeColumns(deleteme)
+        self.removeColumns([j for g in groups for j in g[1:]])
+
+    def idClashes(self):
+        """returns True if other columns have the name of the ID column. contract()
+        merges them into the ID column, which may re-key rows"""
+        names = [h.lower().replace('__','') for h in self._headers()]
+        return bool(names) and names.count(names[self.idColumn]) > 1
+
+    def _contractIds(self, group):
+        """merges the columns of group into the ID column (the first one) using
+        'overwrite', and re-keys the rows whose ID changed"""
+        i = group[0]
+        merged = []
+        newKeys = set()
+        for k in self._rows.keys():
+            if k == self._HEADERS_ID or not k: # rename() skips blank keys
+                continue
+            value = self.mergedValue(self._rows[k][i], self._rows[k][group[1]], mode='overwrite')
+            newKey = clean(sanitize(value))
+            if newKey != k:
+                merged.append((k, value, newKey))
+                newKeys.add(newKey)
+        if len(group) > 2 or len(newKeys) < len(merged) or any(
+                key in self._rows for key in newKeys):
+            # renames would overwrite other rows: do exactly as before, one by one
+            for j in group[1:]:
+                for k in self._rows.keys():
+                    if k != self._HEADERS_ID: # skip headers
+                        row = self._row(k)
+                        row[i] = self.mergedValue(row[i], row[j], mode='overwrite')
+                        self.rename(row[i], key=k) # re-index just in case
+            return
+        for k in self._rows.keys():
+            if k != self._HEADERS_ID:
+                row = self._rows[k]
+                row[i] = self.mergedValue(row[i], row[group[1]], mode='overwrite')
+        # renamed rows go to the end, in order
+        if self.storage == 'columnar':
+            for k, value, newKey in merged:
+                self.rename(value, key=k)
+        else:
+            renamed = set(k for k, value, newKey in merged)
+            rows = OrderedDict((k, row) for k, row in self._rows.iteritems() if k not in renamed)
+            for k, value, newKey in merged:
+                rows[newKey] = self._rows[k]
+            self._rows = rows
+            self._natural = None
 
     def zeroFill(self, zero=0):
         """fills blank cells with zero"""
+        self._arrays = None
+        self._indexes = self._order = None
         for k in self._rows.keys():
-            for h in range(len(self[k])):
-                if self[k][h] in [None, [], '', self._BLANK_VALUE]:
-                    self[k][h]=zero
+            row = self._row(k)
+            for h in range(len(row)):
+                if row[h] in [None, [], '', self._BLANK_VALUE]:
+                    row[h]=zero
 
     def getColumnsWithBlanks(self):
         """returns indices of columns containing blank values"""
@@ -1176,7 +2873,7 @@ class Pysheet:
     def getColumnsContaining(self, items):
         """returns indices of columns contains anything in list of items"""
         return unique([h for k in self.getIds() for h in self.getHeaders(
-            idCol=False, index=True) if self[k][h] in items])
+            idCol=False, index=True) if self._row(k)[h] in items])
 
     def getRowsWithBlanks(self):
         """returns IDs of rows containing blank values"""
@@ -1184,7 +2881,7 @@ class Pysheet:
     def getRowsContaining(self, items):
         """returns IDs of columns containing anything in list of items"""
         return unique([k for k in self.getIds() for h in self.getHeaders(
-            idCol=False, index=True) if self[k][h] in items])
+            idCol=False, index=True) if self._row(k)[h] in items])
 
     def removeColumns(self, cols):
         """removes columns from the dictionary by index (not by header name), starting from 0"""
@@ -1211,9 +2908,20 @@ class Pysheet:
                     # then we need to update the idColumn
                     self.idColumn -= 1
             # now remove
-            for k in self._rows.keys():
+            if self.storage == 'columnar':
                 for c in cols:
-                    del self[k][c]
+                    del self.getHeaders()[c]
+                self._rows.removeColumns(cols)
+            else:
+                # rebuild each row once
+                length = len(self)
+                drop = set(cols)
+                keep = [c for c in range(length) if c not in drop]
+                for row in self._rows.itervalues():
+                    row[:] = [row[c] for c in keep] + row[length:]
+            self._headerMap = None
+            self._arrays = None
+            self._indexes = self._order = None
 
     def rename(self, newName, header=None, key=None):
         """renames a column header, or a row key (not both)"""
@@ -1221,12 +2929,13 @@ class Pysheet:
             hi = self.headerIndex(header)
             if hi >= 0:
                 self.getHeaders()[hi] = str(newName).strip()
+                self._headerMap = None
             else:
                 raise PysheetException("Cannot rename. No such header: %s" % header)
         elif key and key != self._HEADERS_ID:
             cleanKey = clean(sanitize(key))
             cleanNewKey = clean(sanitize(newName))
-            row = self[cleanKey]
+            row = self._row(cleanKey)
             if row != None:
                 if cleanKey != cleanNewKey: # don't rename if the keys are the same
                     del self[cleanKey]
@@ -1235,6 +2944,7 @@ class Pysheet:
             else:
                 raise PysheetException("Cannot rename. No such key: %s" % key)
 
+    @_phase('consolidate')
     def consolidate(self, consolidations, cleanUp=False, mode='smart_append'):
         """consolidates columns according to keywords. consolidations is a 2D list of
         [[header, keyword, keyword, ...], ...]
@@ -1258,35 +2968,59 @@ class Pysheet:
         for header in consolidationHeaders:
             self.insertColumn(header)
 
-        # now consolidate
-        deleteme = []
-        for i in range(len(self)):
-            try:
-                for h in range(len(consolidationHeaders)):
-                    header = consolidationHeaders[h]
-                    header_index = self.headerIndex(header)
-                    keywords = []
-                    if len(consolidations[h]) == 1:
-                        # no keywords given! use the header itself as keyword
-                        keywords = [k.lower() for k in consolidations[h]]
-                    else: # keywords given, skip the header
-                        keywords = [k.lower() for k in consolidations[h][1:]]
-                    for keyword in keywords:
-                        if header_index != i and not self.getHeaders()[i].startswith(
-                                '__') and keyword in self.getHeaders()[i].lower(): # caught a similar header!
-                            deleteme.append(i)
-                            # copy over new values
-                            for k in self.getIds():
-                                self[k][header_index] = self.mergedValue(
-                                        self[k][header_index], self[k][i], mode=mode)
-                            # skip to next column
-                            raise StopIteration
-            except StopIteration:
-                pass
+        # match each column to the first consolidation with a keyword in its header
+        pairs = self._consolidationPlan(consolidations, consolidationHeaders)
+        if pairs:
+            self._indexes = self._order = None
+        # numeric add/mean go column by column on typed sheets (see _mergeArrays), as
+        # long as the merges left for the row sweep don't need to happen first
+        deferred = []
+        written = set() # targets of the deferred merges
+        touched = set() # targets and sources of the deferred merges
+        ids = None
+        for target, source in pairs:
+            if ids == None and self.typed:
+                ids = len(self.getIds())
+            if target in touched or source in written or not self._mergeArrays(
+                    target, source, mode, ids):
+                deferred.append((target, source))
+                written.add(target)
+                touched.update((target, source))
+            elif target == self._excludeIndex():
+                ids = None # the merge may have changed which rows are excluded
+        # and the rest in one sweep of the rows, in the order they were matched
+        if deferred:
+            self._arrays = None
+            excludeIndex = self._excludeIndex()
+            sweeps = [deferred] if excludeIndex not in written else [[p] for p in deferred]
+            for merges in sweeps:
+                for k, row in self._rows.iteritems():
+                    if k.startswith('__') or (excludeIndex >= 0 and not self.isBlank(
+                            row[excludeIndex])): # as getIds()
+                        continue
+                    for target, source in merges:
+                        row[target] = self.mergedValue(row[target], row[source], mode=mode)
 
         # now delete copied columns?
         if cleanUp:
-            self.removeColumns(deleteme)
+            self.removeColumns([source for target, source in pairs])
+
+    def _consolidationPlan(self, consolidations, consolidationHeaders):
+        """returns the (target, source) column pairs to merge for consolidate(), in order
+        of the source columns. A column goes to the first consolidation with a keyword
+        (or just the header) in its header, other than its own and '__' columns"""
+        targets = [self.headerIndex(header) for header in consolidationHeaders]
+        keywords = [[k.lower() for k in (c if len(c) == 1 else c[1:])] for c in consolidations]
+        pairs = []
+        for i, header in enumerate(self._headers()):
+            if header.startswith('__'):
+                continue
+            header = header.lower()
+            for target, words in izip(targets, keywords):
+                if target != i and any(word in header for word in words):
+                    pairs.append((target, i))
+                    break
+        return pairs
 
     def mergedValue(self, cellA, cellB, mode='smart_append'):
         """returns the merged value of two cells, according to mode:
@@ -1338,10 +3072,16 @@ class Pysheet:
 
         return cellA # default is the existing value remains
 
+    @_phase('query')
     def levels(self, column, hasHeader=False):
         """returns a tuple containing (the discreet items or 'levels', is a numeric list?,
         the number of levels)"""
         if not isList(column):
+            levs = self._levelArrays(column)
+            if levs == None:
+                levs = self._levelIndex(column)
+            if levs != None:
+                return (levs, isNumber(levs), len(levs))
             qcolumn = self.produceColumn(column)
             if not qcolumn or len(qcolumn) == 1:
                 # our object is blank or this header does not exist!
@@ -1355,6 +3095,207 @@ class Pysheet:
         levs = unique(tryNumber(qcolumn[offset:]), blanks=False)
         return (levs, isNumber(levs), len(levs))
 
+    def inferTypes(self, cols=None):
+        """infers the type of columns (default all): 'int', 'float', 'percentage' or
+        'string', from their non-blank cells. Numeric columns are kept as NumPy arrays
+        that queries, levels() and add/mean consolidation use until the sheet changes.
+        Rows got with getRow() (or []) may be changed in place, as that drops the arrays,
+        but not rows held from before the last query. Returns {header: type}"""
+        self.typed = True
+        self._arrays = None
+        if cols == None:
+            cols = range(self.idColumn) + range(self.idColumn+1, len(self))
+        elif not isList(cols):
+            cols = [cols]
+        ret = OrderedDict()
+        for c in cols:
+            hi = self.headerIndex(c)
+            if hi < 0:
+                raise PysheetException("No such header: %s" % c)
+            ret[self._headers()[hi]] = self._columnArrays(hi)[3]
+        return ret
+
+    def _columnArrays(self, index):
+        """returns (values, numeric, ints, type, exact) for a column, in the order of
+        _arrayKeys: the numbers of its cells, which cells are numbers and which of those are
+        integers, the type of the column (see inferTypes), and the numbers as saved where
+        they differ from values (None if they do not)"""
+        if self._arrays == None:
+            self._arrays = {}
+            self._arrayKeys = [k for k in self._rows.keys() if k != self._HEADERS_ID]
+        if index in self._arrays:
+            if self._DEBUG:
+                self._checkArrays(index)
+            return self._arrays[index]
+        import numpy
+        cells = [self._rows[k][index] for k in self._arrayKeys]
+        values = numpy.zeros(len(cells))
+        numeric = numpy.zeros(len(cells), dtype=bool)
+        ints = numpy.zeros(len(cells), dtype=bool)
+        kind = 'int'
+        percentages = 0
+        floats = [] # positions of the float cells, which are truncated
+        for j in xrange(len(cells)):
+            x = cells[j]
+            if isinstance(x, str):
+                if x == '':
+                    continue # blank
+                x = tryNumber(x)
+            elif isinstance(x, float) and abs(x) != float('inf'):
+                floats.append(j)
+                x = tryNumber(x) # which truncates, as in queries and mergedValue
+            if isinstance(x, bool) or not isinstance(x, (int, long, float)):
+                if isinstance(x, str) and x.endswith('%') and isNumber(x[:-1], strOk=True):
+                    percentages += 1 # compares as a string all the same
+                kind = 'string'
+            elif isinstance(x, float):
+                values[j] = x
+                numeric[j] = True
+                if kind == 'int':
+                    kind = 'float'
+            elif abs(x) < _MAX_EXACT_INT: # exact as a float, even when added up
+                values[j] = x
+                numeric[j] = True
+                ints[j] = True
+            else:
+                kind = 'string'
+        if kind == 'string' and percentages and percentages == len(cells) - sum(
+                1 for x in cells if x == ''):
+            kind = 'percentage'
+        exact = _exactValues(values, cells, floats) if floats else None
+        self._arrays[index] = (values, numeric, ints, kind, exact)
+        return self._arrays[index]
+
+    def _checkArrays(self, index):
+        """raises an exception if the arrays of a column are out of sync with its cells"""
+        import numpy
+        cached = self._arrays.pop(index)
+        fresh = self._columnArrays(index)
+        exact = lambda arrays: arrays[0] if arrays[4] is None else arrays[4]
+        if cached[3] != fresh[3] or not all(numpy.array_equal(a, b) for a, b in izip(cached[:3],
+                fresh[:3])) or not numpy.array_equal(exact(cached), exact(fresh)):
+            raise PysheetException("Typed arrays out of sync: %s" % self._headers()[index])
+
+    def _compareArrays(self, index, op, arg):
+        """returns the set of row keys whose cell in column index satisfies op ('<', '>',
+        '=' or '!') against arg, like ColumnQuery would. None if the column is not numeric"""
+        if not self.typed or isinstance(arg, bool) or not isinstance(arg, (int, long, float)):
+            return None
+        if not isinstance(arg, float) and abs(arg) >= _MAX_EXACT_INT:
+            return None
+        values, numeric, ints, kind, exact = self._columnArrays(index)
+        if kind not in ['int', 'float']:
+            return None
+        import numpy
+        with numpy.errstate(invalid='ignore'):
+            # blanks are strings, which compare greater than any number
+            if op == '<':
+                hit = numeric & (values < arg)
+            elif op == '>':
+                hit = ~numeric | (values > arg)
+            elif op == '=':
+                hit = numeric & (values == arg)
+            elif op == '!':
+                hit = ~numeric | (values != arg)
+            else:
+                return None
+        return set(compress(self._arrayKeys, hit))
+
+    def _mergeArrays(self, target, source, mode, ids=None):
+        """merges column source into column target like mergedValue for the 'add' and 'mean'
+        modes of numeric columns. Returns False if it did not (so merge cell by cell).
+        ids is len(getIds()), if known"""
+        if not self.typed or mode.lower() not in ['add', 'mean']:
+            return False
+        if ids == None:
+            ids = len(self.getIds())
+        vA, nA, iA, kA, eA = self._columnArrays(target)
+        vB, nB, iB, kB, eB = self._columnArrays(source)
+        if kA not in ['int', 'float'] or kB not in ['int', 'float'] or ids != len(
+                self._arrayKeys):
+            return False # getIds() skips excluded and locked rows
+        import numpy
+        both = nA & nB
+        if mode.lower() == 'add':
+            values = vA + vB
+            ints = iA & iB
+        else:
+            values = (vA + vB) / 2
+            ints = numpy.zeros(len(values), dtype=bool)
+        rows = self._rows
+        cells = [None] * len(values)
+        floats = []
+        for j in numpy.flatnonzero(both):
+            if ints[j]:
+                rows[self._arrayKeys[j]][target] = int(values[j])
+            else:
+                rows[self._arrayKeys[j]][target] = cells[j] = float(values[j])
+                floats.append(j)
+        for j in numpy.flatnonzero(nB & ~nA): # blank target, clean copy
+            row = rows[self._arrayKeys[j]]
+            row[target] = row[source]
+        exact = None
+        if floats or eA is not None or eB is not None:
+            exact = _exactValues(numpy.where(both, values, numpy.where(nA,
+                vA if eA is None else eA, vB if eB is None else eB)), cells, floats)
+        # tryNumber truncates the merged numbers when they are read again
+        values = numpy.where(both, numpy.trunc(values), numpy.where(nA, vA, vB))
+        ints = numpy.where(both, True, numpy.where(nA, iA, iB))
+        numeric = nA | nB
+        if not numpy.isfinite(values[both]).all() or (ints.any() and abs(values[ints]).max(
+                ) >= _MAX_EXACT_INT):
+            del self._arrays[target] # parse again if needed
+        else:
+            kind = 'int' if ints.sum() == numeric.sum() else 'float'
+            self._arrays[target] = (values, numeric, ints, kind, exact)
+        return True
+
+    def _levelArrays(self, column):
+        """returns levels(column)[0] from the arrays of a numeric column, or None"""
+        if not self.typed or self._excludeIndex() >= 0:
+            return None
+        try:
+            query = self.compileColumns(column)
+        except PysheetException:
+            return None
+        if len(query.columns) != 1 or query.tests[0] != None:
+            return None
+        values, numeric, ints, kind, exact = self._columnArrays(query.columns[0])
+        if kind not in ['int', 'float'] or not self._arrayKeys:
+            return None
+        import numpy
+        if exact is not None: # levels() parses the numbers as saved
+            values = exact
+        positions = numpy.flatnonzero(numeric & (values != 0)) # zero is not a level
+        levs, first = numpy.unique(values[positions], return_index=True)
+        index = query.columns[0]
+        # the first occurrence of each value, as levels() would parse it
+        return [tryNumber(str(self._rows[self._arrayKeys[j]][index]))
+                for j in sorted(positions[first])]
+
+    def _levelIndex(self, column):
+        """returns levels(column)[0] from the index of a plain column, or None"""
+        if not self.indexed or self._excludeIndex() >= 0 or self.height() < 2:
+            return None
+        try:
+            query = self.compileColumns(column)
+        except PysheetException:
+            return None
+        if len(query.columns) != 1 or query.tests[0] != None:
+            return None
+        values = self._valueIndex(query.columns[0])
+        if values is None:
+            return None
+        view = values.view('levels', lambda x: tryNumber('' if self.isBlank(x) else str(x)))
+        if view is None:
+            return None
+        order = self._rowOrder()
+        first = [] # (position, cell) of the first occurrence of each level
+        for level, cells in view.iteritems():
+            if level: # zero is not a level
+                first.append(min((min(imap(order.get, values.keys[c])), c) for c in cells))
+        return [tryNumber(str(c)) for p, c in sorted(first)]
+
     def removeMissing(self, rows=False):
         """removes rows or columns (default) with empty fields and returns what was removed"""
         ret = []
@@ -1367,8 +3308,15 @@ class Pysheet:
             self.removeColumns(ret)
         return ret
 
-    def save(self, output=None, delimiter=',', saveHeaders=True, replaceHeaders=None, trans=False):
-        """saves the current state of the dictionary as a delimited text file"""
+    @_phase('save')
+    def save(self, output=None, delimiter=',', saveHeaders=True, replaceHeaders=None, trans=False,
+            snapshot=False):
+        """saves the current state of the dictionary as a delimited text file. A file is
+        written under a temporary name and then renamed, so readers never see half of it.
+        Rows that have not changed since the sheet last saved output (or was loaded from
+        its snapshot) are copied from it as they are, while output stays the same.
+        snapshot=True also writes a binary snapshot next to it (output + '.pysheet'),
+        which is loaded instead of the text for as long as that is unchanged"""
         # check output
         if not output:
             if not self.filename:
@@ -1381,10 +3329,16 @@ class Pysheet:
         elif delimiter == r'\s':
             delimiter = "\s"
         # prepare the output writer
+        outfile = None
         if output == 'stdout':
             writer = csv.writer(sys.stdout, delimiter=delimiter)
         else:
-            writer = csv.writer(open(output, "wb"), delimiter=delimiter)
+            target = os.path.realpath(output) # written through a symlink, as it was
+            temp = "%s.%d" % (target, os.getpid())
+            outfile = open(temp, "wb")
+            writer = csv.writer(outfile, delimiter=delimiter)
+        layout = self._layout
+        self._layout = None
         keys = self._rows.keys()
         skipAutoID = False
         skipAutoIDColumn = -1
@@ -1396,45 +3350,129 @@ class Pysheet:
             if skipAutoIDColumn < 0:
                 skipAutoIDColumn = len(self) + skipAutoIDColumn
         else: # sort only if we have proper IDs
-            keys = natsorted(keys, alg=ns.IGNORECASE)
-        # set the header row on top first
-        if saveHeaders:
-            if skipAutoID:
-                header = self._rows[self._HEADERS_ID][:self.idColumn] + self._rows[
-                        self._HEADERS_ID][(self.idColumn+1):]
+            keys = self._sortedKeys()
+        try:
+            # set the header row on top first
+            if saveHeaders:
+                if skipAutoID:
+                    header = self._rows[self._HEADERS_ID][:self.idColumn] + self._rows[
+                            self._HEADERS_ID][(self.idColumn+1):]
+                else:
+                    header = self._rows[self._HEADERS_ID]
+                if replaceHeaders and len(replaceHeaders) != len(header):
+                    raise PysheetException(("Output headers given do not match number of "
+                    "output columns (%d)!\n%s") % (len(header), flatten(replaceHeaders, ", ")))
+                elif replaceHeaders:
+                    header = replaceHeaders
+                ret = [header]
+            if outfile and saveHeaders and not replaceHeaders and not trans and not skipAutoID:
+                # keep track of where the rows go, to copy those that stay the same next time
+                keys, spans, cells = self._writeRows(outfile, writer, header, keys,
+                        self._savedRows(output, delimiter, layout))
+                layout = [os.path.realpath(output), None, delimiter, list(header), keys, spans,
+                        cells]
             else:
-                header = self._rows[self._HEADERS_ID]
-            if replaceHeaders and len(replaceHeaders) != len(header):
-                raise PysheetException(("Output headers given do not match number of "
-                "output columns (%d)!\n%s") % (len(header), flatten(replaceHeaders, ", ")))
-            elif replaceHeaders:
-                header = replaceHeaders
-            ret = [header]
-        # now the content
-        for k in keys:
-            if k == self._HEADERS_ID:
-                continue
-            row = self._rows[k]
-            line = []
-            for col in range(len(row)): #i[row]:
-                # if col == None: saves N.
-                if skipAutoID and col == skipAutoIDColumn: # don't print auto ids!
-                    continue
-                if isinstance(row[col],str):
-                    line.append(row[col])
-                elif isNumber(row[col]):
-                    line.append(str(row[col]))
+                layout = None
+                # now the content, a row at a time
+                lines = chain(ret, ([cellString(row[col]) for col in range(len(row)) if not (
+                    skipAutoID and col == skipAutoIDColumn)] # don't print auto ids!
+                    for row in imap(self._rows.__getitem__, (
+                        k for k in keys if k != self._HEADERS_ID))))
+                if trans:
+                    writer.writerows(transposeLines(lines, limit=self._TRANSPOSE_CELLS))
                 else:
-                    line.append(cPickle.dumps(row[col]))
-            ret.append(line)
-        if trans:
-            writer.writerows(transpose(ret))
-        else:
-            writer.writerows(ret)
+                    writer.writerows(lines)
+        except:
+            if outfile:
+                outfile.close()
+                os.remove(temp)
+            raise
+        if outfile:
+            outfile.close()
+            if os.path.isfile(target): # keep its mode and owner
+                import shutil
+                shutil.copymode(target, temp)
+                stat = os.stat(target)
+                try:
+                    os.chown(temp, stat.st_uid, stat.st_gid)
+                except OSError:
+                    pass # only root may give files away
+            os.rename(temp, target)
+            if layout != None:
+                stat = os.stat(output)
+                layout[1] = (stat.st_size, stat.st_mtime, stat.st_ino)
+                self._layout = tuple(layout)
+            if snapshot and layout != None:
+                self._saveSnapshot(output, self._layout)
+            elif os.path.isfile(output + self._SNAPSHOT_EXT):
+                os.remove(output + self._SNAPSHOT_EXT) # mtimes may be too coarse to tell
+            # the journal is now part of the saved sheet
+            if self._journal and os.path.realpath(output) == os.path.realpath(
+                    self._journal[0][:-len(self._JOURNAL_EXT)]):
+                self._dropJournal()
         # set the filename
         if not self.filename:
             self.filename = output
 
+    def _savedRows(self, output, delimiter, layout):
+        """returns (the contents of output, {key: position}, spans, cells) from the layout
+        of the rows that the sheet last saved in output (see _writeRows), or None if output
+        or its headers have changed since"""
+        if layout == None:
+            return None
+        path, stat, delim, headers, keys, spans, cells = layout
+        if (path != os.path.realpath(output) or delim != delimiter or
+                headers != self._rows[self._HEADERS_ID]):
+            return None
+        try:
+            with open(output, 'rb') as f:
+                now = os.fstat(f.fileno())
+                if stat != (now.st_size, now.st_mtime, now.st_ino):
+                    return None
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+        return data, dict(izip(keys, count())), spans, cells
+
+    def _writeRows(self, outfile, writer, header, keys, saved=None):
+        """writes the header and the rows of keys, copying the lines of the rows whose cells
+        are the very ones of saved (see _savedRows). Returns the keys written, the (start,
+        end) of their lines and their cells as written"""
+        data, position, spans, cells = saved if saved != None else (None, {}, None, None)
+        keys = [k for k in keys if k != self._HEADERS_ID]
+        if self.storage == 'columnar':
+            rows = izip(*self._selectColumns(keys, len(header)))
+        else:
+            rows = imap(self._rows.__getitem__, keys)
+        writer.writerow(header)
+        pos = outfile.tell()
+        start = end = 0 # the bytes still to copy, as one
+        newSpans = []
+        newCells = []
+        for k, row in izip(keys, rows):
+            j = position.get(k)
+            line = cells[j] if j != None else None
+            if line != None and len(line) == len(row) and all(imap(is_, row, line)):
+                first, last = spans[j]
+                if first != end:
+                    outfile.write(data[start:end])
+                    start = first
+                end = last
+                newSpans.append((pos, pos + last - first))
+                pos += last - first
+            else: # changed or new
+                if end:
+                    outfile.write(data[start:end])
+                    start = end = 0
+                line = tuple([cellString(x) for x in row])
+                writer.writerow(line)
+                newSpans.append((pos, outfile.tell()))
+                pos = newSpans[-1][1]
+            newCells.append(line)
+        if end:
+            outfile.write(data[start:end])
+        return keys, newSpans, newCells
+
     def isEmpty(self):
         """returns True if this sheet is blank"""
         return len(self)<=1 and self.height()<=1
@@ -1450,25 +3488,33 @@ class Pysheet:
 
     def __str__(self):
         """returns a string representation of this object"""
+        return ''.join(self.iterTable())
+
+    def iterTable(self, head=None, page=None):
+        """yields the lines of this sheet drawn as a text table, a row at a time. Only the
+        first head rows are drawn if given. With page, rows are drawn in pages of that many,
+        each with its own header and column widths, so the first page shows at once"""
         if self.isEmpty():
-            return "* empty *\n"
-        try:
-            from texttable import Texttable
-        except ImportError:
-            return "* module 'Texttable' is required to print stuff *\n"
-        header = [[x.replace('__','') for x in self.getHeaders()]]
+            yield "* empty *\n"
+            return
         ids = self.getIds()
         if self._rows[self._HEADERS_ID][self.idColumn] != self._AUTO_ID_HEADER:
             ids.sort() # sort only if non-Auto IDs
-        table = [self[i] for i in ids]
-        table = header + table
-        ttable = Texttable()#self._MAX_PRINT_WIDTH)
-        ttable.set_deco(Texttable.HEADER | Texttable.VLINES)
-        ttable.add_rows(table)
-        try:
-            return ttable.draw() + '\n'
-        except ValueError as e:
-            return "* table too wide to display; choose less then %d columns *\n" % len(self)
+        more = 0
+        if head != None and head < len(ids):
+            more = len(ids) - head
+            ids = ids[:head]
+        printer = TablePrinter([x.replace('__','') for x in self._headers()],
+                self._TABLE_WIDTH)
+        pages = [ids[i:i + page] for i in xrange(0, len(ids), page)] if page else [ids]
+        for i, keys in enumerate(pages):
+            if i:
+                yield "\n"
+            printer.fit(self._row(k) for k in keys) # a pass to measure the columns..
+            for line in printer.lines(self._row(k) for k in keys): # ..and one to draw them
+                yield line
+        if more:
+            yield "* %d more row%s *\n" % (more, '' if more == 1 else 's')
 
 class PysheetException(Exception):
     """Pysheet exception class. You can raise it with a msg"""
@@ -1483,6 +3529,562 @@ class PysheetException(Exception):
     def __str__(self):
         return repr(self.message)
 
+class ColumnarRows(object):
+    """Column-oriented storage for a Pysheet. Behaves like the OrderedDict of
+    ID:row items used by default, but keeps one list per column and a map of IDs
+    to row positions. Rows are returned as ColumnarRow views"""
+    def __init__(self, headersKey, blank=''):
+        self._headersKey = headersKey # the key of the header row
+        self._blank = blank # value used to pad new columns
+        self.headers = None # the header row (a plain list)
+        self.columns = [] # one list of cells per column
+        self._keys = [] # row position -> key (None if deleted)
+        self._pos = {} # key -> row position
+        self._deleted = 0 # number of deleted row positions
+
+    def __len__(self):
+        return len(self._pos) + (self.headers is not None)
+
+    def __contains__(self, key):
+        return key in self._pos or (key == self._headersKey and self.headers is not None)
+
+    def keys(self):
+        """returns the keys in insertion order (header row first)"""
+        ret = [self._headersKey] if self.headers is not None else []
+        ret.extend(k for k in self._keys if k is not None)
+        return ret
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def iteritems(self):
+        for k in self.keys():
+            yield k, self[k]
+
+    def get(self, key, default=None):
+        if key == self._headersKey:
+            return self.headers if self.headers is not None else default
+        pos = self._pos.get(key)
+        if pos is None:
+            return default
+        return ColumnarRow(self, pos)
+
+    def __getitem__(self, key):
+        ret = self.get(key)
+        if ret is None:
+            raise KeyError(key)
+        return ret
+
+    def __setitem__(self, key, row):
+        if key == self._headersKey:
+            self.headers = row
+            self.expand()
+            return
+        values = list(row) # copy first in case row is a view of this object
+        if len(values) > len(self.columns):
+            self._fit(len(values))
+        values += [self._blank] * (len(self.columns) - len(values))
+        pos = self._pos.get(key)
+        if pos is None:
+            if self._deleted > len(self._pos):
+                self.compact()
+            pos = len(self._keys)
+            self._keys.append(key)
+            self._pos[key] = pos
+            for col, value in izip(self.columns, values):
+                col.append(value)
+        else:
+            for col, value in izip(self.columns, values):
+                col[pos] = value
+
+    def __delitem__(self, key):
+        if key == self._headersKey and self.headers is not None:
+            self.headers = None
+            return
+        pos = self._pos.pop(key)
+        self._keys[pos] = None
+        self._deleted += 1
+
+    def pop(self, key, *default):
+        """removes a row and returns it as a list"""
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        ret = self.headers if key == self._headersKey else list(self[key])
+        del self[key]
+        return ret
+
+    def select(self, keys, width, blank):
+        """returns width lists with the cells of the rows of keys, column by column.
+        Missing rows and columns are blank"""
+        pos = [self._pos.get(k) for k in keys]
+        ret = [[col[p] if p is not None else blank for p in pos] for col in self.columns[:width]]
+        ret.extend([blank] * len(keys) for c in range(width - len(ret)))
+        return ret
+
+    def setColumns(self, keys, columns):
+        """replaces all rows but the header row with the given keys and columns"""
+        self._keys = list(keys)
+        self._pos = dict((k, p) for p, k in enumerate(self._keys))
+        self._deleted = 0
+        self.columns = columns
+        self._fit(len(self.headers))
+
+    def compact(self):
+        """drops the cells of deleted rows. Invalidates existing row views"""
+        live = [p for p in range(len(self._keys)) if self._keys[p] is not None]
+        self.columns = [[col[p] for p in live] for col in self.columns]
+        self._keys = [self._keys[p] for p in live]
+        self._pos = dict((k, p) for p, k in enumerate(self._keys))
+        self._deleted = 0
+
+    def _fit(self, width):
+        """appends blank columns until there are width columns"""
+        while len(self.columns) < width:
+            self.columns.append([self._blank] * len(self._keys))
+
+    def expand(self):
+        """blank-pads so that there is a column for every header"""
+        if self.headers is not None:
+            assert len(self.columns) <= len(self.headers), ("Error in columns. Greater "
+            "than length of headers row (%d): %d") % (len(self.headers), len(self.columns))
+            self._fit(len(self.headers))
+
+    def insertColumn(self, index, value):
+        """inserts a column at index, with all cells set to value"""
+        self.columns.insert(index, [value] * len(self._keys))
+
+    def removeColumns(self, cols):
+        """removes columns by index. cols must be sorted in descending order"""
+        for c in cols:
+            del self.columns[c]
+
+    def column(self, index):
+        """returns (a copy of) the cells of the column at index, in row order"""
+        col = self.columns[index]
+        if not self._deleted:
+            return col[:]
+        return [col[p] for p in range(len(self._keys)) if self._keys[p] is not None]
+
+class ColumnarRow(object):
+    """A list-like view of a single row of a ColumnarRows object.
+    Rows have a fixed length: add or remove columns through the Pysheet"""
+    __slots__ = ['_store', '_pos']
+    def __init__(self, store, pos):
+        self._store = store
+        self._pos = pos
+
+    def __len__(self):
+        return len(self._store.columns)
+
+    def __iter__(self):
+        pos = self._pos
+        for col in self._store.columns:
+            yield col[pos]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [col[self._pos] for col in self._store.columns[i]]
+        return self._store.columns[i][self._pos]
+
+    def __setitem__(self, i, value):
+        self._store.columns[i][self._pos] = value
+
+    def __eq__(self, other):
+        if isList(other):
+            return list(self) == list(other)
+        return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return repr(list(self))
+
+class LazyRows(object):
+    """Read-only storage for a Pysheet that maps its file and only parses the rows
+    asked for. Rows are found through an index of (ID hash, byte offset) records,
+    sorted by hash. Rows are returned as lists, and changes to them are not kept"""
+    _RECORD = 16 # bytes per index record: 8 of the ID hash and 8 of the offset
+
+    def __init__(self, headersKey, headers, data, index, start, count, fmt, width,
+            idColumn, blank=''):
+        self._headersKey = headersKey # the key of the header row
+        self.headers = headers # the header row
+        self._data = data # the mapped file
+        self._index = index # the mapped (or in-memory) index records
+        self._start = start # where the records start in index
+        self._count = count # number of records (rows)
+        self._fmt = fmt # csv reader parameters
+        self._width = width # row length
+        self._idColumn = idColumn
+        self._blank = blank
+        self._last = (None, None) # the last row found, as (key, row)
+
+    def __len__(self):
+        return self._count + 1
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        if key == self._headersKey:
+            return self.headers
+        if key == self._last[0]:
+            return self._last[1]
+        for offset in self._offsets(key):
+            row = self._row(offset)
+            if clean(sanitize(row[self._idColumn])) == key:
+                self._last = (key, row)
+                return row
+        return default
+
+    def __getitem__(self, key):
+        ret = self.get(key)
+        if ret is None:
+            raise KeyError(key)
+        return ret
+
+    def keys(self):
+        """returns the keys in file order (header row first)"""
+        return [k for k, row in self.iteritems()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def iteritems(self):
+        yield self._headersKey, self.headers
+        index, start, size = self._index, self._start, self._RECORD
+        for offset in sorted(unpack('>Q', index[p+8:p+size])[0] for p in xrange(
+                start, start + self._count * size, size)):
+            row = self._row(offset)
+            yield clean(sanitize(row[self._idColumn])), row
+
+    def _offsets(self, key):
+        """yields the offsets of the rows whose ID hash is that of key"""
+        digest = md5(key).digest()[:8]
+        index, start, size = self._index, self._start, self._RECORD
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            p = start + mid * size
+            if index[p:p+8] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        p = start + lo * size
+        while lo < self._count and index[p:p+8] == digest:
+            yield unpack('>Q', index[p+8:p+size])[0]
+            lo += 1
+            p += size
+
+    def _row(self, offset):
+        """parses the row at offset, as it would be loaded"""
+        self._data.seek(offset)
+        line = csv.reader(universalLines(self._data), **self._fmt).next()
+        return line[:self._width] + [self._blank] * (self._width - len(line))
+
+    def _readOnly(self, *args):
+        raise PysheetException("This sheet was loaded lazily and is read-only")
+    __setitem__ = __delitem__ = pop = _readOnly
+
+class ValueIndex(object):
+    """The index of a column of an indexed Pysheet: maps each cell to the keys of the rows
+    that hold it, and the cells as the lookups see them (views) to the cells"""
+
+    def __init__(self):
+        self.keys = {} # cell -> set of row keys
+        self._views = {} # view name -> (normalise, {normalised cell: set of cells} or None)
+
+    def add(self, cell, key):
+        """records that row key holds cell. Raises TypeError if cell is unhashable"""
+        keys = self.keys.get(cell)
+        if keys is None:
+            keys = self.keys[cell] = set()
+            for name, (normalise, view) in self._views.items():
+                if view is not None:
+                    self._views[name] = (normalise, self._addView(view, normalise, cell))
+        keys.add(key)
+
+    def remove(self, cell, key):
+        """records that row key no longer holds cell"""
+        keys = self.keys.get(cell)
+        if keys is None:
+            return
+        keys.discard(key)
+        if not keys:
+            del self.keys[cell]
+            for normalise, view in self._views.itervalues():
+                if view is not None:
+                    n = normalise(cell)
+                    view[n].discard(cell)
+                    if not view[n]:
+                        del view[n]
+
+    def _addView(self, view, normalise, cell):
+        """adds cell to view and returns it, or None if cell can't be looked up there"""
+        try:
+            n = normalise(cell)
+        except (TypeError, ValueError, OverflowError):
+            return None
+        if n != n: # NaN equals nothing, not even itself
+            return None
+        view.setdefault(n, set()).add(cell)
+        return view
+
+    def view(self, name, normalise):
+        """returns {normalise(cell): set of cells}, building it on first use, or None if
+        normalise fails on a cell"""
+        if name not in self._views:
+            view = {}
+            for cell in self.keys:
+                view = self._addView(view, normalise, cell)
+                if view is None:
+                    break
+            self._views[name] = (normalise, view)
+        return self._views[name][1]
+
+    def find(self, value, name, normalise):
+        """returns the keys of the rows whose cells normalise to value, or None if the
+        view can't tell"""
+        view = self.view(name, normalise)
+        if view is None:
+            return None
+        return set().union(*[self.keys[c] for c in view.get(value, ())])
+
+class ColumnQuery(object):
+    """A column specification (see Pysheet.parseColumns) compiled to one test per column,
+    so that scanning the rows does not re-check operators or re-parse repeated numbers"""
+
+    def __init__(self, columns, ops, args, unique=None):
+        self.columns = columns # header indices
+        self.ops     = ops     # operator of each column (if any)
+        self.args    = args    # argument of each column (if any)
+        self.unique  = unique if unique != None else [''] * len(columns) # =UNIQUE groups
+        self._numbers = {} # cell -> tryNumber(cell)
+        self.tests = [self._compile(ops[j], args[j]) for j in range(len(columns))]
+        self.bind(None)
+
+    def bind(self, sheet):
+        """precomputes the tests that a sheet can answer from its arrays (see
+        Pysheet.inferTypes) or column indexes (see ValueIndex) as sets of passing row keys.
+        None unbinds"""
+        passing = [None] * len(self.columns)
+        if sheet != None:
+            for j in range(len(self.columns)):
+                if self.tests[j] == None:
+                    continue
+                if sheet.typed and self.ops[j] in ['<', '>', '=', '!']:
+                    passing[j] = sheet._compareArrays(self.columns[j], self.ops[j], self.args[j])
+                if passing[j] == None and self.ops[j] == '=' and self.args[j] != 'UNIQUE':
+                    values = sheet._valueIndex(self.columns[j])
+                    if values != None:
+                        passing[j] = values.find(self.args[j], '=', tryNumber)
+        self._plan = zip(self.columns, self.tests, self.ops, self.args,
+                [tryNumber(a) for a in self.args], self.unique, passing)
+
+    def candidates(self):
+        """returns the keys of the rows that can pass row() going by the bound tests,
+        or None if there are no bound tests"""
+        ret = None
+        for col, test, op, arg, plus, group, passing in self._plan:
+            if passing != None and arg != 'UNIQUE':
+                ret = passing if ret == None else ret & passing
+        return ret
+
+    def number(self, x):
+        """returns tryNumber(x), parsing each distinct cell only once"""
+        try:
+            return self._numbers[x]
+        except KeyError:
+            n = self._numbers[x] = tryNumber(x)
+            return n
+        except TypeError: # unhashable
+            return tryNumber(x)
+
+    def _compile(self, op, arg):
+        """returns a callable that tells if a cell satisfies op and arg, or None if all do"""
+        number = self.number
+        if not op or not arg:
+            return None
+        elif op == '<':
+            return lambda x: number(x) < arg
+        elif op == '>':
+            return lambda x: number(x) > arg
+        elif op == '=':
+            return lambda x: number(x) == arg
+        elif op == '!':
+            return lambda x: number(x) != arg
+        elif op == '~':
+            arg = str(arg)
+            return lambda x: arg in str(x)
+        return lambda x: False # e.g. '+' changes the value instead
+
+    def header(self, headers, idColumn=0):
+        """returns the header row that getColumns returns for this query"""
+        add = []
+        for j in range(len(self.columns)):
+            if not self.args[j]:
+                add.append(headers[self.columns[j]])
+            else: # add operator to the name of the header!
+                add.append(headers[self.columns[j]] + self.ops[j] + str(self.args[j]))
+        return [headers[idColumn]] + [x.replace('__','') for x in add]
+
+    def row(self, row, seen=None, key=None):
+        """returns the requested columns of a row for getColumns, or None if the row does
+        not satisfy the column operators. seen holds the =UNIQUE sets (see uniqueSets)
+        and key is the row's key in the sheet the query was bound to (if any)"""
+        add = [] # initialize the row to be appended
+        for col, test, op, arg, plus, group, passing in self._plan:
+            x = row[col]
+            if test is None or (key in passing if passing != None and key != None else test(
+                    x)) or (arg == 'UNIQUE' and (not seen or tuple(
+                    row[self.columns[k]] for k in seen[group][0]) not in seen[group][1])):
+                add.append(x) # add this value to the new row
+            elif op == '+':
+                try:
+                    add.append(self.number(x) + plus) # perform addition
+                except TypeError:
+                    add.append(str(x)+str(arg))
+            else:
+                return None # skip this row
+        return add
+
+    def hybrid(self, row, blank='', key=None):
+        """returns the requested columns of a row for produceColumn, with blank in place of
+        cells that do not satisfy their operator. key is as for row()"""
+        return [row[col] if test is None or (key in passing if passing != None and
+            key != None else test(row[col])) else blank
+                for col, test, op, arg, plus, group, passing in self._plan]
+
+    def uniqueSets(self):
+        """returns {group: (positions, set of values returned so far)} for the =UNIQUE
+        groups, to be passed to row() and markUnique() during one scan"""
+        seen = {}
+        for j in range(len(self.columns)):
+            if self.unique[j] != '':
+                seen.setdefault(self.unique[j], ([], set()))[0].append(j)
+        return seen
+
+    def markUnique(self, seen, add):
+        """records the values of a returned row in the =UNIQUE sets"""
+        for cols, values in seen.itervalues():
+            values.add(tuple(add[k] for k in cols))
+
+class TablePrinter(object):
+    """Draws rows as a text table with a header line and vertical lines between the
+    columns, as Texttable does, one row at a time. The column widths are measured
+    beforehand by fit. Numbers are formatted as Texttable formats them, cells wider
+    than their column are wrapped, and columns that don't fit at all are left out"""
+    _WRAPPED = re.compile(u'[\t\x0b\x0c\r]') # cells with these are always wrapped
+
+    def __init__(self, header, width=80):
+        self.header = [self.text(x, number=False) for x in header]
+        self.width = width # of the whole table
+        self.widths = None # of each column drawn
+        self.hidden = 0 # columns left out
+
+    @staticmethod
+    def text(x, number=True):
+        """returns a cell as unicode text, with numbers rounded to 3 decimals"""
+        if number:
+            try:
+                f = float(x)
+            except (TypeError, ValueError):
+                f = None
+            if f == None or f != f: # text or NaN
+                pass
+            elif abs(f) > 1e8:
+                return u'%.3e' % f
+            elif f == round(f):
+                if isinstance(x, bool):
+                    return unicode(x)
+                return unicode(x) if type(x) == int else unicode(int(round(f)))
+            else:
+                return u'%.3f' % f
+        if isinstance(x, unicode):
+            return x
+        elif isinstance(x, str):
+            return x.decode('utf-8', 'replace')
+        return unicode(x)
+
+    @staticmethod
+    def cellWidth(text):
+        """returns the width of the widest line of a cell"""
+        return max(displayWidth(line.expandtabs()) for line in text.split(u'\n'))
+
+    def fit(self, rows):
+        """measures the columns of rows, shrinking them to fit the table width"""
+        widths = [self.cellWidth(x) for x in self.header]
+        for row in rows:
+            for i, x in enumerate(row):
+                width = self.cellWidth(self.text(x))
+                if width > widths[i]:
+                    widths[i] = width
+        shown = min(len(widths), (self.width + 3) // 4) # at least one character each
+        self.hidden = len(widths) - shown
+        widths = widths[:shown]
+        if sum(widths) + 3 * (shown - 1) > self.width:
+            available = self.width - 3 * (shown - 1)
+            shrunk = [0] * shown
+            i = 0
+            while available > 0: # a character at a time to each column that needs it
+                if shrunk[i] < widths[i]:
+                    shrunk[i] += 1
+                    available -= 1
+                i = (i + 1) % shown
+            widths = shrunk
+        self.widths = widths
+
+    def lines(self, rows):
+        """yields the lines of the table of rows (utf-8), header first"""
+        yield self._draw(self.header, True)
+        yield '=+='.join('=' * w for w in self.widths) + '\n'
+        for row in rows:
+            yield self._draw([self.text(x) for x in islice(row, len(self.widths))])
+        if self.hidden:
+            yield "* %d more column%s not shown *\n" % (self.hidden,
+                    '' if self.hidden == 1 else 's')
+
+    def _draw(self, cells, header=False):
+        """returns the lines of a row, its cells wrapped to the column widths"""
+        wrapped = [self._wrap(x, w, header) for x, w in izip(cells, self.widths)]
+        height = max(len(x) for x in wrapped)
+        out = []
+        for i in xrange(height):
+            line = []
+            for cell, w in izip(wrapped, self.widths):
+                x = cell[i] if i < len(cell) else u''
+                fill = w - displayWidth(x)
+                if header: # centered
+                    line.append(u' ' * (fill // 2) + x + u' ' * (fill - fill // 2))
+                else:
+                    line.append(x + u' ' * fill)
+            out.append(u' | '.join(line))
+        return (u'\n'.join(out) + u'\n').encode('utf-8')
+
+    def _wrap(self, text, width, header):
+        """returns the lines of a cell wrapped to width"""
+        ret = []
+        for line in text.split(u'\n'):
+            if not line.strip():
+                ret.append(u'')
+            elif not header and len(line) <= width and not self._WRAPPED.search(line):
+                ret.append(line) # as wrapped, once padded
+            else:
+                import textwrap
+                ret.extend(textwrap.wrap(line, width))
+        return ret
+
 ###############################
 ###### UTILITY FUNCTIONS ######
 ###############################
@@ -1493,7 +4095,8 @@ def readable(f):
         return f.lower()
     f = os.path.realpath(f)
     if not os.path.isfile(f):
-        raise argparse.ArgumentTypeError("File does not exist: %s" % f)
+        from argparse import ArgumentTypeError
+        raise ArgumentTypeError("File does not exist: %s" % f)
     return f
 
 def writeable(f):
@@ -1502,7 +4105,8 @@ def writeable(f):
         return f.lower()
     f = os.path.realpath(f)
     if os.path.isfile(f) and not os.access(f, os.W_OK):# or not os.access(os.path.dirname(f), os.W_OK):
-        raise argparse.ArgumentTypeError("File is not writeable: %s" % f)
+        from argparse import ArgumentTypeError
+        raise ArgumentTypeError("File is not writeable: %s" % f)
     return f
 
 def yesNo(f):
@@ -1512,9 +4116,17 @@ def yesNo(f):
     elif f.lower() in ["n","no","false","0"]:
         return False
     else:
-        raise argparse.ArgumentTypeError("Value must be one of y|yes|true|1|n|no|false|0, not %s" % f)
+        from argparse import ArgumentTypeError
+        raise ArgumentTypeError("Value must be one of y|yes|true|1|n|no|false|0, not %s" % f)
     return f
 
+def positive(f):
+    """type for argparse - a whole number above zero"""
+    if not f.isdigit() or int(f) == 0:
+        from argparse import ArgumentTypeError
+        raise ArgumentTypeError("Value must be a whole number above zero, not %s" % f)
+    return int(f)
+
 def collapseMode(f):
     """type for argparse - parses consolidation mode string"""
     if any([f.lower().startswith(x) for x in _COLLAPSE_CHOICES]):
@@ -1525,7 +4137,8 @@ def collapseMode(f):
         except IndexError:
             pass
     else:
-        raise argparse.ArgumentTypeError("Must choose one of %s, not %s" % (choices, f))
+        from argparse import ArgumentTypeError
+        raise ArgumentTypeError("Must choose one of %s, not %s" % (choices, f))
     return (mode[0].lower(), collapse)
 
 def flatten(l, delim=" "):
@@ -1547,7 +4160,10 @@ def isNumber(x, strOk=False):
         #len(filter((lambda i : not isNumber(i, strOk=strOk)),x)) == 0
     if strOk:
         x = tryNumber(x)
-    return isinstance(x, (int, long, float, floating))
+    if isinstance(x, (int, long, float)):
+        return True
+    numpy = sys.modules.get('numpy') # no NumPy numbers unless it was imported
+    return numpy != None and isinstance(x, numpy.floating)
 
 def tryNumber(x):
     """tries to return an appropriate number from x or just x if not a number"""
@@ -1563,10 +4179,111 @@ def tryNumber(x):
         except ValueError:
             return x
 
+def cellString(x):
+    """returns the string that represents a cell in a saved sheet"""
+    if isinstance(x,str):
+        return x
+    elif isNumber(x):
+        return str(x)
+    import cPickle
+    return cPickle.dumps(x)
+
+def _exactValues(values, cells, floats):
+    """returns a copy of the values of a column with its float cells (at positions floats)
+    parsed as saved, which does not truncate them"""
+    exact = values.copy()
+    exact[floats] = [tryNumber(cellString(cells[j])) for j in floats]
+    return exact
+
+def displayWidth(text):
+    """returns the number of columns a line of unicode text takes on a terminal"""
+    try:
+        text.encode('ascii')
+        return len(text)
+    except UnicodeEncodeError:
+        import unicodedata
+        return sum(2 if unicodedata.east_asian_width(c) in 'WF' else
+                0 if unicodedata.combining(c) else 1 for c in text)
+
+def _lockFile(fd, shared=False):
+    """locks an open file (with flock, where there is one) until it is closed"""
+    try:
+        import fcntl
+    except ImportError:
+        return
+    fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+def universalLines(f):
+    """yields the lines of a file (or mmap) opened in binary mode from where it is, as
+    read in universal newline mode. Raises ValueError at a lone carriage return"""
+    for line in iter(f.readline, ''):
+        if '\r' in line:
+            if line.find('\r') != len(line) - 2 or not line.endswith('\r\n'):
+                raise ValueError("Lone carriage return in line: %s" % line)
+            line = line[:-2] + '\n'
+        yield line
+
+def _naturalKey():
+    """returns the key of natsorted(alg=ns.IGNORECASE), importing natsort on first use"""
+    global _NATURAL
+    if _NATURAL == None:
+        from natsort import natsort_keygen, ns
+        _NATURAL = natsort_keygen(alg=ns.IGNORECASE)
+    return _NATURAL
+
 def transpose(arr):
     """transposes a nested list (2D-array)"""
     return map(list, zip(*arr))
 
+def transposeLines(lines, fill='', limit=None):
+    """yields the columns of lines (an iterable of lists) as tuples, padding the shorter
+    lines with fill. Holds at most about limit cells in memory: beyond that the lines are
+    transposed a block at a time and the blocks are kept in a temporary file (so their
+    cells must be plain values, as read from a file)"""
+    spill = None # the temporary file of the blocks, one after the other
+    blocks = [] # [offset of the next column, height, width] of the blocks spilled so far
+    block = []
+    width = 0
+    try:
+        for line in lines:
+            block.append(line)
+            width = max(width, len(line))
+            if limit and width * len(block) >= limit:
+                if spill == None:
+                    from tempfile import TemporaryFile
+                    spill = TemporaryFile(prefix='pysheet')
+                blocks.append(_spillBlock(block, width, fill, spill))
+                block = []
+                width = 0
+        if not blocks: # it all fits
+            for column in izip(*[list(line) + [fill] * (width - len(line)) for line in block]):
+                yield column
+            return
+        if block:
+            blocks.append(_spillBlock(block, width, fill, spill))
+        del block[:]
+        for i in xrange(max(width for offset, height, width in blocks)):
+            column = []
+            for b in blocks:
+                offset, height, width = b
+                if i < width:
+                    spill.seek(offset)
+                    column.extend(marshal.load(spill))
+                    b[0] = spill.tell()
+                else:
+                    column.extend((fill,) * height)
+            yield tuple(column)
+    finally:
+        if spill != None:
+            spill.close()
+
+def _spillBlock(block, width, fill, f):
+    """writes the columns of a block of lines to the end of a file, for transposeLines"""
+    offset = f.tell()
+    for i in xrange(width):
+        marshal.dump(tuple([line[i] if i < len(line) else fill for line in block]), f)
+    return [offset, len(block), width]
+
 def unique(seq, blanks=True):
     """returns a list of unique elements from seq"""
     ret = []
@@ -1598,21 +4315,4 @@ def randomId(size=6, chars=None):
 
 
 if __name__ == '__main__':
-    if PROFILE:
-        import cProfile, pstats
-        cProfile.runctx('main()', globals(), locals(), PROFILE_DAT)
-        f = open(PROFILE_TXT, 'wb')
-        for sort_key in 'time', 'cumulative':
-            stats = pstats.Stats(PROFILE_DAT, stream=f)
-            stats.sort_stats(sort_key)
-            stats.print_stats(PROFILE_LIMIT)
-            stats.strip_dirs()
-            stats.sort_stats(sort_key)
-            if sort_key == 'time':
-                stats.print_callers(PROFILE_LIMIT)
-            else:
-                stats.print_callees(PROFILE_LIMIT)
-        f.close()
-        os.unlink(PROFILE_DAT)
-    else:
-        main()
+    main()
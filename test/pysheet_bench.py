@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of the core Pysheet operations on synthetic sheets
+
+Times loading, merging, consolidating, querying and saving sheets of several shapes
+and sizes, and the locked write path of the command line. Results are written as JSON
+and can be compared against a baseline, flagging the operations that got slower:
+
+    python test/pysheet_bench.py -o before.json
+    python test/pysheet_bench.py -o after.json --baseline before.json
+"""
+
+import argparse, gc, json, os, platform, shutil, sys, tempfile
+from collections import OrderedDict
+from random import Random
+from subprocess import Popen
+from time import time
+
+PYSHEET_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, PYSHEET_DIR)
+from pysheet.pysheet import Pysheet, __version__
+
+PYSHEET = os.path.join(PYSHEET_DIR, "pysheet", "pysheet.py")
+SHAPES = ["tall", "wide", "dups", "numeric"]
+QUERIES = OrderedDict([(">", "num1>500"), ("<", "num1<500"), ("=", "txt0=%s"), ("!", "txt0!%s"),
+    ("~", "txt0~e"), ("=UNIQUE", "txt0=UNIQUE")])
+
+def generate(shape, size, seed):
+  """returns the lines of a synthetic sheet of about size rows: 'tall' (8 columns), 'wide'
+  (a 50th of the rows, 400 columns), 'dups' (a quarter of the IDs, repeated, and few
+  distinct values) or 'numeric' (numbers only)"""
+  rand = Random("%s-%d-%d" % (shape, size, seed))
+  rows, width = (max(size // 50, 10), 400) if shape == "wide" else (size, 8)
+  ids = max(size // 4, 1) if shape == "dups" else rows
+  words = ["%s%d" % (rand.choice(["alpha", "beta", "gamma", "delta", "epsilon"]), i)
+      for i in range(20 if shape == "dups" else 2000)]
+  headers = ["ID"] + ["%s%d" % ("num" if c % 2 or shape == "numeric" else "txt", c)
+      for c in range(width)]
+  lines = [headers]
+  for r in range(rows):
+    line = ["id%d" % rand.randrange(ids) if shape == "dups" else "id%d" % r]
+    for c in range(width):
+      if c % 2 or shape == "numeric":
+        line.append(str(rand.randrange(1000)) if c % 4 else "%.3f" % (rand.random() * 1000))
+      else:
+        line.append(rand.choice(words))
+    lines.append(line)
+  return lines
+
+def write(lines, path):
+  """saves lines as a csv file"""
+  with open(path, "w") as f:
+    for line in lines:
+      f.write(",".join(line) + "\n")
+
+def timed(run, setup=None, repeat=3):
+  """returns the best time of run(setup()) out of repeat runs"""
+  best = None
+  for i in range(repeat):
+    state = setup() if setup else None
+    gc.collect()
+    start = time()
+    run(state)
+    elapsed = time() - start
+    best = elapsed if best == None else min(best, elapsed)
+  return best
+
+def lockedWrites(path, writers=4, writes=5):
+  """writes cells to path from parallel command lines, each locking it with -L. Raises
+  RuntimeError if any of them is missing from path afterwards"""
+  cells = [("w%d_%d" % (w, i), "num1", str(i)) for w in range(writers) for i in range(writes)]
+  jobs = [Popen([sys.executable, PYSHEET, "-d", path, "-D", ",", "-o", path, "-L", "-w"] +
+      sum([list(cell) for cell in cells[w * writes:(w + 1) * writes]], []))
+      for w in range(writers)]
+  for job in jobs:
+    if job.wait():
+      raise RuntimeError("a locked write failed")
+  sheet = Pysheet(path, delimiter=",")
+  ids = set(sheet.getIds())
+  missing = [key for key, header, value in cells
+      if key not in ids or sheet.getCell(key, header) != value]
+  if missing:
+    raise RuntimeError("locked writes lost %d cells: %s" % (len(missing), " ".join(missing)))
+
+def startup(path, runs=10):
+  """reads a cell of path from runs command lines, one after the other"""
+  for i in range(runs):
+    if Popen([sys.executable, PYSHEET, "-d", path, "-D", ",", "-r", "id0", "num1"],
+        stdout=open(os.devnull, "w")).wait():
+      raise RuntimeError("a read failed")
+
+def benchmark(shape, size, tmp, seed=0, repeat=3):
+  """times the operations on a sheet of a shape and size. Returns {operation: seconds}"""
+  path = os.path.join(tmp, "%s-%d.csv" % (shape, size))
+  other = os.path.join(tmp, "%s-%d-other.csv" % (shape, size))
+  out = os.path.join(tmp, "out.csv")
+  lines = generate(shape, size, seed)
+  write(lines, path)
+  write([lines[0]] + generate(shape, size, seed + 1)[1:], other)
+  level = lines[1][1] # of the first column, txt0 (or num0)
+  times = OrderedDict()
+  times["load"] = timed(lambda state: Pysheet(path, delimiter=","), repeat=repeat)
+  times["add+contract"] = timed(lambda (a, b): (a + b).contract(),
+      lambda: (Pysheet(path, delimiter=","), Pysheet(other, delimiter=",")), repeat)
+  times["consolidate"] = timed(lambda p: p.consolidate([["num", "num"], ["txt", "txt"]]),
+      lambda: Pysheet(path, delimiter=","), repeat)
+  sheet = Pysheet(path, delimiter=",")
+  for op, query in QUERIES.items():
+    if shape == "numeric":
+      query = query.replace("txt0", "num0")
+    if "%s" in query:
+      query = query % level
+    times["getColumns " + op] = timed(lambda state: sheet.getColumns(query), repeat=repeat)
+  header = "num0" if shape == "numeric" else "txt0"
+  times["grab(level)"] = timed(lambda state: [sheet.grab(header=header, level=level)
+      for i in range(20)], repeat=repeat)
+  indexed = Pysheet(path, delimiter=",", indexed=True)
+  times["grab(level) indexed"] = timed(lambda state: [indexed.grab(header=header, level=level)
+      for i in range(20)], repeat=repeat)
+  times["save"] = timed(lambda p: p.save(out), lambda: Pysheet(path, delimiter=","), repeat)
+  def resave(p):
+    p.addCell("new", "num1", "1")
+    p.save(out)
+  times["save again"] = timed(resave, lambda: Pysheet(out, delimiter=","), repeat)
+  os.remove(out)
+  return times
+
+def compare(results, baseline, tolerance=0.25, noise=0.005):
+  """prints how results compare with baseline. Returns the operations that got more
+  than tolerance (as a fraction) slower, ignoring differences below noise seconds"""
+  regressions = []
+  for name, seconds in results["times"].items():
+    before = baseline["times"].get(name)
+    if before == None:
+      print "%-45s %10s %10.4f" % (name, "-", seconds)
+      continue
+    slower = seconds > before * (1 + tolerance) and seconds - before > noise
+    if slower:
+      regressions.append(name)
+    print "%-45s %10.4f %10.4f %7.2fx%s" % (name, before, seconds,
+        seconds / before if before else float("inf"), "  REGRESSION" if slower else "")
+  print "=== %d of %d operations slower by more than %d%%" % (len(regressions),
+      len(results["times"]), tolerance * 100)
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--out", "-o", metavar="FILE", help="Write the results as JSON to FILE")
+  parser.add_argument("--baseline", "-b", metavar="FILE",
+      help="Compare the results with those in FILE. Exits with 1 if any are slower")
+  parser.add_argument("--compare", "-c", metavar="FILE",
+      help="Compare the results in FILE with the baseline instead of running")
+  parser.add_argument("--sizes", "-s", type=int, nargs="+", default=[1000, 10000],
+      metavar="ROWS", help="Sizes of the sheets, in rows. Default is 1000 10000")
+  parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=SHAPES,
+      help="Shapes of the sheets. Default is all")
+  parser.add_argument("--repeat", "-r", type=int, default=3,
+      help="Keep the best of this many runs. Default is 3")
+  parser.add_argument("--seed", type=int, default=0, help="Seed of the sheets. Default is 0")
+  parser.add_argument("--tolerance", "-t", type=float, default=0.25,
+      help="Fraction by which an operation may be slower than the baseline. Default is 0.25")
+  args = parser.parse_args()
+  if args.compare:
+    if not args.baseline:
+      parser.error("--compare needs a --baseline")
+    results = json.load(open(args.compare))
+  else:
+    results = OrderedDict([("meta", OrderedDict([("pysheet", __version__),
+        ("python", platform.python_version()), ("platform", platform.platform()),
+        ("sizes", args.sizes), ("shapes", args.shapes), ("repeat", args.repeat),
+        ("seed", args.seed)])), ("times", OrderedDict())])
+    tmp = tempfile.mkdtemp(prefix="pysheet_bench")
+    try:
+      for shape in args.shapes:
+        for size in args.sizes:
+          for name, seconds in benchmark(shape, size, tmp, args.seed, args.repeat).items():
+            results["times"]["%s/%d/%s" % (shape, size, name)] = seconds
+            sys.stderr.write("%-45s %10.4f\n" % ("%s/%d/%s" % (shape, size, name), seconds))
+      path = os.path.join(tmp, "locked.csv")
+      write(generate("tall", min(args.sizes), args.seed), path)
+      results["times"]["locked writes"] = timed(lambda state: lockedWrites(path),
+          repeat=args.repeat)
+      results["times"]["startup"] = timed(lambda state: startup(path), repeat=args.repeat)
+    finally:
+      shutil.rmtree(tmp)
+    if args.out:
+      with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+  if args.baseline and compare(results, json.load(open(args.baseline)), args.tolerance):
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -2,7 +2,7 @@
 
 import unittest, os, sys
 from subprocess import call, check_output, Popen, PIPE, STDOUT
-from time import sleep
+from time import sleep, time
 
 PYSHEET_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.insert(0, PYSHEET_DIR)
@@ -47,6 +47,19 @@ class TestFunctions(unittest.TestCase):
     p.contract()
     self.assertEqual(len(p),5)
     self.assertEqual(p.height(),9)
+    from pysheet.pysheet import transposeLines
+    lines = [["a","b","c"], ["d"], [], ["e","f"]]
+    for limit in [None, 1, 2, 4]: # in memory, or spilled a block at a time
+      self.assertEqual(list(transposeLines(lines, "-", limit)),
+          [("a","d","-","e"), ("b","-","-","f"), ("c","-","-","-")])
+    import resource # many blocks take no more files
+    limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (64, limits[1]))
+    try:
+      columns = list(transposeLines(([str(i), "a", "b"] for i in xrange(2000)), limit=3))
+    finally:
+      resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+    self.assertEqual(columns, [tuple(str(i) for i in xrange(2000)), ("a",) * 2000, ("b",) * 2000])
 
   def test_columns(self):
     p = Pysheet()
@@ -56,9 +69,19 @@ class TestFunctions(unittest.TestCase):
     self.assertEqual(len(p.getColumns()),3)
     self.assertEqual(len(p.getColumns(blanks=True)),5)
     self.assertEqual(len(p.getColumns(3)),4)
+    query = p.compileColumns(["h2", "h3>5"])
+    self.assertEqual(p.getColumns(query), p.getColumns(["h2", "h3>5"]))
+    self.assertEqual(p.produceColumn(query), p.produceColumn(["h2", "h3>5"]))
     self.assertTrue(p.containsColumn("id"))
     self.assertTrue(p.containsColumn("h3"))
     self.assertEqual(p.getHeaders(),['ID', 'H1', 'H2', 'H3'])
+    self.assertEqual([r[0] for r in p.getColumns(["h2=UNIQUE"], blanks=True)],
+            ['ID', 1, 2, 99, 88])
+    p.addCell("5", "h2", "b")
+    p.addCell("6", "h2", "b")
+    p.addCell("6", "h3", "x")
+    self.assertEqual(len(p.getColumns(["h2=UNIQUE"], blanks=True)), 5)
+    self.assertEqual(len(p.getColumns(["h2,h3=UNIQUE"], blanks=True)), 7)
     p.removeMissing(rows=False)
     self.assertEqual(p.getHeaders(),['ID'])
 
@@ -94,7 +117,572 @@ class TestFunctions(unittest.TestCase):
     p._COLLAPSE='|'
     p.consolidate(["bar","%","h"],mode='mean')
     self.assertEqual(p.grab('%','bar'),'foo|0.55%')
+    p = Pysheet(iterable=[["ID","x","id","X"],["a","1","B","2"],["c","2","","3"]])
+    p.contract(mode='add')
+    self.assertEqual(p.keys(headers=False), ["c","B"])
+    self.assertEqual(p.getColumns(), [["ID","x"],["c",5],["B",3]])
     
+  def test_exclude(self):
+    p = Pysheet(iterable=self.table)
+    self.assertFalse(p.excluded(1))
+    p.addCell(2, Pysheet._EXCLUDE_HEADER, "x")
+    self.assertTrue(p.excluded(2))
+    self.assertFalse(p.excluded(3))
+    self.assertEqual(sorted(p.getIds()), [1, 88, 99])
+    self.assertEqual(len(p.keys(exclude=False)), 5)
+    self.assertEqual([r[0] for r in p.getColumns("h1")], ['ID', 1])
+    self.assertEqual(sorted(p.produceColumn("h1")[0]), [1, 88, 99])
+    self.assertEqual(len(p.produceColumn("h1", exclude=False)[0]), 4)
+
+  def test_headerIndex(self):
+    p = Pysheet(iterable=self.table)
+    self.assertEqual(p.headerIndex("h2"), 2)
+    p.getHeaders()[2] = "c" # renamed in place
+    self.assertEqual(p.headerIndex("c"), 2)
+    self.assertEqual(p.headerIndex("h2"), -1)
+    self.assertEqual(p.getColumns("c")[0], ["ID", "c"])
+    p[Pysheet._HEADERS_ID][3] = "d"
+    self.assertEqual(p.headerIndex("d"), 3)
+    headerMap = p._headerMap # lookups do not rebuild it
+    self.assertEqual([p.headerIndex(h) for h in ["c", "d", "h1", "id"]], [2, 3, 1, 0])
+    self.assertTrue(p._headerMap is headerMap)
+    Pysheet._DEBUG = True
+    try:
+      p = Pysheet(iterable=self.table)
+      self.assertEqual(p.headerIndex("h2"), 2)
+      self.assertEqual(p.headerIndex("3"), 3)
+      self.assertEqual(p.headerIndex("h4"), -1)
+      p.insertColumn("h4")
+      self.assertEqual(p.headerIndex("h4"), 1)
+      self.assertEqual(p.headerIndex("h2"), 3)
+      p.rename("h5", header="h4")
+      self.assertEqual(p.headerIndex("h4"), -1)
+      self.assertEqual(p.headerIndex("__h5"), 1)
+      p.removeColumns([1, 2])
+      self.assertEqual(p.getHeaders(), ['ID', 'H2', 'H3'])
+      self.assertEqual(p.headerIndex("h3"), 2)
+      p.addCell(1, "h1", "x")
+      self.assertEqual(p.headerIndex("h1"), 3)
+      p += Pysheet(iterable=self.table)
+      p.contract()
+      self.assertEqual(p.headerIndex("h1"), 3)
+      self.assertEqual(p.headerIndex("id"), 0)
+    finally:
+      Pysheet._DEBUG = False
+
+  def test_columnar(self):
+    sheets = []
+    for storage in ["rows", "columnar"]:
+      p = Pysheet(iterable=self.table, storage=storage)
+      self.assertEqual(p[1], [1, 'a', 'b', 'c'])
+      self.assertEqual(p.getRow(3), None)
+      p.insertColumn("foo", init="x")
+      p.addCell("5", "h4", "d")
+      p.removeCell(99)
+      p.setCell(2, "ID", 4)
+      p += Pysheet(iterable=self.table, storage=storage)
+      p.contract()
+      p.consolidate(["bar", "h"], cleanUp=True)
+      p.removeColumns(1)
+      sheets.append(p)
+    self.assertEqual(sheets[0].keys(), sheets[1].keys())
+    self.assertEqual(sheets[0].getHeaders(), sheets[1].getHeaders())
+    self.assertEqual(sheets[0].getColumns(blanks=True), sheets[1].getColumns(blanks=True))
+    self.assertEqual(str(sheets[0]), str(sheets[1]))
+    self.assertRaises(PysheetException, Pysheet, storage="foo")
+
+  def test_typed(self):
+    table = [["ID","A","B","P"], ["1","2","0.5","1%"], ["2","","3","2%"], ["3","7","2.5",""],
+            ["4","2","","3%"]]
+    p = Pysheet(iterable=table)
+    q = Pysheet(iterable=table, typed=True)
+    self.assertEqual(q.inferTypes().values(), ['int', 'float', 'percentage'])
+    for query in [["A>1"], ["A<7", "B!3"], ["B=2.5"], ["A>1", "P~%"]]:
+      self.assertEqual(p.getColumns(query, blanks=True), q.getColumns(query, blanks=True))
+      self.assertEqual(p.produceColumn(query), q.produceColumn(query))
+    self.assertEqual(p.levels("a"), q.levels("a"))
+    q.addCell("5", "A", "9")
+    self.assertEqual(q.levels("a")[0], [2, 7, 9])
+    self.assertEqual(len(q.getColumns("A>5")), 3)
+    p.consolidate([["X", "A", "B"]], mode="mean")
+    q.consolidate([["X", "A", "B"]], mode="mean")
+    self.assertEqual(p.produceColumn("x")[1], q.produceColumn("x")[1][:-1])
+    # levels of merged floats, which the arrays keep truncated
+    for rows in [[["1","1","2"], ["2","1","2.4"], ["3","0","1"]],
+        [["1","0.2","0.4"], ["2","0.1","0.5"], ["3","0","0.3"]]]: # all within (-1, 1)
+      p = Pysheet(iterable=[["ID","A","B"]] + rows)
+      q = Pysheet(iterable=[["ID","A","B"]] + rows, typed=True)
+      p.consolidate([["X", "A", "B"]], mode="mean")
+      q.consolidate([["X", "A", "B"]], mode="mean")
+      Pysheet._DEBUG = True # checks the merged arrays against the cells
+      try:
+        self.assertEqual(q.levels("x"), p.levels("x"))
+      finally:
+        Pysheet._DEBUG = False
+    # rows changed in place
+    q = Pysheet(iterable=table, typed=True)
+    self.assertEqual([r[0] for r in q.getColumns("A>5")], ["ID", "3"])
+    q["1"][1] = "50"
+    self.assertEqual([r[0] for r in q.getColumns("A>5")], ["ID", "1", "3"])
+    for key, row in q:
+      if key == "3":
+        row[1] = "1"
+    self.assertEqual([r[0] for r in q.getColumns("A>5")], ["ID", "1"])
+    row = q.getRow("2")
+    q.getColumns("A>5")
+    row[1] = "60" # held from before the query: caught when debugging
+    Pysheet._DEBUG = True
+    try:
+      self.assertRaises(PysheetException, q.getColumns, "A>5")
+    finally:
+      Pysheet._DEBUG = False
+
+  def test_stream(self):
+    cgc = os.path.join(os.path.dirname(os.path.realpath(__file__)), "cancer.tsv")
+    query = ['GeneID>5000', 'Chr~1']
+    p = Pysheet(cgc, delimiter='\t')
+    streamed = Pysheet(delimiter='\t').iterColumns(query, filename=cgc)
+    self.assertEqual(p.getColumns(query), [row for key, row in streamed if row])
+    streamed = Pysheet(delimiter='\t').iterColumns(['Chr=UNIQUE'], filename=cgc)
+    self.assertRaises(PysheetException, list, streamed)
+    # the last of duplicate IDs is the one queried, like load
+    test = os.path.join(os.path.dirname(os.path.realpath(__file__)), "stream.csv")
+    with open(test, "w") as f:
+      f.write("ID,x\na,1\nb,2\na,3\nb,1\n")
+    pysheet = os.path.join(PYSHEET_DIR, "pysheet", "pysheet.py")
+    try:
+      self.assertEqual(check_output([sys.executable, pysheet, "-d", test, "-q", "x>1"]), "a\n")
+      self.assertEqual(check_output([sys.executable, pysheet, "-d", test, "-q", "x<2"]), "b\n")
+    finally:
+      os.unlink(test)
+
+  def test_journal(self):
+    from pysheet.pysheet import appendJournal
+    test_dir = os.path.dirname(os.path.realpath(__file__))
+    seq = os.path.join(test_dir, "sequential.csv")
+    test = os.path.join(test_dir, "journal.csv")
+    journal = test + Pysheet._JOURNAL_EXT
+    cells = [('a','N','2.5'), ('b','H','x'), ('b','H','y'), ('a','N','2.5')]
+    Pysheet(iterable=[['ID','H','N'],['a','1','5']]).save(seq)
+    Pysheet(iterable=[['ID','H','N'],['a','1','5']]).save(test)
+    for cell in cells: # rewrite the sheet for every cell
+      p = Pysheet(seq)
+      p.addCell(*cell, mode='mean')
+      p.save()
+    appendJournal(journal, cells[:2], 'mean')
+    appendJournal(journal, cells[2:], 'mean')
+    p = Pysheet(test)
+    self.assertTrue(os.path.isfile(journal))
+    p.save()
+    self.assertFalse(os.path.isfile(journal))
+    self.assertEqual(open(test).read(), open(seq).read())
+    # a cell appended while the journal is dropped is kept
+    appendJournal(journal, cells[:1])
+    p = Pysheet(test)
+    appendJournal(journal, cells[1:2])
+    script = ("import sys; sys.path.insert(0, %r)\nfrom pysheet.pysheet import appendJournal\n"
+        "appendJournal(%r, [('c', 'H', 'z')])") % (PYSHEET_DIR, journal)
+    rename, appenders = os.rename, []
+    def renaming(src, dst):
+      if dst == journal and not appenders: # between reading the journal and replacing it
+        appenders.append(Popen([sys.executable, "-c", script], close_fds=True))
+        sleep(0.5)
+      rename(src, dst)
+    os.rename = renaming
+    try:
+      p.save()
+    finally:
+      os.rename = rename
+    self.assertEqual(appenders[0].wait(), 0)
+    self.assertEqual([l.split(",")[0] for l in open(journal)], ["b", "c"])
+    # the journal belongs to --out
+    pysheet = os.path.join(test_dir, "..", "pysheet", "pysheet.py")
+    self.assertEqual(call([pysheet, "-d", seq, "-o", test, "-J", "-w", "d", "H", "1"]), 1)
+    self.assertEqual(call([pysheet, "-d", test, "-o", test, "-J", "-w", "d", "H", "1"]), 0)
+    self.assertEqual(call([pysheet, "-o", test, "--compact"]), 0)
+    self.assertEqual(Pysheet(test).getIds(), ["a", "b", "c", "d"])
+    self.assertFalse(os.path.isfile(journal))
+    os.unlink(test)
+    os.unlink(seq)
+
+  def test_serve(self):
+    test_dir = os.path.dirname(os.path.realpath(__file__))
+    pysheet = os.path.join(test_dir, "..", "pysheet", "pysheet.py")
+    test = os.path.join(test_dir, "serve.csv")
+    sock = os.path.join(test_dir, "serve.sock")
+    Pysheet(iterable=self.table).save(test)
+    server = Popen([sys.executable, pysheet, "serve", "--socket", sock, "--flush", "60"])
+    try:
+      deadline = time() + 10
+      while not os.path.exists(sock):
+        self.assertTrue(server.poll() == None and time() < deadline, "the server did not start")
+        sleep(0.05)
+      env = dict(os.environ, PYSHEET_SOCKET=sock)
+      before = open(test).read()
+      for i in range(3):
+        call([sys.executable, pysheet, "-d", test, "-w", "x%d" % i, "H1", str(i), "-o", test],
+            env=env)
+      self.assertEqual(check_output([sys.executable, pysheet, "-d", test, "-r", "x2", "H1"],
+          env=env), "2")
+      self.assertEqual(open(test).read(), before) # held back
+      # a write that fails half way is undone, and only that one
+      self.assertEqual(call([sys.executable, pysheet, "-d", test, "-w", "x3", "H1", "3", "-q",
+          "nosuch", "-o", test], env=env, stderr=PIPE), 3)
+      self.assertEqual(check_output([sys.executable, pysheet, "-d", test, "-r", "x2", "H1",
+          "x3", "H1"], env=env), "2")
+      # a write made to the file meanwhile is kept
+      call([sys.executable, pysheet, "-d", test, "-w", "v", "H1", "1", "-o", test, "-L"],
+          env=env)
+      self.assertEqual(call([sys.executable, pysheet, "-d", test, "-w", "direct", "H1", "2",
+          "-o", test, "-L"]), 0)
+      self.assertEqual(check_output([sys.executable, pysheet, "-d", test, "-r", "v", "H1",
+          "direct", "H1"], env=env), "12")
+      server.terminate()
+      server.wait()
+    finally:
+      if server.poll() == None:
+        server.terminate()
+        server.wait()
+    self.assertFalse(os.path.exists(sock))
+    self.assertEqual(Pysheet(test).getIds(), ["1", "2", "88", "99", "direct", "v", "x0", "x1",
+        "x2"])
+    # a write that times out on its lock is saved aside, and not kept in memory
+    import pysheet.pysheet as module
+    server = module.SheetServer(sock)
+    parse = lambda argv: module.argParser().parse_args(argv + ["-d", test, "-o", test])
+    module.run(parse(["-w", "y0", "H1", "0"]), server) # held back
+    lock = module.getLock("flock", test + ".lock")
+    self.assertTrue(lock.acquire(1))
+    timeout, module._LOCK_TIMEOUT = module._LOCK_TIMEOUT, 0.2
+    try:
+      module.run(parse(["-w", "y1", "H1", "1", "-L", test + ".lock", "-LM", "flock"]), server)
+    finally:
+      module._LOCK_TIMEOUT = timeout
+      lock.release()
+    aside = "%s.%d" % (test, os.getpid())
+    self.assertTrue("y1" in Pysheet(aside).getIds())
+    self.assertEqual(server._sheets.values()[0].sheet.getIds()[-2:], ["x2", "y0"])
+    server.flushSheets()
+    self.assertEqual(Pysheet(test).getIds()[-2:], ["x2", "y0"])
+    for path in [test, aside, test + ".lock"]:
+      if os.path.isfile(path):
+        os.unlink(path)
+
+  def test_profile(self):
+    from pysheet.pysheet import PysheetProfile
+    profile = PysheetProfile().start()
+    p = Pysheet(iterable=self.table)
+    p += Pysheet(iterable=self.table)
+    p.contract()
+    p.getColumns("h1")
+    profile.stop()
+    p.contract()
+    report = profile.report()
+    self.assertEqual(report["phases"].keys(), ["load", "merge", "contract", "query"])
+    self.assertEqual([s["calls"] for s in report["phases"].values()], [2, 1, 1, 1])
+    self.assertEqual(report["phases"]["contract"]["rows"], 4)
+    self.assertEqual(report["phases"]["contract"]["cells"], 16)
+
+  def test_startup(self):
+    test = os.path.join(os.path.dirname(os.path.realpath(__file__)), "startup.csv")
+    Pysheet(iterable=self.table).save(test)
+    script = ("import sys; sys.path.insert(0, %r); sys.argv[1:] = sys.argv[2:]\n"
+        "from pysheet.pysheet import main\ntry: main()\n"
+        "finally: print sorted(m for m in ('argparse', 'natsort', 'numpy') if m in sys.modules)")
+    command = [sys.executable, "-c", script % PYSHEET_DIR, "-", "-d", test]
+    self.assertEqual(check_output(command + ["-r", "2", "H1"]), "aa['argparse']\n")
+    self.assertEqual(check_output(command + ["-w", "3", "H1", "x", "-o", test]),
+        "['argparse', 'natsort']\n")
+    for path in [test, test + Pysheet._INDEX_EXT, test + Pysheet._SNAPSHOT_EXT]:
+      if os.path.isfile(path):
+        os.unlink(path)
+
+  def test_output(self):
+    from pysheet.pysheet import setupOutput
+    test = os.path.join(os.path.dirname(os.path.realpath(__file__)), "output.txt")
+    for unbuffered in [False, True]:
+      with open(test, "w") as f:
+        stdout, sys.stdout = sys.stdout, f
+        try:
+          self.assertEqual(setupOutput(unbuffered), f)
+          sys.stdout.write("1\n")
+          self.assertEqual(open(test).read(), "1\n" if unbuffered else "") # kept until closed
+          sys.stdout.close()
+        finally:
+          sys.stdout = stdout
+      self.assertEqual(open(test).read(), "1\n")
+    # a stream without a file is written to and left open
+    from StringIO import StringIO
+    from pysheet.pysheet import main
+    Pysheet(iterable=self.table).save(test)
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+      main(["-d", test, "-r", "2", "H1"])
+      self.assertFalse(sys.stdout.closed)
+      self.assertEqual(sys.stdout.getvalue(), "aa")
+    finally:
+      sys.stdout = stdout
+    for path in [test, test + Pysheet._INDEX_EXT, test + Pysheet._SNAPSHOT_EXT]:
+      if os.path.isfile(path):
+        os.unlink(path)
+
+  def test_table(self):
+    p = Pysheet(iterable=self.table)
+    self.assertEqual(str(p), "ID | H1 | H2 | H3\n===+====+====+===\n1  | a  | b  | c \n"
+        "2  | aa | bb | cc\n88 |    | 8  | 8 \n99 |    |    |   \n")
+    self.assertEqual(list(p.iterTable(head=1)), [
+        "ID | H1 | H2 | H3\n", "===+====+====+===\n", "1  | a  | b  | c \n", "* 3 more rows *\n"])
+    self.assertEqual("".join(p.iterTable(page=3)).split("\n")[5:9], [
+        "", "ID | H1 | H2 | H3", "===+====+====+===", "99 |    |    |   "]) # widths of the page
+    p.addCell(1, "H4", "x" * 100)
+    self.assertEqual(str(p).split("\n")[2:4], ["1  | a  | b  | c  | " + "x" * 60,
+        "   |    |    |    | " + "x" * 40 + " " * 20]) # wrapped to fit 80 characters
+    for i in range(20):
+      p.addCell(1, "more%d" % i, i)
+    self.assertEqual(str(p).split("\n")[-2], "* 5 more columns not shown *")
+
+  def test_locks(self):
+    from pysheet.pysheet import getLock
+    test_dir = os.path.dirname(os.path.realpath(__file__))
+    test = os.path.join(test_dir, "locks.csv")
+    lock = test + ".lock"
+    pysheet = os.path.join(test_dir, "..", "pysheet", "pysheet.py")
+    holder = ("import sys; sys.path.insert(0, %r)\nfrom pysheet.pysheet import getLock\n"
+        "lock = getLock(sys.argv[1], sys.argv[2])\nassert lock.acquire(5)\nprint 'locked'\n"
+        "sys.stdout.flush(); sys.stdin.read(); lock.release()") % PYSHEET_DIR
+    for method, timeout in [("flock", 0.2), ("lockf", 0.2), ("excl", 0.2), ("poll", 2)]:
+      # held by another process
+      other = Popen([sys.executable, "-c", holder, method, lock], stdin=PIPE, stdout=PIPE)
+      self.assertEqual(other.stdout.readline(), "locked\n")
+      mine = getLock(method, lock)
+      self.assertFalse(mine.acquire(timeout))
+      self.assertTrue(mine.waited > 0)
+      if method in ("flock", "lockf"): # the blocking wait is interrupted in time
+        self.assertTrue(mine.waited < timeout + 0.5)
+        import threading # and outside the main thread it polls
+        waiter = threading.Thread(target=lambda: results.append(mine.acquire(timeout)))
+        results = []
+        waiter.start()
+        waiter.join()
+        self.assertEqual(results, [False])
+      other.communicate()
+      self.assertTrue(mine.acquire(5))
+      mine.release()
+      self.assertFalse(os.path.exists(lock))
+      # through the command line
+      Pysheet(iterable=self.table).save(test)
+      self.assertEqual(call([pysheet, "-d", test, "-o", test, "-L", "-LM", method,
+          "-w", "5", "H1", "x"]), 0)
+      self.assertEqual(Pysheet(test).grab(key="5", header="H1"), "x")
+      self.assertFalse(os.path.exists(lock))
+    # stale lock files are removed
+    for method, age in [("excl", 60), ("poll", 200)]:
+      open(lock, "w").write("12345")
+      os.utime(lock, (time() - age, time() - age))
+      mine = getLock(method, lock)
+      self.assertTrue(mine.acquire(5))
+      mine.release()
+    open(lock, "w").write("12345")
+    found = os.stat(lock)
+    open(lock + ".new", "w").write("67890")
+    os.rename(lock + ".new", lock) # taken again since it was found stale
+    getLock("excl", lock)._removeStale(found)
+    self.assertEqual(open(lock).read(), "67890")
+    open(lock + ".break", "w").close() # another waiter is removing it
+    getLock("excl", lock)._removeStale(os.stat(lock))
+    self.assertEqual(open(lock).read(), "67890")
+    os.unlink(lock + ".break")
+    getLock("excl", lock)._removeStale(os.stat(lock))
+    self.assertFalse(os.path.exists(lock))
+    self.assertEqual(sorted(f for f in os.listdir(test_dir) if f.startswith("locks.csv")),
+        ["locks.csv"])
+    os.unlink(test)
+
+  def test_snapshot(self):
+    test = os.path.join(os.path.dirname(os.path.realpath(__file__)), "snapshot.csv")
+    snapshot = test + Pysheet._SNAPSHOT_EXT
+    p = Pysheet(iterable=self.table)
+    p.addCell("1", "H1", 2.5)
+    p.save(test, snapshot=True)
+    self.assertTrue(os.path.isfile(snapshot))
+    for storage in ['rows', 'columnar']:
+      loaded = Pysheet(test, storage=storage)
+      os.rename(snapshot, snapshot + ".bak")
+      parsed = Pysheet(test, storage=storage)
+      os.rename(snapshot + ".bak", snapshot)
+      self.assertEqual([list(r) for k, r in loaded], [list(r) for k, r in parsed])
+    self.assertEqual(Pysheet(test, idColumn=1).getIds(), ['2.5', 'aa', ''])
+    # a file of the same size and mtime renamed over it
+    stat = os.stat(test)
+    with open(test + ".new", "w") as f:
+      f.write(open(test).read().replace("aa", "zz"))
+    os.utime(test + ".new", (stat.st_atime, stat.st_mtime))
+    os.rename(test + ".new", test)
+    self.assertEqual(Pysheet(test).grab("2", "H1"), "zz")
+    p.save(test, snapshot=True)
+    p.addCell("#5", "H1", "x") # would be read back as a comment
+    p.save(test, snapshot=True)
+    self.assertFalse(os.path.isfile(snapshot))
+    p.save(test) # a stale snapshot is removed
+    self.assertFalse(os.path.isfile(snapshot))
+    os.unlink(test)
+
+  def test_save(self):
+    test = os.path.join(os.path.dirname(os.path.realpath(__file__)), "save.csv")
+    for storage in ['rows', 'columnar']:
+      p = Pysheet(iterable=self.table, storage=storage)
+      p.save(test, snapshot=True)
+      for q in [p, Pysheet(test, storage=storage)]: # saved, or loaded from the snapshot
+        q.setCell("2", "H1", "x,y")
+        q.addCell("10", "H3", 10)
+        q.removeCell("99")
+        q.save(test, snapshot=True)
+        self.assertEqual(open(test).read(), "ID,H1,H2,H3\r\n1,a,b,c\r\n2,\"x,y\",bb,cc\r\n"
+            "10,,,10\r\n88,,8,8\r\n")
+    # through a symlink, keeping the mode of the file
+    link = os.path.join(os.path.dirname(test), "savelink.csv")
+    os.chmod(test, 0640)
+    os.symlink(test, link)
+    try:
+      p = Pysheet(link)
+      p.addCell("11", "H1", "z")
+      p.save()
+      self.assertTrue(os.path.islink(link))
+      self.assertEqual(os.stat(test).st_mode & 0777, 0640)
+      self.assertEqual(Pysheet(test).grab("11", "H1"), "z")
+    finally:
+      os.unlink(link)
+    self.assertEqual([f for f in os.listdir(os.path.dirname(test)) if f.startswith("save.csv.")],
+        ["save.csv" + Pysheet._SNAPSHOT_EXT])
+    os.unlink(test + Pysheet._SNAPSHOT_EXT)
+    os.unlink(test)
+
+  def test_sortedKeys(self):
+    for storage in ['rows', 'columnar']:
+      p = Pysheet(iterable=[["ID","v"],["b10","1"],["a2","2"],["B9","3"]], storage=storage)
+      self.assertEqual(p._sortedKeys(), ["a2", "b9", "b10"])
+      p.addCell("A10", "v", "4")
+      p.addCell("b1", "v", "5")
+      p.removeCell("b9")
+      p.rename("c", key="a2")
+      self.assertEqual(p._sortedKeys(), ["a10", "b1", "b10", "c"])
+      self.assertEqual(p.keys(headers=False), ["b10", "A10", "b1", "c"])
+
+  def test_lazy(self):
+    test = os.path.join(os.path.dirname(os.path.realpath(__file__)), "lazy.csv")
+    Pysheet(iterable=self.table + [["1", "dup", "", ""]]).save(test)
+    full = Pysheet(test)
+    for i in range(2): # builds the index, then uses it
+      lazy = Pysheet(test, lazy=True)
+      self.assertTrue(os.path.isfile(test + Pysheet._INDEX_EXT))
+      for key in ["1", "2", "88", "3"]:
+        self.assertEqual(lazy.getRow(key), full.getRow(key))
+      self.assertEqual(lazy.grab("1", "h1"), "dup")
+      self.assertEqual(lazy.height(), full.height())
+    self.assertRaises(PysheetException, lazy.addCell, "5", "h1", "x")
+    os.unlink(test + Pysheet._INDEX_EXT)
+    # \r\n line ends, also inside a quoted cell, and a sniffed delimiter
+    with open(test, 'wb') as f:
+      f.write('ID;h1;h2\r\n1;a;"x\r\ny"\r\n2;"b;c";d\r\n3;e;f\r\n')
+    full = Pysheet(test)
+    lazy = Pysheet(test, lazy=True)
+    self.assertTrue(os.path.isfile(test + Pysheet._INDEX_EXT))
+    self.assertEqual(lazy.delimiter, full.delimiter)
+    for key in ["1", "2", "3"]:
+      self.assertEqual(lazy.getRow(key), full.getRow(key))
+    self.assertEqual(lazy.getRow("1"), ["1", "a", "x\ny"])
+    os.unlink(test + Pysheet._INDEX_EXT)
+    # lone \r line ends are not indexed, the file is read as usual
+    with open(test, 'wb') as f:
+      f.write('ID,h1\r1,a\r2,b\r')
+    lazy = Pysheet(test, lazy=True)
+    self.assertFalse(os.path.isfile(test + Pysheet._INDEX_EXT))
+    self.assertEqual(lazy.getRow("2"), ["2", "b"])
+    os.unlink(test)
+
+  def test_merge(self):
+    from pysheet.pysheet import mergeSheets, mergeFiles
+    tables = [[["ID","x","y"],["a","1","2"],["b","3",""]], [["ID","y"],["b","4"],["c","5"]],
+        [["ID","x","x"],["a","6","7"]], [["ID","z","y"],["d","8","9"],["a","","1.5"]],
+        [["ID","x"],["c","2"]]]
+    for mode in ['smart_append', 'overwrite', 'append', 'add', 'mean']:
+      folded = Pysheet(iterable=tables[0])
+      for table in tables[1:]:
+        folded += Pysheet(iterable=table)
+        folded.contract(mode=mode)
+      merged = mergeSheets([Pysheet(iterable=table) for table in tables], mode)
+      self.assertEqual(merged.getColumns(blanks=True), folded.getColumns(blanks=True))
+    # columns named as the ID column re-key the rows merged so far
+    clashes = [[["ID","Id"],["k2","k1"],["k1","k3"],["k1","1"]], [["ID","A"],["k2","k2"],
+        ["k1","1"],["k2","k3"]], [["ID","A"],["k1","k2"],["k2",""],["k1","k3"]],
+        [["ID","Id","A"],["k2","1","k3"]]]
+    base = os.path.join(os.path.dirname(os.path.realpath(__file__)), "merge%d.csv")
+    for i, table in enumerate(clashes): # keeps the duplicate IDs
+      with open(base % i, "w") as f:
+        f.writelines(",".join(row) + "\n" for row in table)
+    try:
+      folded = Pysheet(base % 0)
+      for i in range(1, len(clashes)):
+        folded += Pysheet(base % i)
+        folded.contract(mode='smart_append')
+      expected = folded.getColumns(blanks=True)
+      merged = mergeSheets([Pysheet(base % i) for i in range(len(clashes))])
+      self.assertEqual(merged.getColumns(blanks=True), expected)
+      for jobs in [2, 3]:
+        merged = mergeFiles(Pysheet(base % 0), [(base % i, {}) for i in range(1,
+            len(clashes))], jobs=jobs)
+        self.assertEqual(merged.getColumns(blanks=True), expected)
+    finally:
+      for i in range(len(clashes)):
+        os.unlink(base % i)
+
+  def test_join(self):
+    other = Pysheet(iterable=[["ID","y"],["c","3"],["b","4"]])
+    expected = {'outer': ["a", "b", "c"], 'inner': ["b"], 'left': ["a", "b"], 'right': ["c", "b"]}
+    for storage in ['rows', 'columnar']:
+      for how in ['outer', 'inner', 'left', 'right']:
+        p = Pysheet(iterable=[["ID","x"],["a","1"],["b","2"]], storage=storage)
+        p.join(other, how)
+        p.contract()
+        self.assertEqual(p.keys(headers=False), expected[how])
+        self.assertEqual(p["b"], ["b", "2", "4"])
+    self.assertEqual(other.keys(headers=False), ["c", "b"])
+    self.assertRaises(PysheetException, p.join, other, "cross")
+
+  def test_consolidate(self):
+    table = [["ID","a1","ab","b1","c"], ["1","1","2","x","3"], ["2","4","","5","y"]]
+    for typed in [False, True]:
+      p = Pysheet(iterable=table, typed=typed)
+      p.consolidate([["A", "a"], ["B", "b", "c"]], cleanUp=True, mode="add")
+      self.assertEqual(p.getHeaders(), ["ID", "__A", "__B"])
+      self.assertEqual(p["1"], ["1", 3, "x;3"])
+      self.assertEqual(p["2"], ["2", "4", "5;y"])
+
+  def test_indexed(self):
+    for storage in ['rows', 'columnar']:
+      p = Pysheet(iterable=[["ID","x"],["a","1"],["b","2"],["c","1.0"]], storage=storage,
+          indexed=True)
+      self.assertEqual(p.grab(header="x", level=1), ["a", "c"])
+      self.assertEqual(p.levels("x"), ([1, 2], True, 2))
+      p.setCell("b", "x", "1")
+      p.addCell("d", "x", "2")
+      p.removeCell("a", "x")
+      self.assertEqual(p.grab(header="x", level=1), ["b", "c"])
+      self.assertEqual(p.getColumns("x=2"), [["ID", "x=2"], ["d", "2"]])
+      self.assertEqual(p.levels("x"), ([1, 2], True, 2))
+      # rows changed in place
+      p["c"][1] = "7"
+      self.assertEqual(p.grab(header="x", level=1), ["b"])
+      self.assertEqual(p.grab(header="x", level=7), ["c"])
+      row = p.getRow("d")
+      self.assertEqual(p.grab(header="x", level=2), ["d"])
+      row[1] = "9" # held from before the lookup: caught when debugging
+      Pysheet._DEBUG = True
+      try:
+        self.assertRaises(PysheetException, p.grab, header="x", level=2)
+      finally:
+        Pysheet._DEBUG = False
+
   def test_example(self):
     # get the directories right
     test_dir = os.path.dirname(os.path.realpath(__file__))